@@ -13,6 +13,8 @@ from enum import Enum
 import google.generativeai as genai
 import os
 
+from utils import parse_llm_json
+
 # Configure Gemini
 genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
 
@@ -201,7 +203,7 @@ Return ONLY valid JSON."""
             result = self._generate_response(specialty_prompt)
             
             try:
-                parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
+                parsed = parse_llm_json(result)
                 matched_specialties = [
                     parsed.get("primary_specialty", "General Medicine")
                 ]
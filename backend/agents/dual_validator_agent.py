@@ -7,13 +7,14 @@ Implements comprehensive validation of SOAP notes:
 Uses Groq as primary LLM to avoid Gemini quota issues.
 """
 
-import json
 import re
 from typing import Dict, Any, List, Tuple
 from dataclasses import dataclass
 from enum import Enum
 import os
 
+from utils import parse_llm_json
+
 # Try to import Groq (primary LLM)
 try:
     from groq import Groq
@@ -406,7 +407,7 @@ Return ONLY valid JSON."""
         result = self._generate_response(prompt)
         
         try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
+            parsed = parse_llm_json(result)
             return parsed.get("contradictions", [])
         except:
             return []
@@ -430,7 +431,7 @@ Return ONLY valid JSON."""
         result = self._generate_response(prompt)
         
         try:
-            return json.loads(result.replace("```json", "").replace("```", "").strip())
+            return parse_llm_json(result)
         except:
             return {"complaints": []}
     
@@ -456,7 +457,7 @@ Return ONLY valid JSON."""
         result = self._generate_response(prompt)
         
         try:
-            return json.loads(result.replace("```json", "").replace("```", "").strip())
+            return parse_llm_json(result)
         except:
             return {"medications": [], "tests": [], "follow_ups": []}
     
@@ -488,7 +489,7 @@ Return ONLY valid JSON."""
         result = self._generate_response(prompt)
         
         try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
+            parsed = parse_llm_json(result)
             return parsed.get("key_info", [])
         except:
             return []
@@ -530,7 +531,7 @@ Return ONLY valid JSON."""
         result = self._generate_response(prompt)
         
         try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
+            parsed = parse_llm_json(result)
             
             for issue in parsed.get("issues", []):
                 issues.append(ValidationIssue(
@@ -4,17 +4,350 @@ Handles patient symptom collection through conversational interface
 and generates triage priority with preliminary SOAP
 """
 
+import asyncio
+import hashlib
 import json
-from typing import Dict, Any, List, Optional
-from dataclasses import dataclass, field
-from datetime import datetime
+import re
+import time
+from collections import OrderedDict, deque
+from contextlib import aclosing
+from typing import AsyncIterator, Deque, Dict, Any, List, Optional, Tuple, Union, Literal, Type, TypeVar
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timezone
 from enum import Enum
 
 import os
-from groq import Groq
+from groq import APIConnectionError, APIError, AsyncGroq, DefaultAioHttpClient, RateLimitError
+import orjson
+from cachetools import LRUCache
+from pydantic import BaseModel, ValidationError, field_validator
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
+
+from response_cache import ResponseCache, response_cache
+from session_store import SessionStore
+from utils import now_iso
+
+# Configure Groq client (async, aiohttp transport); retries are handled by _create_completion
+groq_client = AsyncGroq(api_key=os.getenv("GROQ_API_KEY"), http_client=DefaultAioHttpClient(), max_retries=0)
+
+# Caps concurrent in-flight Groq requests. This is backpressure, not batching:
+# Groq's chat API takes one conversation per request. Concurrency only bounds
+# bursts; Groq's limits are per minute (RPM/TPM, set by the account tier), and
+# 429s are retried with backoff by _create_completion. Raise it only on tiers
+# whose RPM covers GROQ_CONCURRENCY x requests per second per slot.
+GROQ_CONCURRENCY = int(os.getenv("GROQ_CONCURRENCY", "8"))
+groq_semaphore = asyncio.Semaphore(GROQ_CONCURRENCY)
+
+# Returned by _generate_response when Groq fails
+GROQ_FALLBACK = "I'm having trouble processing that. Could you please try again?"
+
+# Per-attempt timeout for non-streaming Groq calls, in seconds
+GROQ_TIMEOUT = float(os.getenv("GROQ_TIMEOUT", "15"))
+
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(initial=0.2, max=2.0),
+    retry=retry_if_exception_type((APIConnectionError, RateLimitError)),
+    reraise=True
+)
+async def _create_completion(**kwargs):
+    """Chat completion with a timeout, retried on connection errors and 429s"""
+    async with groq_semaphore:
+        async with asyncio.timeout(GROQ_TIMEOUT):
+            return await groq_client.chat.completions.create(**kwargs)
+
+# ----------------------------------------------------------------------------
+# System prompts
+# Every call sends a static system message followed by a user message that
+# carries only the variable patient data. Keep these byte-identical across
+# calls (no interpolation) so the provider can reuse the cached prefix.
+# ----------------------------------------------------------------------------
+
+INTAKE_PERSONA = "You are a helpful healthcare intake assistant. Always respond with valid JSON when asked."
+
+TRIAGE_CRITERIA = """TRIAGE CRITERIA:
+- RED (Emergency): Life-threatening, needs immediate attention. Score 9-10.
+  Examples: Chest pain with cardiac features, stroke symptoms, severe breathing difficulty, active bleeding
+  
+- ORANGE (Urgent): Serious but not immediately life-threatening. Score 7-8.
+  Examples: High fever with concerning symptoms, moderate breathing issues, severe pain
+  
+- YELLOW (Semi-Urgent): Needs attention within hours. Score 4-6.
+  Examples: Moderate pain, persistent symptoms, infections needing treatment
+  
+- GREEN (Routine): Can wait for scheduled appointment. Score 1-3.
+  Examples: Mild symptoms, follow-ups, preventive care, chronic condition management"""
+
+TRIAGE_JSON = """{
+  "priority": "red|orange|yellow|green",
+  "score": 1-10,
+  "reasoning": "Brief explanation",
+  "specialties": ["Primary specialty", "Alternative specialty"],
+  "red_flags_detected": ["any concerning signs"],
+  "recommendations": ["immediate actions if any"]
+}"""
+
+SOAP_JSON = """{
+  "Subjective": "Patient-reported symptoms, history, and complaints from the intake. Include duration, severity, and associated symptoms.",
+  "Objective": "Available vitals and any measurable data provided. Note what still needs to be assessed by doctor.",
+  "Assessment": "Preliminary assessment based on reported symptoms. Include differential diagnoses to consider. Mark as 'PRELIMINARY - Pending physician examination'",
+  "Plan": "Suggested initial workup and questions for the physician to address. This is NOT a treatment plan - just guidance for the consultation."
+}"""
+
+SOAP_NOTES = """IMPORTANT: 
+- This is a PRE-VISIT note, not final documentation
+- Mark uncertain areas clearly
+- The doctor will complete the examination and finalize"""
+
+# Fused extraction + follow-up question; user message carries the conversation state
+TURN_SYSTEM = INTAKE_PERSONA + """
+
+Be compassionate. Analyze the patient's latest message, extract health information, and generate the NEXT most relevant question.
+
+RULES FOR THE RESPONSE:
+1. Ask ONE focused question about information still missing after this message
+2. Be empathetic and warm
+3. Briefly acknowledge what patient shared
+4. Keep response to 2-3 sentences max
+5. Use simple language, no medical jargon
+
+Return JSON:
+{
+    "extracted": {
+        "chief_complaint": "main symptom if mentioned, or null",
+        "location": "body location if specified, or null",
+        "duration": "how long symptoms present, or null",
+        "severity": "severity 1-10 or description, or null",
+        "associated_symptoms": ["list of additional symptoms"],
+        "medical_history": "conditions mentioned, or null",
+        "medications_allergies": "medications/allergies, or null"
+    },
+    "response": "Your empathetic response with follow-up question"
+}
+
+Return ONLY valid JSON."""
+
+# Fused triage + preliminary SOAP used when the dynamic intake completes
+ASSESSMENT_SYSTEM = INTAKE_PERSONA + """
+
+You are a clinical triage specialist. Assess the patient intake, provide triage priority, and generate a preliminary SOAP note.
+
+""" + TRIAGE_CRITERIA + """
+
+The SOAP note is a PRELIMINARY note for the doctor to review and complete.
+""" + SOAP_NOTES + """
+
+Return as JSON:
+{
+  "triage": """ + TRIAGE_JSON + """,
+  "soap": """ + SOAP_JSON + """
+}
+
+Return ONLY valid JSON."""
+
+# User message templates, filled with str.format per call
+TURN_USER = """CONVERSATION:
+{conversation}
+
+CURRENT MESSAGE: "{message}"
+
+INFORMATION COLLECTED SO FAR:
+- Chief complaint: {chief_complaint}
+- Location: {location}
+- Duration: {duration}
+- Severity: {severity}
+- Associated symptoms: {associated_symptoms}
+- Medical history: {medical_history}
+
+TURN: {turn_count} of {max_turns}"""
+
+INTAKE_RECORD_USER = """CONVERSATION:
+{conversation}
+
+EXTRACTED DATA:
+{extracted}"""
+
+
+def _fewshot_turn(history: List[str], message: str, turn: int, extracted: Dict[str, Any], response: str,
+                  **collected: Any) -> List[Dict[str, str]]:
+    """One worked turn example as a user/assistant message pair"""
+    known = {k: collected.get(k) or "Unknown" for k in (
+        "chief_complaint", "location", "duration", "severity", "associated_symptoms", "medical_history"
+    )}
+    user = TURN_USER.format(
+        conversation="\n".join([*history, f"USER: {message}"]), message=message, turn_count=turn, max_turns=8, **known
+    )
+    extracted = {**dict.fromkeys(known, None), "associated_symptoms": [], "medications_allergies": None, **extracted}
+    return [
+        {"role": "user", "content": user},
+        {"role": "assistant", "content": json.dumps({"extracted": extracted, "response": response})}
+    ]
+
+
+# Worked examples sent as earlier chat turns, ahead of the real user message.
+# They let the small model match the JSON shape and tone of the larger one.
+FEWSHOT_MESSAGES: Dict[str, List[Dict[str, str]]] = {
+    TURN_SYSTEM: [
+        *_fewshot_turn(
+            [],
+            "I've had a really bad headache",
+            1,
+            {"chief_complaint": "headache", "location": "head"},
+            "I'm sorry you're dealing with a bad headache. How long have you had it?"
+        ),
+        *_fewshot_turn(
+            [
+                "USER: I've had a really bad headache",
+                "ASSISTANT: I'm sorry you're dealing with a bad headache. How long have you had it?"
+            ],
+            "since tuesday, about a 7 out of 10",
+            2,
+            {"duration": "since Tuesday", "severity": "7"},
+            "Thank you, that helps. Have you noticed anything else along with it, like nausea or sensitivity to light?",
+            chief_complaint="headache",
+            location="head"
+        ),
+        *_fewshot_turn(
+            [
+                "USER: I've had a really bad headache",
+                "ASSISTANT: I'm sorry you're dealing with a bad headache. How long have you had it?",
+                "USER: since tuesday, about a 7 out of 10",
+                "ASSISTANT: Thank you, that helps. Have you noticed anything else along with it, like nausea or sensitivity to light?"
+            ],
+            "yes I feel sick and threw up once this morning",
+            3,
+            {"associated_symptoms": ["nausea", "vomiting"]},
+            "That sounds uncomfortable, and I'm glad you told me. Do you have any ongoing health conditions, such as migraines or high blood pressure?",
+            chief_complaint="headache",
+            location="head",
+            duration="since Tuesday",
+            severity="7"
+        )
+    ]
+}
+
+
+def _fmt_value(value: Any) -> str:
+    if isinstance(value, dict):
+        return "; ".join(f"{k}: {v}" for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return ", ".join(map(str, value))
+    return str(value)
+
+
+def _fmt_kv(d: Dict[str, Any]) -> str:
+    """Terse "- key: value" bullets for prompt context; empty fields are left out"""
+    return "\n".join(f"- {k}: {_fmt_value(v)}" for k, v in d.items() if v) or "- none"
+
+
+def _chat_messages(system: str, user: str) -> List[Dict[str, str]]:
+    return [
+        {"role": "system", "content": system},
+        *FEWSHOT_MESSAGES.get(system, ()),
+        {"role": "user", "content": user}
+    ]
+
+# Turn messages up to this many (approximate) tokens go to the small model
+SMALL_MODEL_MAX_TOKENS = int(os.getenv("SMALL_MODEL_MAX_TOKENS", "50"))
+
+# Session store bounds (SESSION_MAX_COUNT applies to the in-process fallback)
+SESSION_MAX_COUNT = int(os.getenv("INTAKE_SESSION_MAX_COUNT", "10000"))
+SESSION_TTL = int(os.getenv("INTAKE_SESSION_TTL", "3600"))
+
+# Number of recent turns (user + assistant message pairs) shown to the turn prompt
+HISTORY_TAIL_TURNS = 6
+
+# collected_info fields tracked in IntakeSession.info_bits for the completion check
+BIT_CHIEF = 1
+BIT_DUR = 2
+BIT_SEV = 4
+BIT_ASSOC = 8
+BIT_HIST = 16
+BITS_ADDITIONAL = BIT_ASSOC | BIT_HIST
+INFO_FIELD_BITS = {
+    "chief_complaint": BIT_CHIEF,
+    "duration": BIT_DUR,
+    "severity": BIT_SEV,
+    "associated_symptoms": BIT_ASSOC,
+    "medical_history": BIT_HIST
+}
+
+# Exact-match cache of fused turn results, mostly hit by short common openers
+TURN_CACHE_SIZE = 4096
+_NON_ALNUM_RE = re.compile(r"[^a-z0-9 ]")
+
+_EXTRACTED_KEY_RE = re.compile(r'"extracted"\s*:\s*')
+_RESPONSE_KEY_RE = re.compile(r'"response"\s*:\s*"')
+
+
+def _decode_partial_json_string(raw: str) -> Tuple[str, bool]:
+    """
+    Decode the body of a JSON string literal that may still be arriving.
+    Returns the text decoded so far and whether the closing quote was seen.
+    """
+    i, n = 0, len(raw)
+    while i < n:
+        c = raw[i]
+        if c == "\\":
+            step = 6 if raw[i + 1:i + 2] == "u" else 2
+            if i + step > n:
+                break
+            i += step
+            continue
+        if c == '"':
+            return json.loads(f'"{raw[:i]}"', strict=False), True
+        i += 1
+    return json.loads(f'"{raw[:i]}"', strict=False), False
+
+
+# ============================================================================
+# LLM OUTPUT SCHEMAS
+# ============================================================================
+
+class ExtractedInfo(BaseModel):
+    chief_complaint: Optional[str] = None
+    location: Optional[str] = None
+    duration: Optional[Union[str, int, float]] = None
+    severity: Optional[Union[int, float, str]] = None
+    associated_symptoms: Optional[List[str]] = None
+    medical_history: Optional[Union[str, List[Any]]] = None
+    medications_allergies: Optional[Union[str, List[Any]]] = None
+
+
+class TriageAssessment(BaseModel):
+    priority: Literal["red", "orange", "yellow", "green"] = "yellow"
+    score: int = 5
+    reasoning: str = ""
+    specialties: List[str] = ["General Medicine"]
+    red_flags_detected: List[str] = []
+    recommendations: List[str] = []
+
+    @field_validator("priority", mode="before")
+    @classmethod
+    def _lower_priority(cls, v):
+        return v.lower() if isinstance(v, str) else v
+
+
+class PreliminarySOAP(BaseModel):
+    Subjective: str = ""
+    Objective: str = ""
+    Assessment: str = ""
+    Plan: str = ""
+
+
+class TurnStep(BaseModel):
+    extracted: ExtractedInfo = ExtractedInfo()
+    response: str = "Could you tell me more about your symptoms?"
+
+
+class IntakeAssessment(BaseModel):
+    triage: TriageAssessment = TriageAssessment()
+    soap: PreliminarySOAP = PreliminarySOAP()
+
+
+SchemaT = TypeVar("SchemaT", bound=BaseModel)
 
-# Configure Groq client
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
 
 
 class TriagePriority(Enum):
@@ -24,12 +357,29 @@ class TriagePriority(Enum):
     GREEN = "green"       # Routine - Standard scheduling
 
 
-@dataclass
+def _empty_collected_info() -> Dict[str, Any]:
+    return {
+        "chief_complaint": None,
+        "location": None,
+        "duration": None,
+        "severity": None,
+        "associated_symptoms": None,
+        "medical_history": None,
+        "medications_allergies": None
+    }
+
+
+@dataclass(slots=True)
 class IntakeSession:
     """Represents a patient intake session"""
     session_id: str
     patient_id: Optional[str] = None
-    conversation_history: List[Dict] = field(default_factory=list)
+    # Conversation as parallel columns: roles pre-uppercased for prompts, contents, epoch timestamps
+    roles: List[str] = field(default_factory=list)
+    contents: List[str] = field(default_factory=list)
+    timestamps: List[float] = field(default_factory=list)
+    # Pre-formatted "ROLE: content" lines for the last HISTORY_TAIL_TURNS turns
+    history_tail: Deque[str] = field(default_factory=lambda: deque(maxlen=2 * HISTORY_TAIL_TURNS), repr=False)
     current_stage: str = "greeting"
     symptoms: List[str] = field(default_factory=list)
     symptom_details: Dict = field(default_factory=dict)
@@ -43,6 +393,52 @@ class IntakeSession:
     final_soap: Optional[Dict] = None
     suggested_specialties: List[str] = field(default_factory=list)
     created_at: datetime = field(default_factory=datetime.now)
+    turn_count: int = 0
+    max_turns: int = 8
+    collected_info: Dict[str, Any] = field(default_factory=_empty_collected_info)
+    info_bits: int = 0
+    # Bumped on every save; keys the serialized session summary
+    version: int = 0
+
+    def add_message(self, role: str, content: str, ts: float) -> None:
+        self.roles.append(role.upper())
+        self.contents.append(content)
+        self.timestamps.append(ts)
+
+    @property
+    def conversation_history(self) -> List[Dict[str, Any]]:
+        """Row view of the conversation ({role, content, timestamp} dicts), built on demand"""
+        return [
+            {"role": role.lower(), "content": content, "timestamp": ts}
+            for role, content, ts in zip(self.roles, self.contents, self.timestamps)
+        ]
+
+
+def _fmt_ts(ts: float) -> str:
+    """ISO-8601 UTC string for an epoch timestamp"""
+    return datetime.fromtimestamp(ts, timezone.utc).isoformat()
+
+
+def _session_to_dict(session: IntakeSession) -> Dict[str, Any]:
+    """JSON-ready form of a session for the shared session store"""
+    data = asdict(session)
+    data["history_tail"] = list(session.history_tail)
+    data["triage_priority"] = session.triage_priority.value if session.triage_priority else None
+    data["created_at"] = session.created_at.isoformat()
+    return data
+
+
+def _session_from_dict(data: Dict[str, Any]) -> IntakeSession:
+    # Sessions stored before the columnar layout carry a list of message dicts
+    history = data.pop("conversation_history", None)
+    if history is not None:
+        data["roles"] = [msg["role"].upper() for msg in history]
+        data["contents"] = [msg["content"] for msg in history]
+        data["timestamps"] = [msg["timestamp"] for msg in history]
+    data["history_tail"] = deque(data.get("history_tail", []), maxlen=2 * HISTORY_TAIL_TURNS)
+    data["triage_priority"] = TriagePriority(data["triage_priority"]) if data.get("triage_priority") else None
+    data["created_at"] = datetime.fromisoformat(data["created_at"])
+    return IntakeSession(**data)
 
 
 class IntakeTriageAgent:
@@ -51,19 +447,6 @@ class IntakeTriageAgent:
     Guides patients through symptom collection and generates preliminary SOAP.
     """
     
-    INTAKE_STAGES = [
-        "greeting",
-        "chief_complaint",
-        "symptom_details",
-        "duration_severity",
-        "associated_symptoms",
-        "medical_history",
-        "medications_allergies",
-        "vitals",
-        "summary_confirmation",
-        "complete"
-    ]
-    
     # Red flag symptoms that trigger immediate escalation
     RED_FLAG_KEYWORDS = [
         "chest pain", "crushing", "can't breathe", "difficulty breathing",
@@ -72,41 +455,137 @@ class IntakeTriageAgent:
         "worst headache", "sudden weakness", "vision loss", "facial droop"
     ]
     
-    def __init__(self, model: str = "llama-3.3-70b-versatile"):
+    # All red flags as one case-insensitive alternation, scanned in a single pass.
+    # Anchored at the start of a word only, so inflected forms ("seizures",
+    # "overdosed", "chest pains") still match.
+    _RED_FLAG_RE = re.compile(r"(?i)\b(?:" + "|".join(re.escape(k) for k in RED_FLAG_KEYWORDS) + r")")
+    
+    _PRIORITY_EMOJI = {"red": "🔴", "orange": "🟠", "yellow": "🟡", "green": "🟢"}
+    
+    _DYNAMIC_SUMMARY_TEMPLATE = """✅ Thank you for completing the intake!
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+📋 Summary:
+• Main concern: {chief}
+• Duration: {duration}
+• Severity: {severity}
+
+━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
+
+{priority_emoji} Triage: {priority}
+🏥 Specialty: {specialty}
+
+Type "Yes" to find available doctors."""
+    
+    def __init__(self, model: str = "llama-3.3-70b-versatile", small_model: str = "llama-3.1-8b-instant"):
+        # 70B for triage/SOAP reasoning, 8B for per-turn extraction and questions
         self.model = model
-        self.sessions: Dict[str, IntakeSession] = {}
+        self.small_model = small_model
+        # Sessions idle for SESSION_TTL seconds are evicted; shared across workers when REDIS_URL is set
+        self.sessions: SessionStore[IntakeSession] = SessionStore(
+            "intake", _session_to_dict, _session_from_dict, ttl=SESSION_TTL, max_local=SESSION_MAX_COUNT
+        )
+        self._turn_cache: "OrderedDict[Tuple[str, str], TurnStep]" = OrderedDict()
+        # session_id -> (version, orjson bytes of get_session_summary)
+        self._summary_cache: LRUCache = LRUCache(maxsize=SESSION_MAX_COUNT)
     
-    def create_session(self, session_id: str, patient_id: Optional[str] = None) -> IntakeSession:
+    async def create_session(self, session_id: str, patient_id: Optional[str] = None) -> IntakeSession:
         """Create a new intake session"""
         session = IntakeSession(session_id=session_id, patient_id=patient_id)
-        self.sessions[session_id] = session
+        await self.sessions.put(session_id, session)
         return session
     
-    def get_session(self, session_id: str) -> Optional[IntakeSession]:
+    async def get_session(self, session_id: str) -> Optional[IntakeSession]:
         """Retrieve an existing session"""
-        return self.sessions.get(session_id)
+        return await self.sessions.get(session_id)
+    
+    async def save_session(self, session: IntakeSession) -> None:
+        """Persist changes made to a session outside process_message"""
+        session.version += 1
+        await self.sessions.put(session.session_id, session)
     
     def _check_red_flags(self, text: str) -> bool:
         """Check if text contains any red flag symptoms"""
-        text_lower = text.lower()
-        return any(flag in text_lower for flag in self.RED_FLAG_KEYWORDS)
+        return self._RED_FLAG_RE.search(text) is not None
     
-    def _generate_response(self, prompt: str) -> str:
-        """Generate response using Groq"""
+    async def _generate_response(self, system: str, user: str, json_mode: bool = False,
+                                 model: Optional[str] = None) -> str:
+        """
+        Generate response using Groq from a static system prompt and a variable user message.
+        With json_mode the provider guarantees a bare JSON object (no markdown fences).
+        """
+        extra = {"response_format": {"type": "json_object"}} if json_mode else {}
         try:
-            response = groq_client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {"role": "system", "content": "You are a helpful healthcare intake assistant. Always respond with valid JSON when asked."},
-                    {"role": "user", "content": prompt}
-                ],
+            response = await _create_completion(
+                model=model or self.model,
+                messages=_chat_messages(system, user),
                 temperature=0.7,
-                max_tokens=1024
+                max_tokens=1024,
+                **extra
             )
             return response.choices[0].message.content.strip()
-        except Exception as e:
+        except (APIError, TimeoutError) as e:
             print(f"Error generating response: {e}")
-            return "I'm having trouble processing that. Could you please try again?"
+            return GROQ_FALLBACK
+    
+    async def _generate_response_stream(self, system: str, user: str,
+                                        model: Optional[str] = None) -> AsyncIterator[str]:
+        """Generate response using Groq, yielding content deltas as they arrive"""
+        try:
+            async with groq_semaphore:
+                stream = await groq_client.chat.completions.create(
+                    model=model or self.model,
+                    messages=_chat_messages(system, user),
+                    temperature=0.7,
+                    max_tokens=1024,
+                    stream=True
+                )
+                async for chunk in stream:
+                    delta = chunk.choices[0].delta.content if chunk.choices else None
+                    if delta:
+                        yield delta
+        except Exception as e:
+            print(f"Error streaming response: {e}")
+    
+    async def _generate_validated(self, system: str, user: str, schema: Type[SchemaT],
+                                  model: Optional[str] = None) -> Optional[SchemaT]:
+        """
+        Generate and validate a JSON response against a schema.
+        Re-prompts once with the explicit JSON schema on a validation error;
+        returns None if the second attempt also fails so callers can fall back.
+        Only validated results are stored in the response cache.
+        """
+        cache_key = None
+        if response_cache is not None:
+            cache_key = ResponseCache.make_key(model or self.model, system, user, schema.__name__)
+            hit = await response_cache.aget(cache_key)
+            if hit is not None:
+                return schema.model_validate_json(hit)
+        
+        parsed = await self._validate_reply(system, user, schema, model)
+        if parsed is not None and cache_key is not None:
+            await response_cache.aput(cache_key, parsed.model_dump_json())
+        return parsed
+    
+    async def _validate_reply(self, system: str, user: str, schema: Type[SchemaT],
+                              model: Optional[str] = None) -> Optional[SchemaT]:
+        result = await self._generate_response(system, user, json_mode=True, model=model)
+        try:
+            return schema.model_validate_json(result)
+        except ValidationError as e:
+            print(f"Invalid {schema.__name__} output, retrying: {e.error_count()} error(s)")
+        
+        retry_user = (
+            f"{user}\n\nYour previous reply was not valid. Respond with ONLY a JSON object "
+            f"matching this JSON schema:\n{json.dumps(schema.model_json_schema())}"
+        )
+        result = await self._generate_response(system, retry_user, json_mode=True, model=model)
+        try:
+            return schema.model_validate_json(result)
+        except ValidationError as e:
+            print(f"Invalid {schema.__name__} output after retry: {e.error_count()} error(s)")
+            return None
     
     def get_greeting_message(self) -> str:
         """Get initial greeting message"""
@@ -117,41 +596,53 @@ class IntakeTriageAgent:
 To get started, could you please tell me:
 What brings you in today? What's your main concern or symptom?"""
     
-    def process_message(self, session_id: str, user_message: str) -> Dict[str, Any]:
+    def _begin_turn(self, session: IntakeSession, user_message: str) -> float:
+        """Record the user message for a new turn; returns the turn timestamp"""
+        # Increment turn count
+        session.turn_count += 1
+        
+        # One epoch timestamp per turn, shared by both history entries; formatted only on output
+        ts = time.time()
+        
+        # Add user message to history
+        self._append_history(session, "user", user_message, ts)
+        return ts
+    
+    def _end_turn(self, session: IntakeSession, ts: float, response_data: Dict[str, Any]) -> Dict[str, Any]:
+        """Record the assistant response for the turn"""
+        self._append_history(session, "assistant", response_data["response"], ts)
+        return response_data
+    
+    def _append_history(self, session: IntakeSession, role: str, content: str, ts: float) -> None:
+        """Append to the full history and the bounded, pre-formatted prompt tail"""
+        session.add_message(role, content, ts)
+        session.history_tail.append(f"{role.upper()}: {content}")
+    
+    def _is_intake_complete(self, session: IntakeSession) -> bool:
+        return self._should_complete_intake(session) or session.turn_count >= session.max_turns
+    
+    def _followup_reply(self, session: IntakeSession, response: str) -> Dict[str, Any]:
+        return {
+            "response": response,
+            "stage": "active",
+            "turn_count": session.turn_count,
+            "max_turns": session.max_turns,
+            "collected_info": session.collected_info
+        }
+    
+    async def process_message(self, session_id: str, user_message: str) -> Dict[str, Any]:
         """
         Process a user message and return the next response.
         Uses dynamic LLM-driven questioning based on conversation context.
         """
-        session = self.sessions.get(session_id)
+        session = await self.sessions.get(session_id)
         if not session:
             return {
                 "error": "Session not found",
                 "response": "Session expired. Please start a new conversation."
             }
         
-        # Initialize turn tracking if not exists
-        if not hasattr(session, 'turn_count'):
-            session.turn_count = 0
-            session.max_turns = 8
-            session.collected_info = {
-                "chief_complaint": None,
-                "location": None,
-                "duration": None,
-                "severity": None,
-                "associated_symptoms": None,
-                "medical_history": None,
-                "medications_allergies": None
-            }
-        
-        # Increment turn count
-        session.turn_count += 1
-        
-        # Add user message to history
-        session.conversation_history.append({
-            "role": "user",
-            "content": user_message,
-            "timestamp": datetime.now().isoformat()
-        })
+        ts = self._begin_turn(session, user_message)
         
         # Check for red flags first
         is_emergency = self._check_red_flags(user_message)
@@ -159,162 +650,240 @@ What brings you in today? What's your main concern or symptom?"""
             session.triage_priority = TriagePriority.RED
             session.triage_score = 10
             emergency_response = self._handle_emergency(session, user_message)
+            await self.save_session(session)
             return emergency_response
         
-        # Extract information from the current message
-        self._extract_information(session, user_message)
+        # Extract information and draft the follow-up question in one call
+        follow_up = await self._turn_step(session, user_message)
         
-        # Check if we should complete the intake
-        should_complete = self._should_complete_intake(session)
-        
-        if should_complete or session.turn_count >= session.max_turns:
-            response_data = self._complete_intake_dynamic(session)
+        if self._is_intake_complete(session):
+            response_data = await self._complete_intake_dynamic(session)
         else:
-            # Generate dynamic follow-up question
-            response_data = self._generate_dynamic_question(session)
-        
-        # Add assistant response to history
-        session.conversation_history.append({
-            "role": "assistant",
-            "content": response_data["response"],
-            "timestamp": datetime.now().isoformat()
-        })
+            response_data = self._followup_reply(session, follow_up)
         
+        response_data = self._end_turn(session, ts, response_data)
+        await self.save_session(session)
         return response_data
     
-    def _extract_information(self, session: IntakeSession, user_message: str) -> None:
-        """Extract and categorize information from user message"""
+    async def process_message_stream(self, session_id: str, user_message: str) -> AsyncIterator[Dict[str, Any]]:
+        """
+        Streaming variant of process_message.
+        Yields {"type": "delta", "delta": text} events while the follow-up
+        question is generated, then one {"type": "result", ...} event with
+        the same payload process_message returns.
+        """
+        session = await self.sessions.get(session_id)
+        if not session:
+            yield {
+                "type": "result",
+                "error": "Session not found",
+                "response": "Session expired. Please start a new conversation."
+            }
+            return
         
-        conversation_context = "\n".join([
-            f"{msg['role'].upper()}: {msg['content']}"
-            for msg in session.conversation_history[-6:]
-        ])
+        ts = self._begin_turn(session, user_message)
         
-        extract_prompt = f"""Analyze this patient message and extract health information.
-
-CONVERSATION:
-{conversation_context}
-
-CURRENT MESSAGE: "{user_message}"
-
-Extract and return as JSON:
-{{
-    "chief_complaint": "main symptom if mentioned, or null",
-    "location": "body location if specified, or null",
-    "duration": "how long symptoms present, or null",
-    "severity": "severity 1-10 or description, or null",
-    "associated_symptoms": ["list of additional symptoms"],
-    "medical_history": "conditions mentioned, or null",
-    "medications_allergies": "medications/allergies, or null"
-}}
-
-Return ONLY valid JSON."""
-
-        result = self._generate_response(extract_prompt)
+        if self._check_red_flags(user_message):
+            session.triage_priority = TriagePriority.RED
+            session.triage_score = 10
+            emergency_response = self._handle_emergency(session, user_message)
+            await self.save_session(session)
+            yield {"type": "delta", "delta": emergency_response["response"]}
+            yield {"type": "result", **emergency_response}
+            return
+        
+        streamed = []
+        async for delta in self._turn_step_stream(session, user_message):
+            streamed.append(delta)
+            yield {"type": "delta", "delta": delta}
+        
+        if self._is_intake_complete(session):
+            response_data = await self._complete_intake_dynamic(session)
+            yield {"type": "delta", "delta": response_data["response"]}
+        else:
+            follow_up = "".join(streamed) or "Thank you for sharing that. Could you tell me more about your symptoms?"
+            if not streamed:
+                yield {"type": "delta", "delta": follow_up}
+            response_data = self._followup_reply(session, follow_up)
+        
+        response_data = self._end_turn(session, ts, response_data)
+        await self.save_session(session)
+        yield {"type": "result", **response_data}
+    
+    async def _turn_step(self, session: IntakeSession, user_message: str) -> str:
+        """
+        Extract information from the user message and draft the next
+        follow-up question in a single LLM call.
+        Returns the follow-up response text.
+        """
+        key = self._turn_cache_key(session, user_message)
+        step = self._turn_cache.get(key)
+        if step is not None:
+            self._turn_cache.move_to_end(key)
+        else:
+            step = await self._generate_validated(
+                TURN_SYSTEM, self._turn_user(session, user_message), TurnStep, model=self._turn_model(user_message)
+            )
+            if step is None:
+                return "Thank you for sharing that. Could you tell me more about your symptoms?"
+            self._cache_turn(key, step)
         
-        try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-            
-            # Update collected info with non-null values
-            for key, value in parsed.items():
-                if value is not None and key in session.collected_info:
-                    if key == "associated_symptoms" and isinstance(value, list):
-                        existing = session.collected_info.get(key) or []
-                        session.collected_info[key] = list(set(existing + value))
-                    else:
-                        session.collected_info[key] = value
-                        
-            # Also update symptom_details
-            if parsed.get("chief_complaint"):
-                session.symptom_details["chief_complaint"] = parsed["chief_complaint"]
-                session.symptoms = [parsed["chief_complaint"]]
-            if parsed.get("duration"):
-                session.symptom_details["duration"] = parsed["duration"]
-            if parsed.get("severity"):
-                session.symptom_details["severity"] = parsed["severity"]
+        self._update_collected_info(session, step.extracted.model_dump())
+        return step.response
+    
+    def _turn_model(self, user_message: str) -> str:
+        """
+        Route short replies ("2 days", "no allergies") to the small model.
+        Long or multi-complaint messages escalate to the main model.
+        """
+        approx_tokens = len(user_message) // 4
+        if approx_tokens > SMALL_MODEL_MAX_TOKENS or user_message.count(",") + user_message.count(" and ") > 3:
+            return self.model
+        return self.small_model
+    
+    def _turn_cache_key(self, session: IntakeSession, user_message: str) -> Tuple[str, str]:
+        """
+        Normalized message plus a hash of everything else the turn prompt
+        depends on, so the same reply in a different conversation never collides.
+        """
+        normalized = _NON_ALNUM_RE.sub("", user_message.lower().strip())
+        context = json.dumps(
+            [session.roles[:-1], session.contents[:-1]]
+            + [session.collected_info, session.turn_count, session.max_turns],
+            default=str
+        )
+        return normalized, hashlib.sha1(context.encode()).hexdigest()
+    
+    def _cache_turn(self, key: Tuple[str, str], step: TurnStep) -> None:
+        self._turn_cache[key] = step
+        self._turn_cache.move_to_end(key)
+        if len(self._turn_cache) > TURN_CACHE_SIZE:
+            self._turn_cache.popitem(last=False)
+    
+    async def _turn_step_stream(self, session: IntakeSession, user_message: str) -> AsyncIterator[str]:
+        """
+        Streaming variant of _turn_step.
+        The turn JSON lists "extracted" before "response": once the extracted
+        object is complete it is applied to the session, and if that completes
+        the intake the stream is abandoned without decoding the question.
+        Otherwise the "response" string is yielded as it decodes.
+        """
+        key = self._turn_cache_key(session, user_message)
+        cached = self._turn_cache.get(key)
+        if cached is not None:
+            self._turn_cache.move_to_end(key)
+            self._update_collected_info(session, cached.extracted.model_dump())
+            if not self._is_intake_complete(session):
+                yield cached.response
+            return
+        
+        decoder = json.JSONDecoder()
+        buf = ""
+        extracted_done = False
+        emitted = 0
+        
+        stream = self._generate_response_stream(
+            TURN_SYSTEM, self._turn_user(session, user_message), model=self._turn_model(user_message)
+        )
+        async with aclosing(stream) as stream:
+            async for chunk in stream:
+                buf += chunk
                 
-        except Exception as e:
-            print(f"Error extracting information: {e}")
-
-    def _should_complete_intake(self, session: IntakeSession) -> bool:
-        """Determine if enough information has been collected"""
-        collected = session.collected_info
-        
-        has_chief_complaint = collected.get("chief_complaint") is not None
-        has_duration = collected.get("duration") is not None
-        has_severity = collected.get("severity") is not None
-        
-        min_turns_reached = session.turn_count >= 3
-        basic_info_complete = has_chief_complaint and (has_duration or has_severity)
-        has_additional = collected.get("associated_symptoms") or collected.get("medical_history")
+                if not extracted_done:
+                    m = _EXTRACTED_KEY_RE.search(buf)
+                    if not m:
+                        continue
+                    try:
+                        obj, _ = decoder.raw_decode(buf, m.end())
+                    except json.JSONDecodeError:
+                        continue
+                    extracted_done = True
+                    try:
+                        self._update_collected_info(session, ExtractedInfo.model_validate(obj).model_dump())
+                    except ValidationError as e:
+                        print(f"Invalid streamed extraction: {e.error_count()} error(s)")
+                    if self._is_intake_complete(session):
+                        return
+                
+                m = _RESPONSE_KEY_RE.search(buf)
+                if not m:
+                    continue
+                text, closed = _decode_partial_json_string(buf[m.end():])
+                if len(text) > emitted:
+                    yield text[emitted:]
+                    emitted = len(text)
+                if closed:
+                    break
         
-        if min_turns_reached and basic_info_complete and (has_additional or session.turn_count >= 5):
-            return True
-        return False
+        try:
+            self._cache_turn(key, TurnStep.model_validate_json(buf))
+        except ValidationError:
+            pass
     
-    def _generate_dynamic_question(self, session: IntakeSession) -> Dict[str, Any]:
-        """Generate contextual follow-up question based on conversation"""
-        
-        conversation_context = "\n".join([
-            f"{msg['role'].upper()}: {msg['content']}"
-            for msg in session.conversation_history
-        ])
+    def _turn_user(self, session: IntakeSession, user_message: str) -> str:
+        """Build the variable user message for the fused turn call"""
         
         collected = session.collected_info
         
-        prompt = f"""You are a compassionate healthcare intake assistant. Based on the conversation, generate the NEXT most relevant question.
-
-CONVERSATION:
-{conversation_context}
-
-INFORMATION COLLECTED:
-- Chief complaint: {collected.get('chief_complaint') or 'Unknown'}
-- Location: {collected.get('location') or 'Unknown'}
-- Duration: {collected.get('duration') or 'Unknown'}
-- Severity: {collected.get('severity') or 'Unknown'}
-- Associated symptoms: {collected.get('associated_symptoms') or 'Unknown'}
-- Medical history: {collected.get('medical_history') or 'Unknown'}
-
-TURN: {session.turn_count} of {session.max_turns}
-
-RULES:
-1. Ask ONE focused question about missing information
-2. Be empathetic and warm
-3. Briefly acknowledge what patient shared
-4. Keep response to 2-3 sentences max
-5. Use simple language, no medical jargon
-
-Return JSON:
-{{"response": "Your empathetic response with follow-up question"}}"""
+        return TURN_USER.format(
+            conversation="\n".join(session.history_tail),
+            message=user_message,
+            chief_complaint=collected.get('chief_complaint') or 'Unknown',
+            location=collected.get('location') or 'Unknown',
+            duration=collected.get('duration') or 'Unknown',
+            severity=collected.get('severity') or 'Unknown',
+            associated_symptoms=collected.get('associated_symptoms') or 'Unknown',
+            medical_history=collected.get('medical_history') or 'Unknown',
+            turn_count=session.turn_count,
+            max_turns=session.max_turns
+        )
+    
+    def _update_collected_info(self, session: IntakeSession, parsed: Dict[str, Any]) -> None:
+        """Merge extracted fields into the session"""
+        
+        # Update collected info with non-null values
+        for key, value in parsed.items():
+            if value is not None and key in session.collected_info:
+                if key == "associated_symptoms" and isinstance(value, list):
+                    # Ordered de-dup so symptoms keep the order the patient reported them
+                    existing = session.collected_info.get(key) or []
+                    session.collected_info[key] = list(dict.fromkeys(existing + value))
+                else:
+                    session.collected_info[key] = value
+                
+                # Additional fields only count once they hold something
+                bit = INFO_FIELD_BITS.get(key, 0)
+                if bit and (session.collected_info[key] or not bit & BITS_ADDITIONAL):
+                    session.info_bits |= bit
+                    
+        # Also update symptom_details
+        if parsed.get("chief_complaint"):
+            session.symptom_details["chief_complaint"] = parsed["chief_complaint"]
+            session.symptoms = [parsed["chief_complaint"]]
+        if parsed.get("duration"):
+            session.symptom_details["duration"] = parsed["duration"]
+        if parsed.get("severity"):
+            session.symptom_details["severity"] = parsed["severity"]
 
-        result = self._generate_response(prompt)
-        
-        try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-            response = parsed.get("response", "Could you tell me more about your symptoms?")
-        except:
-            response = "Thank you for sharing that. Could you tell me more about your symptoms?"
-        
-        return {
-            "response": response,
-            "stage": "active",
-            "turn_count": session.turn_count,
-            "max_turns": session.max_turns,
-            "collected_info": session.collected_info
-        }
+    def _should_complete_intake(self, session: IntakeSession) -> bool:
+        """Determine if enough information has been collected"""
+        bits = session.info_bits
+        return bool(
+            session.turn_count >= 3
+            and bits & BIT_CHIEF
+            and bits & (BIT_DUR | BIT_SEV)
+            and (session.turn_count >= 5 or bits & BITS_ADDITIONAL)
+        )
     
-    def _complete_intake_dynamic(self, session: IntakeSession) -> Dict[str, Any]:
+    async def _complete_intake_dynamic(self, session: IntakeSession) -> Dict[str, Any]:
         """Complete intake with dynamic data and generate SOAP"""
         session.current_stage = "complete"
         
-        # Generate triage
-        triage_result = self._generate_triage(session)
+        # Triage and preliminary SOAP come back from one combined call
+        triage_result, soap_result = await self._generate_assessment(session)
         session.triage_priority = TriagePriority(triage_result["priority"])
         session.triage_score = triage_result["score"]
         session.suggested_specialties = triage_result["specialties"]
-        
-        # Generate preliminary SOAP
-        soap_result = self._generate_preliminary_soap(session)
         session.preliminary_soap = soap_result
         
         collected = session.collected_info
@@ -322,24 +891,16 @@ Return JSON:
         duration = collected.get("duration") or "Not specified"
         severity = collected.get("severity") or "Not specified"
         
-        priority_emoji = {"red": "🔴", "orange": "🟠", "yellow": "🟡", "green": "🟢"}
         p = triage_result["priority"]
         
-        response = f"""✅ Thank you for completing the intake!
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-📋 Summary:
-• Main concern: {chief}
-• Duration: {duration}
-• Severity: {severity}
-
-━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━━
-
-{priority_emoji[p]} Triage: {p.title()}
-🏥 Specialty: {session.suggested_specialties[0] if session.suggested_specialties else 'General Medicine'}
-
-Type "Yes" to find available doctors."""
+        response = self._DYNAMIC_SUMMARY_TEMPLATE.format(
+            chief=chief,
+            duration=duration,
+            severity=severity,
+            priority_emoji=self._PRIORITY_EMOJI[p],
+            priority=p.title(),
+            specialty=session.suggested_specialties[0] if session.suggested_specialties else "General Medicine"
+        )
 
         return {
             "response": response,
@@ -380,383 +941,18 @@ Please type 1 or 2, or describe if your situation has changed."""
             "action_required": "emergency_escalation"
         }
     
-    def _process_stage(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Process message based on current conversation stage"""
-        
-        stage = session.current_stage
-        
-        if stage == "greeting":
-            return self._process_chief_complaint(session, user_message)
-        
-        elif stage == "chief_complaint":
-            return self._process_symptom_details(session, user_message)
-        
-        elif stage == "symptom_details":
-            return self._process_duration_severity(session, user_message)
-        
-        elif stage == "duration_severity":
-            return self._process_associated_symptoms(session, user_message)
-        
-        elif stage == "associated_symptoms":
-            return self._process_medical_history(session, user_message)
-        
-        elif stage == "medical_history":
-            return self._process_medications_allergies(session, user_message)
-        
-        elif stage == "medications_allergies":
-            return self._process_vitals(session, user_message)
-        
-        elif stage == "vitals":
-            return self._complete_intake(session, user_message)
-        
-        else:
-            return self._complete_intake(session, user_message)
-    
-    def _process_chief_complaint(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Extract and clarify chief complaint"""
-        
-        # Use LLM to extract symptoms
-        extract_prompt = f"""Extract the main symptoms/complaints from this patient message.
-Return as JSON: {{"symptoms": ["symptom1", "symptom2"], "needs_clarification": true/false, "clarification_question": "question if needed"}}
-
-Patient said: "{user_message}"
-
-If the complaint is vague, set needs_clarification to true and provide a follow-up question.
-Return ONLY valid JSON."""
-
-        result = self._generate_response(extract_prompt)
-        
-        try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-            session.symptoms = parsed.get("symptoms", [user_message])
-            session.symptom_details["chief_complaint"] = user_message
-            
-            if parsed.get("needs_clarification"):
-                response = parsed.get("clarification_question", 
-                    "Could you tell me more about that? Where exactly do you feel the discomfort?")
-            else:
-                session.current_stage = "chief_complaint"
-                response = f"""Thank you for sharing that. I understand you're experiencing: {', '.join(session.symptoms)}
-
-Now, let me ask a few more questions to better understand your symptoms.
-
-📍 Where exactly is the problem? (e.g., left side of chest, lower back, behind eyes)
-And can you describe what it feels like? (e.g., sharp, dull, throbbing, burning)"""
-        
-        except:
-            session.symptoms = [user_message]
-            session.current_stage = "chief_complaint"
-            response = f"""I see. Let me understand this better.
-
-📍 Where exactly do you feel this?
-And how would you describe the sensation? (e.g., sharp pain, dull ache, pressure)"""
-        
-        return {
-            "response": response,
-            "stage": session.current_stage,
-            "extracted": {"symptoms": session.symptoms}
-        }
-    
-    def _process_symptom_details(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Gather detailed symptom information"""
-        
-        session.symptom_details["location_description"] = user_message
-        session.current_stage = "symptom_details"
-        
-        response = """Got it, thank you for that detail.
-
-⏱️ How long have you been experiencing this?
-- When did it start? (e.g., 2 days ago, this morning, for the past week)
-- Is it constant or does it come and go?
-
-📊 On a scale of 1-10, how severe is it?
-(1 = barely noticeable, 10 = worst imaginable)"""
-        
-        return {
-            "response": response,
-            "stage": session.current_stage
-        }
-    
-    def _process_duration_severity(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Process duration and severity information"""
-        
-        # Extract duration and severity using LLM
-        extract_prompt = f"""Extract duration and severity from this patient message.
-Return as JSON: {{"duration": "X days/hours/weeks", "severity": 1-10, "pattern": "constant/intermittent"}}
-
-Patient said: "{user_message}"
-Return ONLY valid JSON. If severity not mentioned, estimate based on language used."""
-
-        result = self._generate_response(extract_prompt)
-        
-        try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-            session.symptom_details["duration"] = parsed.get("duration", "Not specified")
-            session.symptom_details["severity"] = parsed.get("severity", 5)
-            session.symptom_details["pattern"] = parsed.get("pattern", "Not specified")
-        except:
-            session.symptom_details["duration_raw"] = user_message
-        
-        session.current_stage = "duration_severity"
-        
-        response = """Thank you. Now let's check for any related symptoms.
-
-🔍 Are you experiencing any of these along with your main symptom?
-- Fever or chills
-- Nausea or vomiting
-- Fatigue or weakness
-- Headache
-- Dizziness
-- Any other symptoms
-
-Please list any additional symptoms you're experiencing, or type "None" if there aren't any."""
-        
-        return {
-            "response": response,
-            "stage": session.current_stage,
-            "extracted": session.symptom_details
-        }
-    
-    def _process_associated_symptoms(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Process associated symptoms"""
-        
-        if user_message.lower() not in ["none", "no", "nothing", "n/a"]:
-            extract_prompt = f"""Extract all symptoms mentioned.
-Return as JSON: {{"associated_symptoms": ["symptom1", "symptom2"]}}
-
-Patient said: "{user_message}"
-Return ONLY valid JSON."""
-
-            result = self._generate_response(extract_prompt)
-            try:
-                parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-                session.symptom_details["associated_symptoms"] = parsed.get("associated_symptoms", [])
-            except:
-                session.symptom_details["associated_symptoms"] = [user_message]
-        
-        session.current_stage = "associated_symptoms"
-        
-        response = """Noted. Now, a few questions about your medical background.
-
-📋 Medical History:
-1. Do you have any ongoing medical conditions? (e.g., diabetes, hypertension, asthma, heart disease)
-2. Have you had any surgeries in the past?
-3. Is there any relevant family history of medical conditions?
-
-Please share what's relevant, or type "None" if not applicable."""
-        
-        return {
-            "response": response,
-            "stage": session.current_stage
-        }
-    
-    def _process_medical_history(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Process medical history"""
-        
-        if user_message.lower() not in ["none", "no", "nothing", "n/a"]:
-            extract_prompt = f"""Extract medical history information.
-Return as JSON: {{"conditions": [], "surgeries": [], "family_history": []}}
-
-Patient said: "{user_message}"
-Return ONLY valid JSON."""
-
-            result = self._generate_response(extract_prompt)
-            try:
-                parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-                session.medical_history = parsed
-            except:
-                session.medical_history["raw"] = user_message
-        
-        session.current_stage = "medical_history"
-        
-        response = """Thank you for sharing that.
-
-💊 Medications & Allergies:
-1. Are you currently taking any medications? (prescription or over-the-counter)
-2. Do you have any known allergies? (medications, food, or environmental)
-
-Please list them, or type "None" if not applicable."""
-        
-        return {
-            "response": response,
-            "stage": session.current_stage
-        }
-    
-    def _process_medications_allergies(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Process medications and allergies"""
-        
-        if user_message.lower() not in ["none", "no", "nothing", "n/a"]:
-            extract_prompt = f"""Extract medications and allergies.
-Return as JSON: {{"medications": [], "allergies": []}}
-
-Patient said: "{user_message}"
-Return ONLY valid JSON."""
-
-            result = self._generate_response(extract_prompt)
-            try:
-                parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-                session.current_medications = parsed.get("medications", [])
-                session.allergies = parsed.get("allergies", [])
-            except:
-                pass
-        
-        session.current_stage = "medications_allergies"
-        
-        response = """Almost done! Just one more thing.
-
-🌡️ Current Vitals (if you have them):
-If you have access to any of these measurements, please share:
-- Temperature
-- Blood pressure
-- Heart rate/pulse
-- Oxygen level (SpO2)
-
-If you don't have these available, just type "Not available" and we'll continue."""
-        
-        return {
-            "response": response,
-            "stage": session.current_stage
-        }
-    
-    def _process_vitals(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Process vitals if provided"""
-        
-        if user_message.lower() not in ["not available", "none", "no", "n/a", "don't have"]:
-            extract_prompt = f"""Extract vital signs from this message.
-Return as JSON: {{"temperature": "value or null", "blood_pressure": "value or null", "heart_rate": "value or null", "oxygen_saturation": "value or null"}}
-
-Patient said: "{user_message}"
-Return ONLY valid JSON. Use null for missing values."""
-
-            result = self._generate_response(extract_prompt)
-            try:
-                parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-                session.vitals = {k: v for k, v in parsed.items() if v is not None}
-            except:
-                pass
-        
-        session.current_stage = "vitals"
-        
-        # Now complete the intake
-        return self._complete_intake(session, user_message)
-    
-    def _complete_intake(self, session: IntakeSession, user_message: str) -> Dict[str, Any]:
-        """Complete intake, generate triage and preliminary SOAP"""
-        
-        session.current_stage = "complete"
-        
-        # Generate triage assessment
-        triage_result = self._generate_triage(session)
-        session.triage_priority = TriagePriority(triage_result["priority"])
-        session.triage_score = triage_result["score"]
-        session.suggested_specialties = triage_result["specialties"]
-        
-        # Generate preliminary SOAP
-        soap_result = self._generate_preliminary_soap(session)
-        session.preliminary_soap = soap_result
-        
-        # Create summary response
-        priority_emoji = {
-            "red": "🔴",
-            "orange": "🟠",
-            "yellow": "🟡",
-            "green": "🟢"
-        }
-        
-        priority_text = {
-            "red": "Emergency - Immediate attention needed",
-            "orange": "Urgent - Priority scheduling",
-            "yellow": "Semi-Urgent - Same-day appointment recommended",
-            "green": "Routine - Standard scheduling"
-        }
-        
-        p = triage_result["priority"]
-        
-        response = f"""✅ Thank you for completing the intake assessment!
-
----
-📋 Summary of Your Symptoms:
-• Main concern: {', '.join(session.symptoms)}
-• Duration: {session.symptom_details.get('duration', 'Not specified')}
-• Severity: {session.symptom_details.get('severity', 'Not specified')}/10
-
----
-{priority_emoji[p]} Triage Assessment: {priority_text[p]}
-
-🏥 Recommended Specialty: {session.suggested_specialties[0] if session.suggested_specialties else 'General Medicine'}
-
----
-What happens next:
-1. We'll match you with the most suitable doctor
-2. You'll receive appointment options based on availability
-3. The doctor will review your preliminary assessment before your visit
-
-Would you like me to proceed with finding an available doctor?
-Type "Yes" to continue or "No" if you have more symptoms to add."""
-
-        return {
-            "response": response,
-            "stage": "complete",
-            "triage": triage_result,
-            "preliminary_soap": soap_result,
-            "session_complete": True,
-            "suggested_specialties": session.suggested_specialties
-        }
-    
-    def _generate_triage(self, session: IntakeSession) -> Dict[str, Any]:
-        """Generate triage priority based on collected information"""
-        
-        session_summary = {
-            "symptoms": session.symptoms,
-            "symptom_details": session.symptom_details,
-            "medical_history": session.medical_history,
-            "vitals": session.vitals,
-            "allergies": session.allergies
-        }
-        
-        triage_prompt = f"""You are a clinical triage specialist. Assess this patient intake and provide triage priority.
-
-PATIENT INFORMATION:
-{json.dumps(session_summary, indent=2)}
-
-TRIAGE CRITERIA:
-- RED (Emergency): Life-threatening, needs immediate attention. Score 9-10.
-  Examples: Chest pain with cardiac features, stroke symptoms, severe breathing difficulty, active bleeding
-  
-- ORANGE (Urgent): Serious but not immediately life-threatening. Score 7-8.
-  Examples: High fever with concerning symptoms, moderate breathing issues, severe pain
-  
-- YELLOW (Semi-Urgent): Needs attention within hours. Score 4-6.
-  Examples: Moderate pain, persistent symptoms, infections needing treatment
-  
-- GREEN (Routine): Can wait for scheduled appointment. Score 1-3.
-  Examples: Mild symptoms, follow-ups, preventive care, chronic condition management
-
-Return as JSON:
-{{
-  "priority": "red|orange|yellow|green",
-  "score": 1-10,
-  "reasoning": "Brief explanation",
-  "specialties": ["Primary specialty", "Alternative specialty"],
-  "red_flags_detected": ["any concerning signs"],
-  "recommendations": ["immediate actions if any"]
-}}
-
-Return ONLY valid JSON."""
-
-        result = self._generate_response(triage_prompt)
-        
-        try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
+    def _triage_result(self, parsed: Optional[TriageAssessment]) -> Dict[str, Any]:
+        """Convert a triage assessment to the result dict, with a default on failure"""
+        if parsed is not None:
             return {
-                "priority": parsed.get("priority", "yellow"),
-                "score": parsed.get("score", 5),
-                "reasoning": parsed.get("reasoning", ""),
-                "specialties": parsed.get("specialties", ["General Medicine"]),
-                "red_flags": parsed.get("red_flags_detected", []),
-                "recommendations": parsed.get("recommendations", [])
+                "priority": parsed.priority,
+                "score": parsed.score,
+                "reasoning": parsed.reasoning,
+                "specialties": parsed.specialties,
+                "red_flags": parsed.red_flags_detected,
+                "recommendations": parsed.recommendations
             }
-        except:
+        else:
             # Default to moderate priority if parsing fails
             return {
                 "priority": "yellow",
@@ -767,89 +963,92 @@ Return ONLY valid JSON."""
                 "recommendations": []
             }
     
-    def _generate_preliminary_soap(self, session: IntakeSession) -> Dict[str, Any]:
-        """Generate preliminary SOAP note from intake"""
+    async def _generate_assessment(self, session: IntakeSession) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+        """Generate triage and preliminary SOAP together in a single LLM call"""
         
-        conversation_text = "\n".join([
-            f"{msg['role'].upper()}: {msg['content']}"
-            for msg in session.conversation_history
-        ])
+        parsed = await self._generate_validated(ASSESSMENT_SYSTEM, self._intake_record(session), IntakeAssessment)
+        if parsed is None:
+            return self._triage_result(None), self._soap_result(None, session)
+        return self._triage_result(parsed.triage), self._soap_result(parsed.soap, session)
+    
+    def _intake_record(self, session: IntakeSession) -> str:
+        """Conversation and extracted data, the variable part of the SOAP prompts"""
         
-        soap_prompt = f"""Generate a preliminary SOAP note from this patient intake conversation.
-
-CONVERSATION:
-{conversation_text}
-
-EXTRACTED DATA:
-- Symptoms: {session.symptoms}
-- Symptom Details: {json.dumps(session.symptom_details)}
-- Medical History: {json.dumps(session.medical_history)}
-- Medications: {session.current_medications}
-- Allergies: {session.allergies}
-- Vitals: {json.dumps(session.vitals)}
-
-Generate a PRELIMINARY SOAP note for the doctor to review and complete:
-
-Return as JSON:
-{{
-  "Subjective": "Patient-reported symptoms, history, and complaints from the intake. Include duration, severity, and associated symptoms.",
-  "Objective": "Available vitals and any measurable data provided. Note what still needs to be assessed by doctor.",
-  "Assessment": "Preliminary assessment based on reported symptoms. Include differential diagnoses to consider. Mark as 'PRELIMINARY - Pending physician examination'",
-  "Plan": "Suggested initial workup and questions for the physician to address. This is NOT a treatment plan - just guidance for the consultation."
-}}
-
-IMPORTANT: 
-- This is a PRE-VISIT note, not final documentation
-- Mark uncertain areas clearly
-- The doctor will complete the examination and finalize
-Return ONLY valid JSON."""
-
-        result = self._generate_response(soap_prompt)
+        conversation_text = "\n".join(map(": ".join, zip(session.roles, session.contents)))
         
-        try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
+        # Plain bullets cost fewer tokens than JSON's quoted keys and escapes
+        extracted = _fmt_kv({
+            "symptoms": session.symptoms,
+            "symptom_details": session.symptom_details,
+            "medical_history": session.medical_history,
+            "medications": session.current_medications,
+            "allergies": session.allergies,
+            "vitals": session.vitals
+        })
+        
+        return INTAKE_RECORD_USER.format(conversation=conversation_text, extracted=extracted)
+    
+    def _soap_result(self, parsed: Optional[PreliminarySOAP], session: IntakeSession) -> Dict[str, Any]:
+        """Convert a preliminary SOAP to the result dict, with a fallback on failure"""
+        if parsed is not None:
             return {
-                "Subjective": parsed.get("Subjective", ""),
-                "Objective": parsed.get("Objective", ""),
-                "Assessment": parsed.get("Assessment", ""),
-                "Plan": parsed.get("Plan", ""),
+                **parsed.model_dump(),
                 "is_preliminary": True,
-                "generated_at": datetime.now().isoformat()
+                "generated_at": now_iso()
             }
-        except:
+        else:
             return {
                 "Subjective": f"Patient reports: {', '.join(session.symptoms)}",
                 "Objective": "Pending physician examination",
                 "Assessment": "PRELIMINARY - Pending physician examination",
                 "Plan": "Complete physical examination and clinical assessment",
                 "is_preliminary": True,
-                "generated_at": datetime.now().isoformat()
+                "generated_at": now_iso()
             }
     
-    def get_session_summary(self, session_id: str) -> Dict[str, Any]:
+    async def get_session_summary(self, session_id: str) -> Dict[str, Any]:
         """Get complete session summary for storage/transfer"""
-        session = self.sessions.get(session_id)
-        if not session:
+        raw = await self.get_session_summary_json(session_id)
+        if raw is None:
             return {"error": "Session not found"}
+        return orjson.loads(raw)
+    
+    async def get_session_summary_json(self, session_id: str) -> Optional[bytes]:
+        """
+        get_session_summary as JSON bytes, or None if the session doesn't exist.
+        Serialized once per session version and reused until the next save.
+        """
+        session = await self.sessions.get(session_id)
+        if not session:
+            return None
         
-        return {
+        cached = self._summary_cache.get(session_id)
+        if cached and cached[0] == session.version:
+            return cached[1]
+        
+        # orjson writes the TriagePriority enum and created_at datetime natively
+        raw = orjson.dumps({
             "session_id": session.session_id,
             "patient_id": session.patient_id,
-            "conversation_history": session.conversation_history,
+            "conversation_history": [
+                {"role": role.lower(), "content": content, "timestamp": _fmt_ts(ts)}
+                for role, content, ts in zip(session.roles, session.contents, session.timestamps)
+            ],
             "symptoms": session.symptoms,
             "symptom_details": session.symptom_details,
             "vitals": session.vitals,
             "medical_history": session.medical_history,
             "allergies": session.allergies,
             "current_medications": session.current_medications,
-            "triage_priority": session.triage_priority.value if session.triage_priority else None,
+            "triage_priority": session.triage_priority,
             "triage_score": session.triage_score,
             "preliminary_soap": session.preliminary_soap,
             "suggested_specialties": session.suggested_specialties,
-            "created_at": session.created_at.isoformat(),
+            "created_at": session.created_at,
             "current_stage": session.current_stage
-        }
-
+        }, default=str)
+        self._summary_cache[session_id] = (session.version, raw)
+        return raw
 
 # Create global instance
 intake_agent = IntakeTriageAgent()
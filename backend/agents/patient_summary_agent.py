@@ -5,30 +5,432 @@ Converts medical terminology to plain language.
 Uses Groq as primary LLM to avoid Gemini quota issues.
 """
 
-import json
-from typing import Dict, Any, List
-from datetime import datetime
+import asyncio
+import hashlib
+import re
+import time
+import unicodedata
+from collections import defaultdict, deque
+from contextlib import aclosing
+from typing import AsyncIterator, Awaitable, Callable, DefaultDict, Deque, Dict, Any, List, Optional, Tuple, Type
 import os
 
+import jinja2
+from pydantic import BaseModel, Field, ValidationError
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential
+
+from gemini_client import GEMINI_MODEL, gemini_client
+from response_cache import ResponseCache, response_cache
+from semantic_cache import SemanticCache
+from utils import now_iso, today_long
+
 # Try to import Groq (primary LLM)
 try:
-    from groq import Groq
+    from groq import APIConnectionError, APIError, AsyncGroq, DefaultAioHttpClient, InternalServerError, RateLimitError
     GROQ_AVAILABLE = True
+    # Transient failures worth retrying: connection errors, 429s and 5xx
+    GROQ_RETRYABLE = (APIConnectionError, RateLimitError, InternalServerError)
 except ImportError:
     GROQ_AVAILABLE = False
+    GROQ_RETRYABLE = ()
     print("⚠️ Groq not installed for patient summary agent.")
 
-# Try to import Gemini (fallback)
+# Gemini (fallback) comes from the process-wide client in gemini_client
 try:
-    import google.generativeai as genai
-    genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
-    GEMINI_AVAILABLE = True
+    from google.genai import types as genai_types
 except ImportError:
-    GEMINI_AVAILABLE = False
-    print("⚠️ Gemini not installed for patient summary agent.")
+    genai_types = None
+
+# Local BPE tokenizer for token budgets; avoids a provider count_tokens round trip
+try:
+    import tiktoken
+    _ENCODING = tiktoken.get_encoding("cl100k_base")
+except Exception as e:
+    _ENCODING = None
+    print(f"⚠️ tiktoken unavailable for patient summary agent, estimating tokens: {e}")
 
 GROQ_API_KEY = os.getenv("GROQ_API_KEY")
 
+# Caps concurrent in-flight LLM calls from this agent to respect provider rate limits
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "8"))
+summary_semaphore = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+# Recent successful Groq latencies per call kind (system prompt), so short SMS
+# calls and full summaries don't share a percentile. A call still running past
+# its kind's 95th percentile gets a duplicate request and the first to finish
+# wins, so only the slowest few percent of calls cost an extra request.
+_groq_latencies: DefaultDict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=200))
+HEDGE_DEFAULT_DELAY = float(os.getenv("SUMMARY_HEDGE_DELAY", "8"))
+
+
+def _hedge_delay(kind: str) -> float:
+    latencies = _groq_latencies[kind]
+    if len(latencies) < 20:
+        return HEDGE_DEFAULT_DELAY
+    return sorted(latencies)[int(len(latencies) * 0.95)]
+
+
+async def _hedged(call: Callable[[], Awaitable[Any]], kind: str) -> Any:
+    """Run call; if it outlives the hedge delay for its kind, race a second copy against it"""
+    first = asyncio.create_task(call())
+    done, _ = await asyncio.wait({first}, timeout=_hedge_delay(kind))
+    if done:
+        return first.result()
+    
+    pending = {first, asyncio.create_task(call())}
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is None:
+                for other in pending:
+                    other.cancel()
+                return task.result()
+    # Both copies failed; surface the original error
+    return first.result()
+
+# Subjective/Objective sections longer than this are condensed before prompting
+SOAP_SECTION_MAX_TOKENS = 400
+_SENTENCE_SPLIT_RE = re.compile(r"(?<=[.!?])\s+")
+
+# Cases per batched summary call, bounded by output length
+SUMMARY_BATCH_SIZE = 10
+
+# Token budget for SMS summaries
+SMS_TOKEN_BUDGET = 80
+
+
+def count_tokens(text: str) -> int:
+    return len(_ENCODING.encode(text)) if _ENCODING else len(text) // 4
+
+
+def _truncate_sms(text: str, max_tokens: int = SMS_TOKEN_BUDGET) -> str:
+    """Cut text to the token budget, ending in "..." when shortened"""
+    if count_tokens(text) <= max_tokens:
+        return text
+    if _ENCODING:
+        return _ENCODING.decode(_ENCODING.encode(text)[:max_tokens - 1]).rstrip() + "..."
+    return text[:max_tokens * 4 - 3].rstrip() + "..."
+
+
+def _condense(text: str, max_tokens: int = SOAP_SECTION_MAX_TOKENS) -> str:
+    """
+    Keep the first and last two sentences of an over-long narrative section,
+    marking what was left out. Only for Subjective/Objective: Assessment and
+    Plan carry diagnoses, medications and instructions and are never cut.
+    """
+    if count_tokens(text) <= max_tokens:
+        return text
+    sentences = _SENTENCE_SPLIT_RE.split(text.strip())
+    if len(sentences) > 4:
+        text = " ".join(sentences[:2] + [f"[... {len(sentences) - 4} sentences omitted ...]"] + sentences[-2:])
+    if len(text) > max_tokens * 4:
+        text = text[:max_tokens * 4].rstrip() + " [... truncated]"
+    return text
+
+def _fmt_medications(medications: List[Any]) -> str:
+    """One "- name dosage frequency" bullet per medication, terser than JSON"""
+    lines = []
+    for med in medications:
+        if isinstance(med, dict):
+            fields = (med.get("name", ""), med.get("dosage", ""), med.get("frequency", ""), med.get("instructions", ""))
+            lines.append("- " + " ".join(str(f) for f in fields if f))
+        else:
+            lines.append(f"- {med}")
+    return "\n" + "\n".join(lines)
+
+def _is_valid(result: str, schema: Optional[Type[BaseModel]]) -> bool:
+    """Whether a reply matches schema (always true for free text)"""
+    if schema is None:
+        return True
+    try:
+        schema.model_validate_json(result)
+        return True
+    except ValidationError:
+        return False
+
+def _prompt_fields(request: Dict[str, Any]) -> Dict[str, Any]:
+    """A generate_patient_summary request without the fields that don't go into the prompt"""
+    return {k: v for k, v in request.items() if k != "patient_id"}
+
+# Opt-in: near-duplicate Subjective/Objective text (whitespace edits, reordered
+# sentences) reuses a cached summary. Assessment, Plan, diagnoses, medications
+# and follow-up must match exactly, since the embedding truncates long prompts
+# and would not see a changed instruction.
+summary_semantic_cache = SemanticCache(
+    threshold=float(os.getenv("SUMMARY_CACHE_THRESHOLD", "0.95"))
+) if os.getenv("SEMANTIC_CACHE_ENABLED", "0") == "1" else None
+
+# ----------------------------------------------------------------------------
+# Prompts
+# Static instructions go in the system prompt (Groq system message, Gemini
+# system_instruction) so the provider can reuse the cached prefix; only the
+# SOAP fields travel in the user message.
+# ----------------------------------------------------------------------------
+
+SUMMARY_PERSONA = "You are a healthcare communication specialist who converts medical information to patient-friendly language."
+
+SUMMARY_RULES = """RULES:
+- Use 6th grade reading level; explain any medical term in parentheses
+- Be warm and reassuring but accurate
+- Use "you/your" language
+- Include specific actionable items
+- warning_signs: symptoms that need care, and what to do about each"""
+
+SUMMARY_SCHEMA = """{
+  "greeting": "greeting with patient name",
+  "visit_summary": "one line",
+  "what_we_found": "diagnosis, 2-3 sentences",
+  "body_explanation": "what is happening in the body, 1-2 sentences",
+  "treatment_plan": {
+    "medications": [{"name": "", "dosage": "", "frequency": "", "purpose": "", "special_instructions": ""}],
+    "other_treatments": [],
+    "lifestyle_advice": []
+  },
+  "important_instructions": [],
+  "warning_signs": [{"symptom": "", "action": ""}],
+  "next_steps": {"follow_up": "", "tests_needed": [], "contact_info": "when to call the office"},
+  "closing_message": ""
+}"""
+
+SUMMARY_SYSTEM = SUMMARY_PERSONA + """
+
+Convert the clinical SOAP note in the user message into a patient-friendly visit summary.
+
+""" + SUMMARY_RULES + """
+
+Return ONLY valid JSON:
+""" + SUMMARY_SCHEMA
+
+# Several encounters per call; each case in the user message is wrapped in <case id=N>
+SUMMARY_BATCH_SYSTEM = SUMMARY_PERSONA + """
+
+The user message holds several clinical SOAP notes, each inside <case id=N>...</case>.
+Convert each one into its own patient-friendly visit summary.
+
+""" + SUMMARY_RULES + """
+
+Return ONLY a valid JSON object with one element per case:
+{"cases": [{"case_id": N, "summary": <summary for case N>}]}
+
+Each summary has this shape:
+""" + SUMMARY_SCHEMA
+
+# ----------------------------------------------------------------------------
+# Output schemas
+# Sent to Gemini as response_schema and used to validate every reply.
+# default_factory keeps "default" out of the JSON schema, which Gemini rejects.
+# ----------------------------------------------------------------------------
+
+class SummaryMedication(BaseModel):
+    name: str = Field(default_factory=str)
+    dosage: str = Field(default_factory=str)
+    frequency: str = Field(default_factory=str)
+    purpose: str = Field(default_factory=str)
+    special_instructions: str = Field(default_factory=str)
+
+
+class TreatmentPlan(BaseModel):
+    medications: List[SummaryMedication] = Field(default_factory=list)
+    other_treatments: List[str] = Field(default_factory=list)
+    lifestyle_advice: List[str] = Field(default_factory=list)
+
+
+class WarningSign(BaseModel):
+    symptom: str = Field(default_factory=str)
+    action: str = Field(default_factory=str)
+
+
+class NextSteps(BaseModel):
+    follow_up: str = Field(default_factory=str)
+    tests_needed: List[str] = Field(default_factory=list)
+    contact_info: str = Field(default_factory=str)
+
+
+class PatientSummary(BaseModel):
+    greeting: str = Field(default_factory=str)
+    visit_summary: str = Field(default_factory=str)
+    what_we_found: str = Field(default_factory=str)
+    body_explanation: str = Field(default_factory=str)
+    treatment_plan: TreatmentPlan = Field(default_factory=TreatmentPlan)
+    important_instructions: List[str] = Field(default_factory=list)
+    warning_signs: List[WarningSign] = Field(default_factory=list)
+    next_steps: NextSteps = Field(default_factory=NextSteps)
+    closing_message: str = Field(default_factory=str)
+
+
+class BatchCase(BaseModel):
+    case_id: int
+    summary: PatientSummary
+
+
+class SummaryBatch(BaseModel):
+    cases: List[BatchCase] = Field(default_factory=list)
+
+
+SUMMARY_USER_NOTE = """CLINICAL SOAP NOTE:
+Subjective: {subjective}
+Objective: {objective}
+Assessment: {assessment}
+Plan: {plan}
+
+"""
+
+# Optional sections, in prompt order, with the bit each sets in the shape mask
+SUMMARY_USER_SECTIONS = (
+    (4, "DIAGNOSES: {diagnoses}"),
+    (2, "MEDICATIONS: {medications}"),
+    (1, "FOLLOW-UP: {follow_up}"),
+)
+
+# One template per (has_diagnoses, has_medications, has_follow_up) shape,
+# built once here so absent sections are left out instead of filled with placeholders
+SUMMARY_USER_TEMPLATES = {
+    mask: SUMMARY_USER_NOTE + "\n".join(
+        [line for bit, line in SUMMARY_USER_SECTIONS if mask & bit]
+        + ["PATIENT: {patient_name}", "DOCTOR: {doctor_name}"]
+    )
+    for mask in range(8)
+}
+
+SMS_SYSTEM = SUMMARY_PERSONA + """
+
+Create a very brief SMS summary (under 300 characters) for the clinical note in the user message.
+
+Format: "[Greeting] [What was found] [Key action] [When to follow up]"
+
+Example: "Hi John! Your visit showed a throat infection. Take your antibiotics 3x daily. Call if fever >101°F. See you in 1 week! -Dr. Smith"
+
+Keep it warm but concise. Return ONLY the SMS text."""
+
+SMS_USER = """ASSESSMENT: {assessment}
+PLAN: {plan}"""
+
+
+# Fixed parts of the fallback summary used when the LLM reply can't be parsed
+_BASIC_SUMMARY_TEMPLATE: Dict[str, Any] = {
+    "visit_summary": "Here is a summary of your recent visit.",
+    "body_explanation": "Your doctor has evaluated your condition.",
+    "important_instructions": ["Follow the treatment plan provided by your doctor"],
+    "warning_signs": [
+        {
+            "symptom": "If your symptoms get worse",
+            "action": "Contact your doctor or seek medical attention"
+        }
+    ],
+    "next_steps": {
+        "follow_up": "As directed by your doctor",
+        "tests_needed": [],
+        "contact_info": "Call the clinic if you have questions"
+    }
+}
+
+# ----------------------------------------------------------------------------
+# HTML rendering
+# The stylesheet is static: it is built once here and also served on its own
+# (GET /summary/summary.css) so API clients can cache it instead of receiving
+# it with every summary. The body template is compiled once at import.
+# ----------------------------------------------------------------------------
+
+SUMMARY_CSS = """
+.patient-summary {
+    font-family: 'Segoe UI', Arial, sans-serif;
+    max-width: 600px;
+    margin: 0 auto;
+    padding: 20px;
+    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
+    border-radius: 15px;
+    color: white;
+}
+.summary-header {
+    text-align: center;
+    margin-bottom: 20px;
+}
+.summary-section {
+    background: rgba(255,255,255,0.1);
+    border-radius: 10px;
+    padding: 15px;
+    margin: 10px 0;
+}
+.section-title {
+    font-weight: bold;
+    font-size: 1.1em;
+    margin-bottom: 10px;
+    display: flex;
+    align-items: center;
+    gap: 8px;
+}
+.medication-card {
+    background: rgba(255,255,255,0.15);
+    border-radius: 8px;
+    padding: 10px;
+    margin: 8px 0;
+}
+.warning-box {
+    background: rgba(255,100,100,0.2);
+    border-left: 4px solid #ff6b6b;
+    padding: 10px 15px;
+    border-radius: 5px;
+}
+.instruction-item {
+    padding: 5px 0;
+    display: flex;
+    align-items: center;
+    gap: 8px;
+}
+"""
+SUMMARY_CSS_BYTES = SUMMARY_CSS.encode()
+SUMMARY_STYLE_BLOCK = "\n<style>" + SUMMARY_CSS + "</style>\n"
+
+SUMMARY_HTML_TEMPLATE = jinja2.Environment(autoescape=True).from_string("""\
+<div class="patient-summary">
+<div class="summary-header">
+    <h2>📋 Your Visit Summary</h2>
+    <p>{{ date }}</p>
+</div>
+
+<div class="summary-section">
+    <p>{{ summary.get("greeting", "Dear Patient,") }}</p>
+    <p><strong>{{ summary.get("visit_summary", "") }}</strong></p>
+</div>
+
+<div class="summary-section">
+    <div class="section-title">🔍 What We Found</div>
+    <p>{{ summary.get("what_we_found", "") }}</p>
+    <p><em>{{ summary.get("body_explanation", "") }}</em></p>
+</div>
+
+<div class="summary-section">
+    <div class="section-title">💊 Your Treatment Plan</div>
+    {% for med in treatment.get("medications", []) %}
+<div class="medication-card">
+    <strong>💊 {{ med.get("name", "Medication") }}</strong>
+    <br>Take: {{ med.get("dosage", "") }} {{ med.get("frequency", "") }}
+    <br>Purpose: {{ med.get("purpose", "") }}
+</div>
+    {% endfor %}
+</div>
+
+<div class="summary-section">
+    <div class="section-title">📌 Important Instructions</div>
+    {% for inst in summary.get("important_instructions", []) %}<div class="instruction-item">✓ {{ inst }}</div>{% endfor %}
+</div>
+
+<div class="summary-section warning-box">
+    <div class="section-title">⚠️ Warning Signs - Seek Care If:</div>
+    {% for warning in summary.get("warning_signs", []) %}{% if warning is mapping %}<div>🚨 {{ warning.get("symptom", "") }} → <strong>{{ warning.get("action", "") }}</strong></div>{% else %}<div>🚨 {{ warning }}</div>{% endif %}{% endfor %}
+</div>
+
+<div class="summary-section">
+    <div class="section-title">📅 Next Steps</div>
+    <div>📆 Follow-up: {{ next_steps.get("follow_up", "As directed") }}</div>
+    <div>📞 {{ next_steps.get("contact_info", "Call if you have questions") }}</div>
+</div>
+
+<div class="summary-section" style="text-align: center;">
+    <p>{{ summary.get("closing_message", "Wishing you well!") }}</p>
+</div>
+</div>""")
+
 
 class PatientSummaryAgent:
     """
@@ -49,52 +451,150 @@ class PatientSummaryAgent:
         self.use_groq = GROQ_AVAILABLE and GROQ_API_KEY
         
         if self.use_groq:
-            self.groq_client = Groq(api_key=GROQ_API_KEY)
+            # Retries are handled by _create_completion
+            self.groq_client = AsyncGroq(api_key=GROQ_API_KEY, http_client=DefaultAioHttpClient(), max_retries=0)
         
-        # Gemini as fallback
-        self.gemini_model = None
-        if GEMINI_AVAILABLE:
-            try:
-                self.gemini_model = genai.GenerativeModel('gemini-2.0-flash')
-            except:
-                print("⚠️ Could not initialize Gemini for patient summary")
+        # Gemini as fallback, through the shared client
+        self.gemini_client = gemini_client
+        self.gemini_model = GEMINI_MODEL
     
-    def _generate_response(self, prompt: str) -> str:
-        """Generate response using Groq (primary) or Gemini (fallback)"""
-        # Try Groq first
-        if self.use_groq:
+    async def _generate_response(self, system: str, user: str, max_tokens: int = 2048,
+                                 schema: Optional[Type[BaseModel]] = None) -> str:
+        """
+        Generate response using Groq (primary) or Gemini (fallback).
+        With a schema both providers return bare JSON: Groq in JSON mode,
+        Gemini constrained to the schema itself.
+        """
+        return (await self._generate_with_source(system, user, max_tokens, schema))[0]
+    
+    async def _generate_with_source(self, system: str, user: str, max_tokens: int = 2048,
+                                    schema: Optional[Type[BaseModel]] = None) -> Tuple[str, bool]:
+        """
+        Like _generate_response, also reporting whether the text came from Groq
+        (True) or the fallback. Only Groq replies are cached, and with a schema
+        only those that validate against it.
+        """
+        async with summary_semaphore:
+            if self.use_groq:
+                cache_key = None
+                if response_cache is not None:
+                    cache_key = ResponseCache.make_key(
+                        self.groq_model, system, user, max_tokens, schema.__name__ if schema else None
+                    )
+                    hit = await response_cache.aget(cache_key)
+                    if hit is not None:
+                        return hit, True
+                
+                result = await self._generate_groq(system, user, max_tokens, schema)
+                if result:
+                    if cache_key is not None and _is_valid(result, schema):
+                        await response_cache.aput(cache_key, result)
+                    return result, True
+            return await self._generate_gemini(system, user, schema), False
+    
+    async def _generate_groq(self, system: str, user: str, max_tokens: int,
+                             schema: Optional[Type[BaseModel]] = None) -> str:
+        """Groq completion, or "" on failure"""
+        extra = {"response_format": {"type": "json_object"}} if schema else {}
+        try:
+            create = lambda: self._create_completion(
+                system,
+                model=self.groq_model,
+                messages=[
+                    {"role": "system", "content": system},
+                    {"role": "user", "content": user}
+                ],
+                temperature=0.7,
+                max_tokens=max_tokens,
+                **extra
+            )
+            # Batch calls are the longest and most expensive; duplicating them isn't worth it
+            response = await (create() if system == SUMMARY_BATCH_SYSTEM else _hedged(create, system))
+            return response.choices[0].message.content.strip()
+        except APIError as e:
+            print(f"Groq error in patient summary: {e}")
+            return ""
+    
+    async def _generate_gemini(self, system: str, user: str, schema: Optional[Type[BaseModel]] = None) -> str:
+        """Gemini completion, or "" on failure or when Gemini is not configured"""
+        if self.gemini_client:
             try:
-                response = self.groq_client.chat.completions.create(
-                    model=self.groq_model,
-                    messages=[
-                        {"role": "system", "content": "You are a healthcare communication specialist who converts medical information to patient-friendly language."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    temperature=0.7,
-                    max_tokens=2048
+                response = await self.gemini_client.aio.models.generate_content(
+                    model=self.gemini_model, contents=user, config=self._gemini_config(system, schema)
                 )
-                return response.choices[0].message.content.strip()
-            except Exception as e:
-                print(f"Groq error in patient summary: {e}")
-        
-        # Fallback to Gemini
-        if self.gemini_model:
-            try:
-                response = self.gemini_model.generate_content(prompt)
                 return response.text.strip()
             except Exception as e:
                 print(f"Gemini error in patient summary: {e}")
         
         return ""
     
-    def generate_patient_summary(
+    @retry(
+        stop=stop_after_attempt(3),
+        wait=wait_exponential(multiplier=0.2, exp_base=4),
+        retry=retry_if_exception_type(GROQ_RETRYABLE),
+        reraise=True
+    )
+    async def _create_completion(self, kind: str, **kwargs):
+        """
+        Groq chat completion, retried with backoff (0.2s, 0.8s) on connection
+        errors, 429s and 5xx. Latency is recorded under kind for hedging.
+        """
+        start = time.monotonic()
+        response = await self.groq_client.chat.completions.create(**kwargs)
+        _groq_latencies[kind].append(time.monotonic() - start)
+        return response
+    
+    def _gemini_config(self, system: str, schema: Optional[Type[BaseModel]] = None):
+        """Static system prompt as system_instruction; with a schema, JSON constrained to it"""
+        if schema:
+            return genai_types.GenerateContentConfig(
+                system_instruction=system, response_mime_type="application/json", response_schema=schema
+            )
+        return genai_types.GenerateContentConfig(system_instruction=system)
+    
+    async def _generate_response_stream(self, system: str, user: str) -> AsyncIterator[str]:
+        """Stream a response as text deltas, Groq first with Gemini as fallback"""
+        async with summary_semaphore:
+            if self.use_groq:
+                try:
+                    stream = await self.groq_client.chat.completions.create(
+                        model=self.groq_model,
+                        messages=[
+                            {"role": "system", "content": system},
+                            {"role": "user", "content": user}
+                        ],
+                        temperature=0.7,
+                        max_tokens=2048,
+                        stream=True
+                    )
+                    async for chunk in stream:
+                        delta = chunk.choices[0].delta.content if chunk.choices else None
+                        if delta:
+                            yield delta
+                    return
+                except Exception as e:
+                    print(f"Groq streaming error in patient summary: {e}")
+            
+            if self.gemini_client:
+                try:
+                    response = await self.gemini_client.aio.models.generate_content_stream(
+                        model=self.gemini_model, contents=user, config=self._gemini_config(system)
+                    )
+                    async for chunk in response:
+                        if chunk.text:
+                            yield chunk.text
+                except Exception as e:
+                    print(f"Gemini streaming error in patient summary: {e}")
+    
+    async def generate_patient_summary(
         self,
         soap_note: Dict[str, str],
         diagnoses: List[str] = None,
         medications: List[Dict] = None,
         follow_up_date: str = None,
         patient_name: str = "Patient",
-        doctor_name: str = "Your doctor"
+        doctor_name: str = "Your doctor",
+        patient_id: Optional[str] = None
     ) -> Dict[str, Any]:
         """
         Generate a comprehensive patient-friendly summary.
@@ -106,99 +606,110 @@ class PatientSummaryAgent:
             follow_up_date: When to return
             patient_name: For personalization
             doctor_name: Treating physician
+            patient_id: Enables reuse of this patient's summaries for near-identical notes
             
         Returns:
             Patient-friendly summary with all sections
         """
         
-        # Build context for LLM
-        diagnoses_text = ", ".join(diagnoses) if diagnoses else "See below"
-        meds_text = json.dumps(medications) if medications else "See plan"
-        
-        prompt = f"""You are a healthcare communication specialist. Convert this clinical SOAP note into a patient-friendly summary.
-
-CLINICAL SOAP NOTE:
-Subjective: {soap_note.get('Subjective', 'N/A')}
-Objective: {soap_note.get('Objective', 'N/A')}
-Assessment: {soap_note.get('Assessment', 'N/A')}
-Plan: {soap_note.get('Plan', 'N/A')}
-
-DIAGNOSES: {diagnoses_text}
-MEDICATIONS: {meds_text}
-FOLLOW-UP: {follow_up_date or 'To be scheduled'}
-PATIENT: {patient_name}
-DOCTOR: {doctor_name}
-
-Create a patient-friendly summary with these sections:
-
-1. WHAT WE FOUND (2-3 sentences explaining the diagnosis in simple terms)
-2. WHAT'S HAPPENING IN YOUR BODY (1-2 sentences explaining the condition simply)
-3. YOUR TREATMENT PLAN:
-   - Medications (name, when to take, what it does)
-   - Other instructions
-4. IMPORTANT INSTRUCTIONS (bullet points)
-5. WARNING SIGNS - SEEK CARE IF (specific symptoms to watch for)
-6. NEXT STEPS (follow-up, tests, etc.)
-
-RULES:
-- Use 6th grade reading level
-- Avoid medical jargon - explain terms in parentheses if needed
-- Be warm and reassuring but accurate
-- Use "you/your" language
-- Include specific actionable items
+        user = self._summary_user(soap_note, diagnoses, medications, follow_up_date, patient_name, doctor_name)
 
-Return as JSON:
-{{
-  "greeting": "Personal greeting with patient name",
-  "visit_summary": "Brief 1-line summary of the visit",
-  "what_we_found": "Plain language explanation of diagnosis",
-  "body_explanation": "Simple explanation of what's happening",
-  "treatment_plan": {{
-    "medications": [
-      {{
-        "name": "medication name",
-        "simple_name": "what type of medicine",
-        "dosage": "how much",
-        "frequency": "when to take",
-        "purpose": "what it does in simple terms",
-        "special_instructions": "any special notes"
-      }}
-    ],
-    "other_treatments": ["list of other treatments"],
-    "lifestyle_advice": ["helpful tips"]
-  }},
-  "important_instructions": ["actionable instruction 1", "instruction 2"],
-  "warning_signs": [
-    {{
-      "symptom": "what to watch for",
-      "action": "what to do"
-    }}
-  ],
-  "next_steps": {{
-    "follow_up": "when to come back",
-    "tests_needed": ["any tests to do"],
-    "contact_info": "when to call the office"
-  }},
-  "closing_message": "Reassuring closing"
-}}
-
-Return ONLY valid JSON."""
-
-        result = self._generate_response(prompt)
+        # Summaries are only reused within one patient; names appear verbatim in the text, so they scope it too.
+        # The actionable parts of the note must match exactly, not just semantically.
+        actionable = hashlib.blake2b(repr((
+            soap_note.get("Assessment"), soap_note.get("Plan"), diagnoses, medications, follow_up_date
+        )).encode(), digest_size=16).hexdigest()
+        namespace = f"patient_summary:{patient_id}|{patient_name}|{doctor_name}|{actionable}"
+        cache_text = " ".join(user.lower().split())
+        embedding = None
+        result = None
+        if summary_semantic_cache and patient_id:
+            embedding = await asyncio.to_thread(summary_semantic_cache.embed, cache_text)
+            if embedding is not None:
+                result = summary_semantic_cache.get(namespace, cache_text, embedding)
+        
+        if result is None:
+            result, from_groq = await self._generate_with_source(SUMMARY_SYSTEM, user, schema=PatientSummary)
+            if not from_groq:
+                # Fallback output is not cached
+                embedding = None
         
         try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-            
-            # Add metadata
-            parsed["generated_at"] = datetime.now().isoformat()
-            parsed["doctor_name"] = doctor_name
-            parsed["patient_name"] = patient_name
-            
-            return parsed
-            
-        except Exception as e:
+            summary = PatientSummary.model_validate_json(result)
+        except ValidationError as e:
             # Return basic summary if parsing fails
+            print(f"Patient summary validation error: {e}")
             return self._generate_basic_summary(soap_note, patient_name, doctor_name)
+        
+        if embedding is not None:
+            summary_semantic_cache.put(namespace, cache_text, embedding, summary.model_dump_json())
+        
+        return self._with_metadata(summary.model_dump(), patient_name, doctor_name)
+    
+    def _summary_user(
+        self,
+        soap_note: Dict[str, str],
+        diagnoses: List[str] = None,
+        medications: List[Dict] = None,
+        follow_up_date: str = None,
+        patient_name: str = "Patient",
+        doctor_name: str = "Your doctor"
+    ) -> str:
+        """Variable part of the summary prompt for one encounter"""
+        template = SUMMARY_USER_TEMPLATES[(bool(diagnoses) << 2) | (bool(medications) << 1) | bool(follow_up_date)]
+        
+        return template.format(
+            subjective=_condense(soap_note.get('Subjective', 'N/A')),
+            objective=_condense(soap_note.get('Objective', 'N/A')),
+            assessment=soap_note.get('Assessment', 'N/A'),
+            plan=soap_note.get('Plan', 'N/A'),
+            diagnoses=", ".join(diagnoses) if diagnoses else "",
+            medications=_fmt_medications(medications) if medications else "",
+            follow_up=follow_up_date,
+            patient_name=patient_name,
+            doctor_name=doctor_name
+        )
+    
+    def _with_metadata(self, parsed: Dict[str, Any], patient_name: str, doctor_name: str) -> Dict[str, Any]:
+        parsed["generated_at"] = now_iso()
+        parsed["doctor_name"] = doctor_name
+        parsed["patient_name"] = patient_name
+        return parsed
+    
+    async def generate_patient_summary_batch(self, requests: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """
+        Summaries for many encounters (e.g. end-of-day discharges), in request order.
+        Each request holds generate_patient_summary's keyword arguments. Up to
+        SUMMARY_BATCH_SIZE cases share one LLM call; chunks run concurrently.
+        """
+        chunks = [requests[i:i + SUMMARY_BATCH_SIZE] for i in range(0, len(requests), SUMMARY_BATCH_SIZE)]
+        results = await asyncio.gather(*(self._summarize_chunk(chunk) for chunk in chunks))
+        return [summary for chunk in results for summary in chunk]
+    
+    async def _summarize_chunk(self, chunk: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """One batched call; cases missing from the reply are summarized individually"""
+        user = "\n\n".join(
+            f"<case id={i}>\n{self._summary_user(**_prompt_fields(request))}\n</case>"
+            for i, request in enumerate(chunk)
+        )
+        result = await self._generate_response(
+            SUMMARY_BATCH_SYSTEM, user, max_tokens=1024 * len(chunk), schema=SummaryBatch
+        )
+        
+        by_id = {}
+        try:
+            by_id = {case.case_id: case.summary.model_dump() for case in SummaryBatch.model_validate_json(result).cases}
+        except ValidationError as e:
+            print(f"Batch summary validation error: {e}")
+        
+        async def one(i: int, request: Dict[str, Any]) -> Dict[str, Any]:
+            if i in by_id:
+                return self._with_metadata(
+                    by_id[i], request.get("patient_name", "Patient"), request.get("doctor_name", "Your doctor")
+                )
+            return await self.generate_patient_summary(**request)
+        
+        return list(await asyncio.gather(*(one(i, request) for i, request in enumerate(chunk))))
     
     def _generate_basic_summary(
         self,
@@ -208,287 +719,153 @@ Return ONLY valid JSON."""
     ) -> Dict[str, Any]:
         """Generate a basic summary when LLM parsing fails"""
         
+        # Static text is shared; containers are copied so callers can edit the result
         return {
+            **_BASIC_SUMMARY_TEMPLATE,
             "greeting": f"Dear {patient_name},",
-            "visit_summary": "Here is a summary of your recent visit.",
             "what_we_found": soap_note.get("Assessment", "Please refer to your detailed notes."),
-            "body_explanation": "Your doctor has evaluated your condition.",
             "treatment_plan": {
                 "medications": [],
                 "other_treatments": [soap_note.get("Plan", "Follow your doctor's instructions")],
                 "lifestyle_advice": []
             },
-            "important_instructions": ["Follow the treatment plan provided by your doctor"],
-            "warning_signs": [
-                {
-                    "symptom": "If your symptoms get worse",
-                    "action": "Contact your doctor or seek medical attention"
-                }
-            ],
-            "next_steps": {
-                "follow_up": "As directed by your doctor",
-                "tests_needed": [],
-                "contact_info": "Call the clinic if you have questions"
-            },
+            "important_instructions": list(_BASIC_SUMMARY_TEMPLATE["important_instructions"]),
+            "warning_signs": [dict(w) for w in _BASIC_SUMMARY_TEMPLATE["warning_signs"]],
+            "next_steps": {**_BASIC_SUMMARY_TEMPLATE["next_steps"], "tests_needed": []},
             "closing_message": f"Take care, and don't hesitate to reach out if you have questions. - {doctor_name}",
-            "generated_at": datetime.now().isoformat()
+            "generated_at": now_iso()
         }
     
     def format_for_display(self, summary: Dict[str, Any]) -> str:
         """Format summary for text display (e.g., SMS, email, print)"""
         
-        lines = []
-        
-        # Header
-        lines.append(f"📋 YOUR VISIT SUMMARY")
-        lines.append(f"Date: {datetime.now().strftime('%B %d, %Y')}")
-        lines.append("")
-        
-        # Greeting
-        lines.append(summary.get("greeting", "Dear Patient,"))
-        lines.append("")
-        
-        # Visit summary
-        lines.append(summary.get("visit_summary", ""))
-        lines.append("")
-        
-        # What we found
-        lines.append("🔍 WHAT WE FOUND:")
-        lines.append(summary.get("what_we_found", ""))
-        lines.append("")
-        
-        # Body explanation
-        if summary.get("body_explanation"):
-            lines.append(summary["body_explanation"])
-            lines.append("")
-        
-        # Treatment plan
-        lines.append("💊 YOUR TREATMENT PLAN:")
-        
         treatment = summary.get("treatment_plan", {})
-        
-        # Medications
-        for med in treatment.get("medications", []):
-            lines.append(f"  • {med.get('name', 'Medication')}")
-            lines.append(f"    - Take: {med.get('dosage', '')} {med.get('frequency', '')}")
-            lines.append(f"    - Purpose: {med.get('purpose', '')}")
-            if med.get("special_instructions"):
-                lines.append(f"    - Note: {med['special_instructions']}")
-        
-        # Other treatments
-        for treatment_item in treatment.get("other_treatments", []):
-            lines.append(f"  • {treatment_item}")
-        
-        lines.append("")
-        
-        # Important instructions
-        lines.append("📌 IMPORTANT INSTRUCTIONS:")
-        for instruction in summary.get("important_instructions", []):
-            lines.append(f"  ✓ {instruction}")
-        lines.append("")
-        
-        # Warning signs
-        lines.append("⚠️ WARNING SIGNS - SEEK CARE IF:")
-        for warning in summary.get("warning_signs", []):
-            if isinstance(warning, dict):
-                lines.append(f"  🚨 {warning.get('symptom', '')} → {warning.get('action', '')}")
-            else:
-                lines.append(f"  🚨 {warning}")
-        lines.append("")
-        
-        # Next steps
-        lines.append("📅 NEXT STEPS:")
         next_steps = summary.get("next_steps", {})
-        if next_steps.get("follow_up"):
-            lines.append(f"  • Follow-up: {next_steps['follow_up']}")
-        for test in next_steps.get("tests_needed", []):
-            lines.append(f"  • Test needed: {test}")
-        if next_steps.get("contact_info"):
-            lines.append(f"  • Questions? {next_steps['contact_info']}")
-        lines.append("")
-        
-        # Closing
-        lines.append(summary.get("closing_message", "Wishing you a speedy recovery!"))
         
-        return "\n".join(lines)
+        body = f"{summary['body_explanation']}\n\n" if summary.get("body_explanation") else ""
+        
+        # Each block is one line per item, joined once
+        treatment_lines = "".join(
+            f"  • {med.get('name', 'Medication')}\n"
+            f"    - Take: {med.get('dosage', '')} {med.get('frequency', '')}\n"
+            f"    - Purpose: {med.get('purpose', '')}\n"
+            + (f"    - Note: {med['special_instructions']}\n" if med.get("special_instructions") else "")
+            for med in treatment.get("medications", [])
+        ) + "".join(f"  • {item}\n" for item in treatment.get("other_treatments", []))
+        
+        instruction_lines = "".join(f"  ✓ {instruction}\n" for instruction in summary.get("important_instructions", []))
+        
+        warning_lines = "".join(
+            f"  🚨 {warning.get('symptom', '')} → {warning.get('action', '')}\n" if isinstance(warning, dict)
+            else f"  🚨 {warning}\n"
+            for warning in summary.get("warning_signs", [])
+        )
+        
+        next_step_lines = (
+            (f"  • Follow-up: {next_steps['follow_up']}\n" if next_steps.get("follow_up") else "")
+            + "".join(f"  • Test needed: {test}\n" for test in next_steps.get("tests_needed", []))
+            + (f"  • Questions? {next_steps['contact_info']}\n" if next_steps.get("contact_info") else "")
+        )
+        
+        text = (
+            f"📋 YOUR VISIT SUMMARY\n"
+            f"Date: {today_long()}\n\n"
+            f"{summary.get('greeting', 'Dear Patient,')}\n\n"
+            f"{summary.get('visit_summary', '')}\n\n"
+            f"🔍 WHAT WE FOUND:\n"
+            f"{summary.get('what_we_found', '')}\n\n"
+            f"{body}"
+            f"💊 YOUR TREATMENT PLAN:\n{treatment_lines}\n"
+            f"📌 IMPORTANT INSTRUCTIONS:\n{instruction_lines}\n"
+            f"⚠️ WARNING SIGNS - SEEK CARE IF:\n{warning_lines}\n"
+            f"📅 NEXT STEPS:\n{next_step_lines}\n"
+            f"{summary.get('closing_message', 'Wishing you a speedy recovery!')}"
+        )
+        
+        # Model text may mix composed and decomposed characters; ship one form
+        return unicodedata.normalize("NFC", text)
     
-    def format_for_html(self, summary: Dict[str, Any]) -> str:
-        """Format summary as HTML for web display"""
-        
-        html_parts = []
-        
-        # CSS styling
-        html_parts.append("""
-<style>
-.patient-summary {
-    font-family: 'Segoe UI', Arial, sans-serif;
-    max-width: 600px;
-    margin: 0 auto;
-    padding: 20px;
-    background: linear-gradient(135deg, #667eea 0%, #764ba2 100%);
-    border-radius: 15px;
-    color: white;
-}
-.summary-header {
-    text-align: center;
-    margin-bottom: 20px;
-}
-.summary-section {
-    background: rgba(255,255,255,0.1);
-    border-radius: 10px;
-    padding: 15px;
-    margin: 10px 0;
-}
-.section-title {
-    font-weight: bold;
-    font-size: 1.1em;
-    margin-bottom: 10px;
-    display: flex;
-    align-items: center;
-    gap: 8px;
-}
-.medication-card {
-    background: rgba(255,255,255,0.15);
-    border-radius: 8px;
-    padding: 10px;
-    margin: 8px 0;
-}
-.warning-box {
-    background: rgba(255,100,100,0.2);
-    border-left: 4px solid #ff6b6b;
-    padding: 10px 15px;
-    border-radius: 5px;
-}
-.instruction-item {
-    padding: 5px 0;
-    display: flex;
-    align-items: center;
-    gap: 8px;
-}
-</style>
-""")
-        
-        # Main container
-        html_parts.append('<div class="patient-summary">')
-        
-        # Header
-        html_parts.append(f'''
-<div class="summary-header">
-    <h2>📋 Your Visit Summary</h2>
-    <p>{datetime.now().strftime('%B %d, %Y')}</p>
-</div>
-''')
-        
-        # Greeting
-        html_parts.append(f'''
-<div class="summary-section">
-    <p>{summary.get("greeting", "Dear Patient,")}</p>
-    <p><strong>{summary.get("visit_summary", "")}</strong></p>
-</div>
-''')
-        
-        # What we found
-        html_parts.append(f'''
-<div class="summary-section">
-    <div class="section-title">🔍 What We Found</div>
-    <p>{summary.get("what_we_found", "")}</p>
-    <p><em>{summary.get("body_explanation", "")}</em></p>
-</div>
-''')
-        
-        # Treatment plan
-        treatment = summary.get("treatment_plan", {})
-        meds_html = ""
-        for med in treatment.get("medications", []):
-            meds_html += f'''
-<div class="medication-card">
-    <strong>💊 {med.get('name', 'Medication')}</strong>
-    <br>Take: {med.get('dosage', '')} {med.get('frequency', '')}
-    <br>Purpose: {med.get('purpose', '')}
-</div>
-'''
-        
-        html_parts.append(f'''
-<div class="summary-section">
-    <div class="section-title">💊 Your Treatment Plan</div>
-    {meds_html}
-</div>
-''')
-        
-        # Instructions
-        instructions_html = "".join([
-            f'<div class="instruction-item">✓ {inst}</div>'
-            for inst in summary.get("important_instructions", [])
-        ])
-        
-        html_parts.append(f'''
-<div class="summary-section">
-    <div class="section-title">📌 Important Instructions</div>
-    {instructions_html}
-</div>
-''')
-        
-        # Warning signs
-        warnings_html = ""
-        for warning in summary.get("warning_signs", []):
-            if isinstance(warning, dict):
-                warnings_html += f'<div>🚨 {warning.get("symptom", "")} → <strong>{warning.get("action", "")}</strong></div>'
-            else:
-                warnings_html += f'<div>🚨 {warning}</div>'
-        
-        html_parts.append(f'''
-<div class="summary-section warning-box">
-    <div class="section-title">⚠️ Warning Signs - Seek Care If:</div>
-    {warnings_html}
-</div>
-''')
-        
-        # Next steps
-        next_steps = summary.get("next_steps", {})
-        html_parts.append(f'''
-<div class="summary-section">
-    <div class="section-title">📅 Next Steps</div>
-    <div>📆 Follow-up: {next_steps.get("follow_up", "As directed")}</div>
-    <div>📞 {next_steps.get("contact_info", "Call if you have questions")}</div>
-</div>
-''')
-        
-        # Closing
-        html_parts.append(f'''
-<div class="summary-section" style="text-align: center;">
-    <p>{summary.get("closing_message", "Wishing you well!")}</p>
-</div>
-''')
-        
-        html_parts.append('</div>')
-        
-        return "".join(html_parts)
+    def format_for_html(self, summary: Dict[str, Any], include_css: bool = True) -> str:
+        """
+        Format summary as HTML for web display.
+        Pass include_css=False when the client loads SUMMARY_CSS separately.
+        """
+        html = SUMMARY_HTML_TEMPLATE.render(
+            summary=summary,
+            treatment=summary.get("treatment_plan", {}),
+            next_steps=summary.get("next_steps", {}),
+            date=today_long()
+        )
+        html = unicodedata.normalize("NFC", html)
+        return SUMMARY_STYLE_BLOCK + html if include_css else html
     
-    def generate_sms_summary(
+    async def generate_sms_summary(
         self,
         soap_note: Dict[str, str],
         patient_name: str = "Patient"
     ) -> str:
         """Generate a brief SMS-friendly summary (under 160 chars ideal)"""
         
-        prompt = f"""Create a very brief SMS summary (under 300 characters) for this clinical note.
+        user = SMS_USER.format(
+            assessment=soap_note.get('Assessment', ''),
+            plan=soap_note.get('Plan', '')
+        )
 
-ASSESSMENT: {soap_note.get('Assessment', '')}
-PLAN: {soap_note.get('Plan', '')}
-
-Format: "[Greeting] [What was found] [Key action] [When to follow up]"
-
-Example: "Hi John! Your visit showed a throat infection. Take your antibiotics 3x daily. Call if fever >101°F. See you in 1 week! -Dr. Smith"
-
-Keep it warm but concise. Return ONLY the SMS text."""
-
-        result = self._generate_response(prompt)
+        result = await self._generate_response(SMS_SYSTEM, user)
         
         # Ensure it's not too long
-        if len(result) > 300:
-            result = result[:297] + "..."
-        
-        return result
+        return _truncate_sms(result)
+    
+    async def generate_sms_summary_stream(
+        self,
+        soap_note: Dict[str, str],
+        patient_name: str = "Patient"
+    ) -> AsyncIterator[str]:
+        """Streaming variant of generate_sms_summary, with the same token budget"""
+        
+        user = SMS_USER.format(
+            assessment=soap_note.get('Assessment', ''),
+            plan=soap_note.get('Plan', '')
+        )
+        
+        # Text is released only while two tokens of headroom remain,
+        # so a later cut to the budget never has to retract sent text
+        sent = ""
+        buf = ""
+        async with aclosing(self._generate_response_stream(SMS_SYSTEM, user)) as stream:
+            async for delta in stream:
+                buf += delta
+                n = count_tokens(buf)
+                if n > SMS_TOKEN_BUDGET:
+                    final = _truncate_sms(buf)
+                    yield final[len(sent):] if final.startswith(sent) else "..."
+                    return
+                if n <= SMS_TOKEN_BUDGET - 2 and len(buf) > len(sent):
+                    yield buf[len(sent):]
+                    sent = buf
+        tail = buf.rstrip()[len(sent):]
+        if tail:
+            yield tail
+    
+    async def generate_all(
+        self,
+        soap_note: Dict[str, str],
+        diagnoses: List[str] = None,
+        medications: List[Dict] = None,
+        follow_up_date: str = None,
+        patient_name: str = "Patient",
+        doctor_name: str = "Your doctor",
+        patient_id: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """Generate the full summary and the SMS summary concurrently"""
+        
+        summary, sms = await asyncio.gather(
+            self.generate_patient_summary(
+                soap_note, diagnoses, medications, follow_up_date, patient_name, doctor_name, patient_id
+            ),
+            self.generate_sms_summary(soap_note, patient_name)
+        )
+        return {"summary": summary, "sms": sms}
 
 
 # Create global instance
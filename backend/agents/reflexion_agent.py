@@ -4,21 +4,200 @@ Implements continuous learning from doctor edits to improve SOAP generation.
 Uses the Reflexion pattern to analyze feedback and optimize prompts.
 """
 
-import json
-from typing import Dict, Any, List, Optional, Tuple
+import asyncio
+import hashlib
+from typing import Dict, Any, List, Optional, Tuple, Iterator, BinaryIO
 from dataclasses import dataclass, field
 from datetime import datetime
-from collections import defaultdict
-import difflib
+from collections import Counter, defaultdict
+from itertools import chain
 
-import google.generativeai as genai
-import os
+import numpy as np
+import orjson
+from cachetools import LRUCache
+from rapidfuzz.distance import Indel
 
-# Configure Gemini
-genai.configure(api_key=os.getenv("GOOGLE_API_KEY"))
+from gemini_client import GEMINI_MODEL, gemini_client
+from utils import parse_llm_json
 
+# Categorized (original, edited) pairs remembered, so re-submitted edits skip the LLM
+CATEGORY_CACHE_SIZE = 1024
 
-@dataclass
+# Uncached edits categorized per LLM call; chunks run concurrently
+CATEGORY_BATCH_SIZE = 20
+
+# Caps concurrent categorization calls so large recategorizations stay under Gemini rate limits
+CATEGORY_CONCURRENCY = 4
+category_semaphore = asyncio.Semaphore(CATEGORY_CONCURRENCY)
+
+CATEGORY_DEFINITIONS = """Categories:
+- correction: Fixing factual errors or misinterpretations
+- addition: Adding missing information
+- removal: Removing incorrect or irrelevant information
+- clarification: Rewording for clarity without changing meaning
+- style: Formatting or stylistic preferences
+- clinical_judgment: Changes based on clinical expertise"""
+
+# Prompt templates; only the edit/sample blocks are filled in per call
+CATEGORIZE_PROMPT = """Categorize each doctor's edit to an AI-generated SOAP note.
+
+{edits_text}
+
+""" + CATEGORY_DEFINITIONS + """
+
+Return as JSON, one entry per edit:
+{{"edits": [{{"edit_id": 0, "category": "category_name", "reason": "brief explanation"}}]}}
+
+Return ONLY valid JSON."""
+
+INSIGHT_SAMPLE = "Edit {}:\nSpecialty: {}\nSections Changed: {}\nCategory: {}\nOriginal: {}\nEdited: {}"
+
+INSIGHTS_PROMPT = """Analyze these doctor edits to AI-generated SOAP notes and identify patterns.
+
+EDIT SAMPLES:
+{samples_text}
+
+Identify:
+1. Common patterns in what doctors are changing
+2. Recurring issues in AI-generated content
+3. Specialty-specific patterns (if applicable)
+4. Suggestions for improving the AI prompts
+
+Return as JSON:
+{{
+  "insights": [
+    {{
+      "category": "content|structure|terminology|completeness|accuracy",
+      "insight": "Description of the pattern observed",
+      "frequency": "how often this occurs (1-10)",
+      "specialty_specific": "specialty name or null",
+      "suggested_prompt_update": "How to modify the SOAP generation prompt to address this",
+      "confidence": 0.0-1.0
+    }}
+  ],
+  "overall_recommendation": "Top priority improvement to make"
+}}
+
+Return ONLY valid JSON."""
+
+# SOAP sections in a fixed order so texts line up section by section
+SOAP_SECTIONS = ("Subjective", "Objective", "Assessment", "Plan")
+
+# Edit severity by [length-change bucket][sections bucket]:
+# length change <10% / <30% / more, and <=1 / 2 / 3+ sections edited
+_SEVERITY = (
+    ("minor", "moderate", "major"),
+    ("moderate", "moderate", "major"),
+    ("major", "major", "major"),
+)
+
+# Most recent edit distances kept per specialty for the improvement trend
+TREND_SIZE = 100
+
+
+def _sift3(a: str, b: str, max_offset: int = 5) -> float:
+    """
+    Sift3 approximate edit distance: one linear scan that re-aligns within
+    max_offset characters after a mismatch. Much cheaper than Levenshtein
+    and close enough to rank edits by size.
+    """
+    if not a:
+        return float(len(b))
+    if not b:
+        return float(len(a))
+    
+    c = offset1 = offset2 = matches = 0
+    while c + offset1 < len(a) and c + offset2 < len(b):
+        if a[c + offset1] == b[c + offset2]:
+            matches += 1
+        else:
+            offset1 = offset2 = 0
+            for i in range(max_offset):
+                if c + i < len(a) and a[c + i] == b[c]:
+                    offset1 = i
+                    break
+                if c + i < len(b) and a[c] == b[c + i]:
+                    offset2 = i
+                    break
+        c += 1
+    return (len(a) + len(b)) / 2 - matches
+
+
+class ImprovementTrend:
+    """
+    Improvement trend of one specialty as parallel columns (unix timestamps and
+    edit distances), so metrics are array means instead of walks over dicts.
+    Fixed-size ring buffer: appends overwrite the oldest point in place.
+    """
+    
+    def __init__(self, size: int = TREND_SIZE):
+        self._timestamps = np.zeros(size, dtype=np.int64)
+        # Distances are stored rounded to 3 decimals, well within float16 precision
+        self._distances = np.zeros(size, dtype=np.float16)
+        self._next = 0  # slot the next point is written to
+        self._count = 0
+    
+    def __len__(self) -> int:
+        return self._count
+    
+    def append(self, timestamp: int, edit_distance: float):
+        """Add a point; timestamp is unix epoch seconds"""
+        self._timestamps[self._next] = timestamp
+        self._distances[self._next] = edit_distance
+        self._next = (self._next + 1) % len(self._distances)
+        self._count = min(self._count + 1, len(self._distances))
+    
+    def _ordered(self, column: np.ndarray) -> np.ndarray:
+        """Column oldest point first"""
+        if self._count < len(column):
+            return column[:self._count]
+        return np.concatenate((column[self._next:], column[:self._next]))
+    
+    @property
+    def timestamps(self) -> np.ndarray:
+        return self._ordered(self._timestamps)
+    
+    @property
+    def distances(self) -> np.ndarray:
+        return self._ordered(self._distances)
+    
+    def points(self, last: int = TREND_SIZE) -> List[Tuple[int, float]]:
+        """Last points as (epoch seconds, edit distance), oldest first"""
+        return list(zip(self.timestamps[-last:].tolist(), self.distances[-last:].tolist()))
+    
+    def to_list(self, last: int = TREND_SIZE) -> List[Dict[str, Any]]:
+        """
+        Trend points as {timestamp, edit_distance} dicts for the API and exports;
+        the only place epochs are turned into ISO strings.
+        """
+        return [
+            {"timestamp": datetime.fromtimestamp(ts).isoformat(), "edit_distance": round(ed, 3)}
+            for ts, ed in self.points(last)
+        ]
+    
+    @classmethod
+    def from_list(cls, points: List[Dict[str, Any]]) -> "ImprovementTrend":
+        """Inverse of to_list; timestamps may be ISO strings or epoch seconds"""
+        trend = cls()
+        for p in points[-TREND_SIZE:]:
+            ts = p["timestamp"]
+            if isinstance(ts, str):
+                ts = int(datetime.fromisoformat(ts).timestamp())
+            trend.append(int(ts), p["edit_distance"])
+        return trend
+
+
+def _new_pattern_stats() -> Dict[str, Any]:
+    return {
+        "section_edits": Counter(),
+        "category_counts": Counter(),
+        "severity_counts": Counter(),
+        "sum_edit_distance": 0.0,
+        "total": 0
+    }
+
+
+@dataclass(slots=True)
 class EditLog:
     """Represents a single edit log entry"""
     encounter_id: str
@@ -28,12 +207,22 @@ class EditLog:
     edited_soap: Dict[str, str]
     sections_edited: List[str]
     edit_distance: float
-    edit_category: str
+    edit_category: Optional[str]  # None when categorization failed; left out of category counts
     edit_severity: str
     timestamp: datetime = field(default_factory=datetime.now)
+    _serialized: Optional[Tuple[str, str]] = field(default=None, init=False, repr=False, compare=False)
+    
+    def serialized_soap(self) -> Tuple[str, str]:
+        """(original, edited) SOAP as JSON, encoded once and reused by later prompts"""
+        if self._serialized is None:
+            self._serialized = (
+                orjson.dumps(self.original_soap).decode(),
+                orjson.dumps(self.edited_soap).decode()
+            )
+        return self._serialized
 
 
-@dataclass
+@dataclass(slots=True)
 class LearningInsight:
     """Insight derived from edit analysis"""
     category: str
@@ -56,8 +245,10 @@ class ReflexionAgent:
     5. Performance Metrics - Track improvement over time
     """
     
-    def __init__(self, model: str = "gemini-2.0-flash"):
-        self.model = genai.GenerativeModel(model)
+    def __init__(self, model: str = GEMINI_MODEL):
+        # Process-wide google-genai client: agents share its config and connection pool
+        self.client = gemini_client
+        self.model = model
         self.edit_logs: List[EditLog] = []
         self.insights: List[LearningInsight] = []
         self.prompt_improvements: Dict[str, List[str]] = defaultdict(list)
@@ -67,19 +258,39 @@ class ReflexionAgent:
             "total_edits": 0,
             "avg_edit_distance": 0.0,
             "common_issues": [],
-            "improvement_trend": []
+            "improvement_trend": ImprovementTrend()
         })
+        
+        # Running analyze_patterns aggregates over edit_logs: specialty -> stats,
+        # None -> all specialties. Updated as logs are added, never persisted.
+        self._pattern_stats: Dict[Optional[str], Dict[str, Any]] = defaultdict(_new_pattern_stats)
+        
+        # blake2b of the (original, edited) pair -> LLM edit category
+        self._category_cache: LRUCache = LRUCache(maxsize=CATEGORY_CACHE_SIZE)
     
     def _generate_response(self, prompt: str) -> str:
         """Generate response using Gemini"""
+        if self.client is None:
+            return "{}"
+        try:
+            response = self.client.models.generate_content(model=self.model, contents=prompt)
+            return response.text.strip()
+        except Exception as e:
+            print(f"Error generating response: {e}")
+            return "{}"
+    
+    async def _generate_response_async(self, prompt: str) -> str:
+        """Async variant of _generate_response, so batched calls can run concurrently"""
+        if self.client is None:
+            return "{}"
         try:
-            response = self.model.generate_content(prompt)
+            response = await self.client.aio.models.generate_content(model=self.model, contents=prompt)
             return response.text.strip()
         except Exception as e:
             print(f"Error generating response: {e}")
             return "{}"
     
-    def log_edit(
+    async def log_edit(
         self,
         encounter_id: str,
         doctor_id: str,
@@ -91,117 +302,183 @@ class ReflexionAgent:
         Log a doctor's edit to an AI-generated SOAP note.
         Analyzes the diff and categorizes the edit.
         """
+        logs = await self.log_edits_batch([{
+            "encounter_id": encounter_id,
+            "doctor_id": doctor_id,
+            "specialty": specialty,
+            "original_soap": original_soap,
+            "edited_soap": edited_soap
+        }])
+        return logs[0]
+    
+    async def log_edits_batch(self, edits: List[Dict[str, Any]]) -> List[EditLog]:
+        """
+        Log many edits at once (e.g. a backfill), in order. Each edit holds
+        log_edit's keyword arguments. Diffs and severities are computed
+        locally; categories come from as few LLM calls as possible.
+        """
+        diffs = [self._diff_sections(edit["original_soap"], edit["edited_soap"]) for edit in edits]
+        
+        # Notes saved without changes are logged as "none" edits without an LLM call
+        changed = [i for i, edit in enumerate(edits) if edit["original_soap"] != edit["edited_soap"]]
+        categories = ["none"] * len(edits)
+        found = await self._categorize_edits([
+            (edits[i]["original_soap"], edits[i]["edited_soap"], diffs[i][0])
+            for i in changed
+        ])
+        for i, category in zip(changed, found):
+            categories[i] = category
+        
+        logs = []
+        for edit, (sections_edited, weighted_similarities, orig_len, edit_len), category in zip(edits, diffs, categories):
+            log = EditLog(
+                encounter_id=edit["encounter_id"],
+                doctor_id=edit["doctor_id"],
+                specialty=edit["specialty"],
+                original_soap=edit["original_soap"],
+                edited_soap=edit["edited_soap"],
+                sections_edited=sections_edited,
+                edit_distance=self._calculate_edit_distance(weighted_similarities),
+                edit_category=category,
+                edit_severity=self._edit_severity(orig_len, edit_len, sections_edited)
+            )
+            
+            self.edit_logs.append(log)
+            self._record_patterns([log])
+            
+            # Update specialty metrics
+            self._update_specialty_metrics(edit["specialty"], log)
+            logs.append(log)
         
-        # Calculate sections that were edited
+        return logs
+    
+    def _diff_sections(
+        self,
+        original_soap: Dict[str, str],
+        edited_soap: Dict[str, str]
+    ) -> Tuple[List[str], List[Tuple[int, float]], int, int]:
+        """
+        One pass over the sections: edited section names, (weight, similarity)
+        per section (only edited ones go through the matcher), and total
+        original and edited lengths.
+        """
         sections_edited = []
-        for section in ["Subjective", "Objective", "Assessment", "Plan"]:
+        weighted_similarities = []
+        orig_len = edit_len = 0
+        for section in SOAP_SECTIONS:
             orig = original_soap.get(section, "")
             edited = edited_soap.get(section, "")
+            orig_len += len(orig)
+            edit_len += len(edited)
             if orig != edited:
                 sections_edited.append(section)
-        
-        # Calculate edit distance
-        edit_distance = self._calculate_edit_distance(original_soap, edited_soap)
-        
-        # Categorize the edit
-        edit_category, edit_severity = self._categorize_edit(
-            original_soap, edited_soap, sections_edited
-        )
-        
-        # Create log entry
-        log = EditLog(
-            encounter_id=encounter_id,
-            doctor_id=doctor_id,
-            specialty=specialty,
-            original_soap=original_soap,
-            edited_soap=edited_soap,
-            sections_edited=sections_edited,
-            edit_distance=edit_distance,
-            edit_category=edit_category,
-            edit_severity=edit_severity
-        )
-        
-        self.edit_logs.append(log)
-        
-        # Update specialty metrics
-        self._update_specialty_metrics(specialty, log)
-        
-        return log
+                weighted_similarities.append((max(len(orig), len(edited)), Indel.normalized_similarity(orig, edited)))
+            else:
+                weighted_similarities.append((len(orig), 1.0))
+        return sections_edited, weighted_similarities, orig_len, edit_len
     
-    def _calculate_edit_distance(
-        self,
-        original: Dict[str, str],
-        edited: Dict[str, str]
-    ) -> float:
-        """Calculate normalized edit distance between SOAPs"""
-        
-        original_text = " ".join(original.values())
-        edited_text = " ".join(edited.values())
-        
-        # Use SequenceMatcher for similarity
-        similarity = difflib.SequenceMatcher(
-            None, original_text, edited_text
-        ).ratio()
+    def fast_edit_distance(self, original_soap: Dict[str, str], edited_soap: Dict[str, str]) -> Dict[str, Any]:
+        """
+        Approximate edit distance and severity for live feedback while a doctor
+        types (Sift3 per edited section). Nothing is logged and no LLM is called;
+        logged edits still use the exact distance.
+        """
+        distance = 0.0
+        total = 0
+        sections_edited = []
+        orig_len = edit_len = 0
+        for section in SOAP_SECTIONS:
+            orig = original_soap.get(section, "")
+            edited = edited_soap.get(section, "")
+            orig_len += len(orig)
+            edit_len += len(edited)
+            total += max(len(orig), len(edited))
+            if orig != edited:
+                sections_edited.append(section)
+                distance += _sift3(orig, edited)
         
-        # Return as distance (1 - similarity)
+        return {
+            "edit_distance_estimate": round(min(distance / total, 1.0), 3) if total else 0.0,
+            "sections_edited": sections_edited,
+            "severity": self._edit_severity(orig_len, edit_len, sections_edited)
+        }
+    
+    def _calculate_edit_distance(self, weighted_similarities: List[Tuple[int, float]]) -> float:
+        """
+        Normalized edit distance between SOAPs: 1 minus the length-weighted
+        mean of per-section Indel similarities (SequenceMatcher.ratio() semantics).
+        Each section is weighted by its longer version, so a section added
+        from nothing still counts.
+        """
+        total = sum(length for length, _ in weighted_similarities)
+        if total == 0:
+            return 0.0
+        similarity = sum(length * sim for length, sim in weighted_similarities) / total
         return round(1 - similarity, 3)
     
-    def _categorize_edit(
-        self,
-        original: Dict[str, str],
-        edited: Dict[str, str],
-        sections_edited: List[str]
-    ) -> Tuple[str, str]:
-        """Categorize the type and severity of edit"""
+    def _edit_severity(self, orig_len: int, edit_len: int, sections_edited: List[str]) -> str:
+        """Severity of an edit from its change in length and number of sections"""
         
         # Calculate total change magnitude
-        orig_len = sum(len(v) for v in original.values())
-        edit_len = sum(len(v) for v in edited.values())
-        
         len_diff = abs(edit_len - orig_len)
         len_change_ratio = len_diff / max(orig_len, 1)
         
-        # Determine severity
-        if len_change_ratio < 0.1 and len(sections_edited) <= 1:
-            severity = "minor"
-        elif len_change_ratio < 0.3 and len(sections_edited) <= 2:
-            severity = "moderate"
-        else:
-            severity = "major"
+        n_sections = len(sections_edited)
+        return _SEVERITY[(len_change_ratio >= 0.1) + (len_change_ratio >= 0.3)][(n_sections >= 2) + (n_sections >= 3)]
+    
+    async def _categorize_edits(self, items: List[Tuple[Dict[str, str], Dict[str, str], List[str]]]) -> List[Optional[str]]:
+        """
+        Edit category for each (original, edited, sections_edited), in order,
+        or None where categorization failed. Cached pairs are answered locally;
+        the rest are sent in chunks of CATEGORY_BATCH_SIZE per LLM call, at most
+        CATEGORY_CONCURRENCY at a time.
+        """
+        # Same before/after pair (demo, re-submission) -> same category, no LLM call
+        keys = [
+            hashlib.blake2b(orjson.dumps([original, edited], option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+            for original, edited, _ in items
+        ]
+        categories = [self._category_cache.get(key) for key in keys]
+        
+        missing = [i for i, category in enumerate(categories) if category is None]
+        chunks = [missing[i:i + CATEGORY_BATCH_SIZE] for i in range(0, len(missing), CATEGORY_BATCH_SIZE)]
+        results = await asyncio.gather(*(self._categorize_chunk([items[i] for i in chunk]) for chunk in chunks))
+        
+        for chunk, found in zip(chunks, results):
+            for i, category in zip(chunk, found):
+                if category:
+                    self._category_cache[keys[i]] = category
+                categories[i] = category
+        return categories
+    
+    async def _categorize_chunk(self, items: List[Tuple[Dict[str, str], Dict[str, str], List[str]]]) -> List[Optional[str]]:
+        """One LLM call for several edits; None where the reply has no category"""
+        
+        edits_text = "\n\n".join(
+            f"<edit id={i}>\n"
+            f"ORIGINAL:\n{orjson.dumps(original, option=orjson.OPT_INDENT_2).decode()}\n\n"
+            f"EDITED:\n{orjson.dumps(edited, option=orjson.OPT_INDENT_2).decode()}\n\n"
+            f"SECTIONS CHANGED: {sections_edited}\n"
+            f"</edit>"
+            for i, (original, edited, sections_edited) in enumerate(items)
+        )
         
         # Use LLM to categorize type
-        prompt = f"""Categorize this doctor's edit to an AI-generated SOAP note.
-
-ORIGINAL:
-{json.dumps(original, indent=2)}
-
-EDITED:
-{json.dumps(edited, indent=2)}
-
-SECTIONS CHANGED: {sections_edited}
-
-Categories:
-- correction: Fixing factual errors or misinterpretations
-- addition: Adding missing information
-- removal: Removing incorrect or irrelevant information
-- clarification: Rewording for clarity without changing meaning
-- style: Formatting or stylistic preferences
-- clinical_judgment: Changes based on clinical expertise
-
-Return as JSON:
-{{"category": "category_name", "reason": "brief explanation"}}
-
-Return ONLY valid JSON."""
+        prompt = CATEGORIZE_PROMPT.format(edits_text=edits_text)
 
-        result = self._generate_response(prompt)
+        async with category_semaphore:
+            result = await self._generate_response_async(prompt)
         
+        found: List[Optional[str]] = [None] * len(items)
         try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
-            category = parsed.get("category", "correction")
-        except:
-            category = "correction"
-        
-        return category, severity
+            parsed = parse_llm_json(result)
+            for item in parsed.get("edits", []):
+                edit_id = int(item["edit_id"])
+                if 0 <= edit_id < len(items) and item.get("category"):
+                    found[edit_id] = item["category"]
+        except (orjson.JSONDecodeError, AttributeError, KeyError, TypeError, ValueError) as e:
+            print(f"Edit categorization parse error: {e}")
+        return found
     
     def _update_specialty_metrics(self, specialty: str, log: EditLog):
         """Update running metrics for a specialty"""
@@ -214,15 +491,8 @@ Return ONLY valid JSON."""
         old_avg = metrics["avg_edit_distance"]
         metrics["avg_edit_distance"] = old_avg + (log.edit_distance - old_avg) / n
         
-        # Track improvement trend (lower edit distance = better)
-        metrics["improvement_trend"].append({
-            "timestamp": log.timestamp.isoformat(),
-            "edit_distance": log.edit_distance
-        })
-        
-        # Keep only last 100 entries
-        if len(metrics["improvement_trend"]) > 100:
-            metrics["improvement_trend"] = metrics["improvement_trend"][-100:]
+        # Track improvement trend (lower edit distance = better), last TREND_SIZE points
+        metrics["improvement_trend"].append(int(log.timestamp.timestamp()), log.edit_distance)
     
     def analyze_patterns(self, specialty: str = None) -> Dict[str, Any]:
         """
@@ -230,36 +500,22 @@ Return ONLY valid JSON."""
         Can be filtered by specialty.
         """
         
-        # Filter logs by specialty if specified
-        logs = self.edit_logs
-        if specialty:
-            logs = [l for l in logs if l.specialty == specialty]
-        
-        if not logs:
+        # Aggregates are kept up to date by _record_patterns, no scan over edit_logs
+        stats = self._pattern_stats.get(specialty or None)
+        if not stats:
             return {"message": "No edit logs available for analysis"}
         
-        # Aggregate statistics
-        section_edits = defaultdict(int)
-        category_counts = defaultdict(int)
-        severity_counts = defaultdict(int)
-        
-        for log in logs:
-            for section in log.sections_edited:
-                section_edits[section] += 1
-            category_counts[log.edit_category] += 1
-            severity_counts[log.edit_severity] += 1
+        section_edits = stats["section_edits"]
+        category_counts = stats["category_counts"]
+        severity_counts = stats["severity_counts"]
         
         # Calculate percentages
-        total = len(logs)
+        total = stats["total"]
         
         analysis = {
             "total_edits_analyzed": total,
             "specialty": specialty or "all",
-            "sections_most_edited": dict(sorted(
-                section_edits.items(),
-                key=lambda x: x[1],
-                reverse=True
-            )),
+            "sections_most_edited": dict(section_edits.most_common()),
             "edit_categories": {
                 k: {"count": v, "percentage": round(v/total*100, 1)}
                 for k, v in category_counts.items()
@@ -268,13 +524,28 @@ Return ONLY valid JSON."""
                 k: {"count": v, "percentage": round(v/total*100, 1)}
                 for k, v in severity_counts.items()
             },
-            "avg_edit_distance": round(
-                sum(l.edit_distance for l in logs) / total, 3
-            )
+            "avg_edit_distance": round(stats["sum_edit_distance"] / total, 3)
         }
         
         return analysis
     
+    def _record_patterns(self, logs: List[EditLog]):
+        """Add logs to the running analyze_patterns aggregates (overall and per specialty)"""
+        if not logs:
+            return
+        
+        by_specialty = defaultdict(list)
+        for log in logs:
+            by_specialty[log.specialty].append(log)
+        
+        for key, group in ((None, logs), *by_specialty.items()):
+            stats = self._pattern_stats[key]
+            stats["section_edits"].update(chain.from_iterable(l.sections_edited for l in group))
+            stats["category_counts"].update(l.edit_category for l in group if l.edit_category is not None)
+            stats["severity_counts"].update(l.edit_severity for l in group)
+            stats["sum_edit_distance"] += sum(l.edit_distance for l in group)
+            stats["total"] += len(group)
+    
     def generate_insights(self, specialty: str = None) -> List[LearningInsight]:
         """Generate actionable insights from edit patterns"""
         
@@ -294,48 +565,17 @@ Return ONLY valid JSON."""
         # Prepare sample edits for analysis
         sample_logs = logs[-10:]  # Last 10 edits
         
-        samples_text = "\n\n".join([
-            f"Edit {i+1}:\n"
-            f"Specialty: {log.specialty}\n"
-            f"Sections Changed: {log.sections_edited}\n"
-            f"Category: {log.edit_category}\n"
-            f"Original: {json.dumps(log.original_soap)}\n"
-            f"Edited: {json.dumps(log.edited_soap)}"
-            for i, log in enumerate(sample_logs)
-        ])
+        samples_text = "\n\n".join(
+            INSIGHT_SAMPLE.format(n, log.specialty, log.sections_edited, log.edit_category or "uncategorized", *log.serialized_soap())
+            for n, log in enumerate(sample_logs, 1)
+        )
         
-        prompt = f"""Analyze these doctor edits to AI-generated SOAP notes and identify patterns.
-
-EDIT SAMPLES:
-{samples_text}
-
-Identify:
-1. Common patterns in what doctors are changing
-2. Recurring issues in AI-generated content
-3. Specialty-specific patterns (if applicable)
-4. Suggestions for improving the AI prompts
-
-Return as JSON:
-{{
-  "insights": [
-    {{
-      "category": "content|structure|terminology|completeness|accuracy",
-      "insight": "Description of the pattern observed",
-      "frequency": "how often this occurs (1-10)",
-      "specialty_specific": "specialty name or null",
-      "suggested_prompt_update": "How to modify the SOAP generation prompt to address this",
-      "confidence": 0.0-1.0
-    }}
-  ],
-  "overall_recommendation": "Top priority improvement to make"
-}}
-
-Return ONLY valid JSON."""
+        prompt = INSIGHTS_PROMPT.format(samples_text=samples_text)
 
         result = self._generate_response(prompt)
         
         try:
-            parsed = json.loads(result.replace("```json", "").replace("```", "").strip())
+            parsed = parse_llm_json(result)
             
             insights = []
             for item in parsed.get("insights", []):
@@ -389,7 +629,7 @@ Return ONLY valid JSON."""
         if improvements["base_improvements"]:
             prompt = f"""Based on these identified issues with SOAP note generation:
 
-{json.dumps(improvements['base_improvements'], indent=2)}
+{orjson.dumps(improvements['base_improvements'], option=orjson.OPT_INDENT_2).decode()}
 
 Generate a set of additional instructions to add to the SOAP generation prompt.
 Format as a bullet list of rules/guidelines.
@@ -409,15 +649,14 @@ Return ONLY the bullet list, no explanation."""
                 return {"message": f"No data for specialty: {specialty}"}
             
             metrics = self.specialty_metrics[specialty]
-            trend = metrics.get("improvement_trend", [])
+            trend = metrics["improvement_trend"]
             
             if len(trend) >= 2:
                 # Calculate improvement
-                first_half = trend[:len(trend)//2]
-                second_half = trend[len(trend)//2:]
-                
-                first_avg = sum(t["edit_distance"] for t in first_half) / len(first_half)
-                second_avg = sum(t["edit_distance"] for t in second_half) / len(second_half)
+                mid = len(trend) // 2
+                distances = trend.distances.astype(np.float32)
+                first_avg = float(distances[:mid].mean())
+                second_avg = float(distances[mid:].mean())
                 
                 improvement = ((first_avg - second_avg) / first_avg) * 100 if first_avg > 0 else 0
             else:
@@ -428,7 +667,7 @@ Return ONLY the bullet list, no explanation."""
                 "total_edits": metrics["total_edits"],
                 "current_avg_edit_distance": round(metrics["avg_edit_distance"], 3),
                 "improvement_percentage": round(improvement, 1),
-                "trend_data": trend[-20:]  # Last 20 data points
+                "trend_data": trend.to_list(last=20)  # Last 20 data points
             }
         
         else:
@@ -456,74 +695,178 @@ Return ONLY the bullet list, no explanation."""
                 }
             }
     
-    def export_learning_data(self) -> Dict[str, Any]:
-        """Export all learning data for persistence"""
+    def export_learning_data(self, fp: Optional[BinaryIO] = None) -> Optional[Dict[str, Any]]:
+        """
+        Export all learning data for persistence.
+        Given a binary file, streams it there as JSONL (see iter_learning_data_jsonl)
+        instead of building the whole export in memory.
+        """
+        
+        if fp is not None:
+            fp.writelines(self.iter_learning_data_jsonl())
+            return None
         
         return {
-            "edit_logs": [
-                {
-                    "encounter_id": log.encounter_id,
-                    "doctor_id": log.doctor_id,
-                    "specialty": log.specialty,
-                    "original_soap": log.original_soap,
-                    "edited_soap": log.edited_soap,
-                    "sections_edited": log.sections_edited,
-                    "edit_distance": log.edit_distance,
-                    "edit_category": log.edit_category,
-                    "edit_severity": log.edit_severity,
-                    "timestamp": log.timestamp.isoformat()
-                }
-                for log in self.edit_logs
-            ],
-            "specialty_metrics": dict(self.specialty_metrics),
-            "insights": [
-                {
-                    "category": i.category,
-                    "insight": i.insight,
-                    "frequency": i.frequency,
-                    "suggested_prompt_update": i.suggested_prompt_update,
-                    "specialty": i.specialty,
-                    "confidence": i.confidence
-                }
-                for i in self.insights
-            ],
+            "edit_logs": [self._edit_log_record(log) for log in self.edit_logs],
+            "specialty_metrics": {
+                specialty: self._specialty_metrics_record(metrics)
+                for specialty, metrics in self.specialty_metrics.items()
+            },
+            "insights": [self._insight_record(i) for i in self.insights],
             "exported_at": datetime.now().isoformat()
         }
     
-    def import_learning_data(self, data: Dict[str, Any]):
-        """Import previously saved learning data"""
+    def iter_learning_data_jsonl(self) -> Iterator[bytes]:
+        """
+        Learning data as JSONL lines, one record at a time:
+        {"type": "edit_log" | "specialty_metrics" | "insight" | "exported_at", "data": ...}
+        Specialty metrics records also carry "specialty".
+        """
+        for log in self.edit_logs:
+            yield orjson.dumps({"type": "edit_log", "data": self._edit_log_record(log)}, option=orjson.OPT_APPEND_NEWLINE)
+        for specialty, metrics in self.specialty_metrics.items():
+            yield orjson.dumps(
+                {"type": "specialty_metrics", "specialty": specialty, "data": self._specialty_metrics_record(metrics)},
+                option=orjson.OPT_APPEND_NEWLINE
+            )
+        for insight in self.insights:
+            yield orjson.dumps({"type": "insight", "data": self._insight_record(insight)}, option=orjson.OPT_APPEND_NEWLINE)
+        yield orjson.dumps({"type": "exported_at", "data": datetime.now().isoformat()}, option=orjson.OPT_APPEND_NEWLINE)
+    
+    def import_learning_data_jsonl(self, fp: BinaryIO, recompute_distances: bool = False):
+        """Import learning data written by export_learning_data(fp)"""
+        
+        data = {"edit_logs": [], "specialty_metrics": {}, "insights": []}
+        for line in fp:
+            if not line.strip():
+                continue
+            record = orjson.loads(line)
+            if record["type"] == "edit_log":
+                data["edit_logs"].append(record["data"])
+            elif record["type"] == "specialty_metrics":
+                data["specialty_metrics"][record["specialty"]] = record["data"]
+            elif record["type"] == "insight":
+                data["insights"].append(record["data"])
+        
+        self.import_learning_data(data, recompute_distances=recompute_distances)
+    
+    @staticmethod
+    def _edit_log_record(log: EditLog) -> Dict[str, Any]:
+        return {
+            "encounter_id": log.encounter_id,
+            "doctor_id": log.doctor_id,
+            "specialty": log.specialty,
+            "original_soap": log.original_soap,
+            "edited_soap": log.edited_soap,
+            "sections_edited": log.sections_edited,
+            "edit_distance": log.edit_distance,
+            "edit_category": log.edit_category,
+            "edit_severity": log.edit_severity,
+            "timestamp": log.timestamp.isoformat()
+        }
+    
+    @staticmethod
+    def _specialty_metrics_record(metrics: Dict[str, Any]) -> Dict[str, Any]:
+        return {**metrics, "improvement_trend": metrics["improvement_trend"].to_list()}
+    
+    @staticmethod
+    def _insight_record(insight: LearningInsight) -> Dict[str, Any]:
+        return {
+            "category": insight.category,
+            "insight": insight.insight,
+            "frequency": insight.frequency,
+            "suggested_prompt_update": insight.suggested_prompt_update,
+            "specialty": insight.specialty,
+            "confidence": insight.confidence
+        }
+    
+    def import_learning_data(self, data: Dict[str, Any], recompute_distances: bool = False):
+        """
+        Import previously saved learning data.
+        With recompute_distances, edit distances of the imported logs are
+        recalculated with the current metric instead of trusting the export.
+        """
         
         # Import edit logs
-        for log_data in data.get("edit_logs", []):
-            log = EditLog(
-                encounter_id=log_data["encounter_id"],
-                doctor_id=log_data["doctor_id"],
-                specialty=log_data["specialty"],
-                original_soap=log_data["original_soap"],
-                edited_soap=log_data["edited_soap"],
-                sections_edited=log_data["sections_edited"],
-                edit_distance=log_data["edit_distance"],
-                edit_category=log_data["edit_category"],
-                edit_severity=log_data["edit_severity"],
-                timestamp=datetime.fromisoformat(log_data["timestamp"])
-            )
-            self.edit_logs.append(log)
+        logs = self._edit_logs_from_data(data.get("edit_logs", []))
+        if recompute_distances:
+            self._recompute_distances(logs)
+        self.edit_logs.extend(logs)
+        self._record_patterns(logs)
         
-        # Import specialty metrics
+        # Import specialty metrics (merged over defaults, so partial entries stay complete)
         for specialty, metrics in data.get("specialty_metrics", {}).items():
             self.specialty_metrics[specialty].update(metrics)
+            if "improvement_trend" in metrics:
+                self.specialty_metrics[specialty]["improvement_trend"] = ImprovementTrend.from_list(
+                    metrics["improvement_trend"]
+                )
         
         # Import insights
-        for insight_data in data.get("insights", []):
-            self.insights.append(LearningInsight(
+        self.insights.extend(
+            LearningInsight(
                 category=insight_data["category"],
                 insight=insight_data["insight"],
                 frequency=insight_data["frequency"],
                 suggested_prompt_update=insight_data["suggested_prompt_update"],
                 specialty=insight_data.get("specialty"),
                 confidence=insight_data.get("confidence", 0.5)
-            ))
-
+            )
+            for insight_data in data.get("insights", [])
+        )
+    
+    async def import_learning_data_async(
+        self,
+        data: Dict[str, Any],
+        recategorize: bool = False,
+        recompute_distances: bool = False
+    ):
+        """
+        import_learning_data, optionally re-running LLM categorization on the
+        imported edits (e.g. after the categories changed). Uncached edits are
+        categorized in concurrent batches rather than one call at a time.
+        """
+        logs = self._edit_logs_from_data(data.get("edit_logs", []))
+        if recompute_distances:
+            self._recompute_distances(logs)
+        if recategorize and logs:
+            categories = await self._categorize_edits(
+                [(log.original_soap, log.edited_soap, log.sections_edited) for log in logs]
+            )
+            for log, category in zip(logs, categories):
+                # Keep the exported category when recategorization fails
+                if category is not None:
+                    log.edit_category = category
+        
+        self.import_learning_data({**data, "edit_logs": []})
+        self.edit_logs.extend(logs)
+        self._record_patterns(logs)
+    
+    def _recompute_distances(self, logs: List[EditLog]) -> None:
+        """Recalculate edit_distance (RapidFuzz, per section) and sections_edited for each log"""
+        for log in logs:
+            log.sections_edited, weighted_similarities, _, _ = self._diff_sections(log.original_soap, log.edited_soap)
+            log.edit_distance = self._calculate_edit_distance(weighted_similarities)
+    
+    def _edit_logs_from_data(self, edit_logs: List[Dict[str, Any]]) -> List[EditLog]:
+        return [
+            EditLog(
+                encounter_id=log_data["encounter_id"],
+                doctor_id=log_data["doctor_id"],
+                specialty=log_data["specialty"],
+                original_soap=log_data["original_soap"],
+                edited_soap=log_data["edited_soap"],
+                sections_edited=log_data["sections_edited"],
+                edit_distance=log_data["edit_distance"],
+                edit_category=log_data["edit_category"],
+                edit_severity=log_data["edit_severity"],
+                timestamp=(
+                    log_data["timestamp"] if isinstance(log_data["timestamp"], datetime)
+                    else datetime.fromisoformat(log_data["timestamp"])
+                )
+            )
+            for log_data in edit_logs
+        ]
 
 # Create global instance
 reflexion_agent = ReflexionAgent()
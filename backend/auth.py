@@ -5,15 +5,31 @@ Handles user authentication for Patients, Doctors, and Hospital Admins
 
 import os
 import uuid
+import base64
 import hashlib
+import hmac
 import secrets
+import sys
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, date
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Tuple, Callable
 from dataclasses import dataclass, field
 from enum import Enum
 
 from fastapi import HTTPException, Depends, Header
 from pydantic import BaseModel, EmailStr
+from tenacity import retry, stop_after_attempt, wait_exponential
+
+from session_store import TokenStore
+
+try:
+    from supabase_client import get_supabase_client
+    SUPABASE_AVAILABLE = True
+except ImportError:
+    SUPABASE_AVAILABLE = False
+    print("⚠️ supabase not installed, using local auth only.")
 
 
 def calculate_age(date_of_birth: str) -> Optional[int]:
@@ -30,6 +46,47 @@ def calculate_age(date_of_birth: str) -> Optional[int]:
 
 # In production, use a proper database. For demo, using in-memory storage.
 
+# Salt of legacy SHA-256 password hashes (still verified for existing accounts)
+_SALT_BYTES = b"clinical_ehr_salt_2026"
+
+# Columns fetched for Supabase logins: the stored hash plus what the login response returns
+DOCTOR_LOGIN_COLUMNS = (
+    "id, email, name, phone, password_hash, specialty, subspecialty, "
+    "experience_years, qualifications, rating"
+)
+PATIENT_LOGIN_COLUMNS = (
+    "email, name, phone, password_hash, date_of_birth, gender, blood_group, "
+    "allergies, chronic_conditions, current_medications"
+)
+
+# Session token lifetime in seconds
+AUTH_TOKEN_TTL = int(os.getenv("AUTH_TOKEN_TTL", "86400"))
+
+# Supabase patient inserts waiting in the background writer; past this, signups insert inline
+SUPABASE_WRITE_QUEUE = int(os.getenv("SUPABASE_WRITE_QUEUE", "1000"))
+_supabase_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="supabase-write")
+
+# Random bytes per session token, and tokens pre-generated per os.urandom call
+TOKEN_BYTES = 32
+TOKEN_BATCH = 256
+
+# scrypt cost for new password hashes: N (CPU/memory, power of 2), r, p
+SCRYPT_N = int(os.getenv("SCRYPT_N", str(2 ** 14)))
+SCRYPT_R = int(os.getenv("SCRYPT_R", "8"))
+SCRYPT_P = int(os.getenv("SCRYPT_P", "1"))
+
+# Threads for bulk password hashing; each scrypt call holds 128*N*r bytes (16 MB by default)
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(min(4, os.cpu_count() or 1))))
+_hash_pool = ThreadPoolExecutor(max_workers=HASH_WORKERS, thread_name_prefix="password-hash")
+
+
+def bearer_token(authorization: Optional[str]) -> Optional[str]:
+    """Token from an "Authorization: Bearer <token>" header (scheme case-insensitive), else None"""
+    if not authorization or authorization[:7].lower() != "bearer ":
+        return None
+    token = authorization[7:].strip()
+    return token if token and " " not in token else None
+
 
 class UserRole(str, Enum):
     PATIENT = "patient"
@@ -37,7 +94,11 @@ class UserRole(str, Enum):
     HOSPITAL = "hospital"
 
 
-@dataclass
+# Role -> its interned string value, read by every auth response and local login
+_ROLE_VALUES: Dict[UserRole, str] = {role: sys.intern(role.value) for role in UserRole}
+
+
+@dataclass(slots=True)
 class User:
     id: str
     email: str
@@ -51,6 +112,18 @@ class User:
     token: Optional[str] = None
 
 
+def user_payload(user: User, **extra) -> Dict[str, Any]:
+    """A user as returned by the auth endpoints: identity fields, extras, then the profile merged over them"""
+    return {
+        "id": user.id,
+        "email": user.email,
+        "name": user.name,
+        "role": _ROLE_VALUES[user.role],
+        "phone": user.phone,
+        **extra,
+    } | user.profile
+
+
 class LoginRequest(BaseModel):
     id: str  # Can be email for patients or UUID for doctors
     password: str
@@ -91,17 +164,153 @@ class AuthManager:
     
     def __init__(self):
         self.users: Dict[str, User] = {}
-        self.tokens: Dict[str, str] = {}  # token -> user_id
+        # token -> user_id; in Redis when REDIS_URL is set, so every API worker sees each login
+        self.tokens = TokenStore(ttl=AUTH_TOKEN_TTL)
+        self._token_pool: deque = deque()
+        # email / phone -> user_id, kept in step with self.users for O(1) duplicate checks
+        self._email_index: Dict[str, str] = {}
+        self._phone_index: Dict[str, str] = {}
+        # (email, role value) -> user_id, for local logins
+        self._email_role_index: Dict[Tuple[str, str], str] = {}
+        # Created once and reused by every login/signup; None means local auth only
+        self._supabase = self._connect_supabase()
+        self._write_slots = threading.BoundedSemaphore(SUPABASE_WRITE_QUEUE)
+        # Signups run in worker threads; serializes the duplicate check with _add_user
+        self._signup_lock = threading.Lock()
         self._init_demo_users()
     
+    def _connect_supabase(self):
+        if not SUPABASE_AVAILABLE:
+            return None
+        try:
+            return get_supabase_client()
+        except Exception as e:
+            print(f"⚠️ Supabase unavailable, using local auth only: {e}")
+            return None
+    
+    @retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=0.5), reraise=True)
+    def _retry_write(self, write: Callable[[], Any]):
+        write()
+    
+    def _write(self, write: Callable[[], Any], label: str):
+        try:
+            self._retry_write(write)
+            print(f"✅ Supabase: {label}")
+        except Exception as e:
+            # Local state stands even if Supabase fails
+            print(f"⚠️ Warning: Supabase write failed ({label}): {e}")
+    
+    def _queue_write(self, write: Callable[[], Any], label: str):
+        """Run a Supabase write off the request path; inline if the writer is backed up"""
+        if not self._write_slots.acquire(blocking=False):
+            self._write(write, label)
+            return
+        
+        def run():
+            try:
+                self._write(write, label)
+            finally:
+                self._write_slots.release()
+        
+        _supabase_writer.submit(run)
+    
+    def _queue_patient_insert(self, patient_data: Dict[str, Any], label: str):
+        """Insert a patient row in the background (see _queue_write)"""
+        self._queue_write(
+            lambda: self._supabase.table("patients").insert(patient_data).execute(),
+            f"inserted {label}"
+        )
+    
+    def _upgrade_legacy_hash(self, table: str, key_column: str, row: Dict[str, Any], password: str, stored_hash: str):
+        """After a successful login, replace a legacy SHA-256 hash in Supabase with scrypt"""
+        if not self._is_legacy_hash(stored_hash):
+            return
+        new_hash = self._hash_password(password)
+        key = row.get(key_column)
+        self._queue_write(
+            lambda: self._supabase.table(table).update({"password_hash": new_hash}).eq(key_column, key).execute(),
+            f"rehashed {table} password for {key}"
+        )
+    
+    def _scrypt(self, password: str, salt: bytes) -> str:
+        return hashlib.scrypt(password.encode(), salt=salt, n=SCRYPT_N, r=SCRYPT_R, p=SCRYPT_P, dklen=32).hex()
+    
     def _hash_password(self, password: str) -> str:
-        """Hash password with salt"""
-        salt = "clinical_ehr_salt_2026"  # In production, use proper salt per user
-        return hashlib.sha256(f"{password}{salt}".encode()).hexdigest()
+        """Hash password with scrypt and a per-user salt, stored as "<base64 salt>:<hex digest>" """
+        # Deliberately not memoized: every call draws a fresh salt, and a cache keyed
+        # on the password would keep plaintext passwords in memory
+        salt = secrets.token_bytes(16)
+        return f"{base64.b64encode(salt).decode()}:{self._scrypt(password, salt)}"
+    
+    def _legacy_hash_password(self, password: str) -> str:
+        """Single SHA-256 with the global salt, the format of hashes stored before scrypt"""
+        h = hashlib.sha256(password.encode())
+        h.update(_SALT_BYTES)
+        return h.hexdigest()
+    
+    @staticmethod
+    def _is_legacy_hash(stored_hash: str) -> bool:
+        return ":" not in stored_hash
+    
+    def _verify_password(self, password: str, stored_hash: str) -> bool:
+        """Check a password against a stored scrypt or legacy SHA-256 hash"""
+        if self._is_legacy_hash(stored_hash):
+            return hmac.compare_digest(stored_hash, self._legacy_hash_password(password))
+        salt, digest = stored_hash.split(":", 1)
+        return hmac.compare_digest(digest, self._scrypt(password, base64.b64decode(salt)))
+    
+    def bulk_hash(self, passwords: List[str]) -> List[str]:
+        """
+        Hash many passwords (demo users, bulk patient imports) in order.
+        scrypt runs in OpenSSL with the GIL released, so the shared hash
+        pool spreads them over HASH_WORKERS cores.
+        """
+        if len(passwords) <= 1:
+            return [self._hash_password(password) for password in passwords]
+        return list(_hash_pool.map(self._hash_password, passwords))
+    
+    def _add_user(self, user: User):
+        """Store a user and index its email and phone (first registration wins)"""
+        self.users[user.id] = user
+        self._email_index.setdefault(user.email, user.id)
+        self._email_role_index.setdefault((user.email, _ROLE_VALUES[user.role]), user.id)
+        if user.phone:
+            self._phone_index.setdefault(user.phone, user.id)
+    
+    def bulk_load(self, users: List[User]):
+        """
+        Store many users at once (seeding, imports): one dict update per
+        index instead of _add_user per user. Same first-registration-wins rule.
+        """
+        self.users.update((user.id, user) for user in users)
+        emails: Dict[str, str] = {}
+        email_roles: Dict[Tuple[str, str], str] = {}
+        phones: Dict[str, str] = {}
+        for user in users:
+            emails.setdefault(user.email, user.id)
+            email_roles.setdefault((user.email, _ROLE_VALUES[user.role]), user.id)
+            if user.phone:
+                phones.setdefault(user.phone, user.id)
+        self._email_index.update((k, v) for k, v in emails.items() if k not in self._email_index)
+        self._email_role_index.update((k, v) for k, v in email_roles.items() if k not in self._email_role_index)
+        self._phone_index.update((k, v) for k, v in phones.items() if k not in self._phone_index)
     
     def _generate_token(self) -> str:
-        """Generate a secure session token"""
-        return secrets.token_urlsafe(32)
+        """Generate a secure session token (same format as secrets.token_urlsafe(32))"""
+        # deque.popleft is atomic, so concurrent logins in worker threads never share a token
+        while True:
+            try:
+                return self._token_pool.popleft()
+            except IndexError:
+                self._refill_tokens()
+    
+    def _refill_tokens(self):
+        """Pre-generate TOKEN_BATCH tokens from a single os.urandom read"""
+        raw = os.urandom(TOKEN_BYTES * TOKEN_BATCH)
+        self._token_pool.extend(
+            base64.urlsafe_b64encode(raw[i:i + TOKEN_BYTES]).rstrip(b"=").decode("ascii")
+            for i in range(0, len(raw), TOKEN_BYTES)
+        )
     
     def _init_demo_users(self):
         """Initialize demo users for testing"""
@@ -148,43 +357,47 @@ class AuthManager:
             },
         ]
         
-        for user_data in demo_users:
-            user = User(
+        password_hashes = self.bulk_hash([user_data["password"] for user_data in demo_users])
+        self.bulk_load([
+            User(
                 id=user_data["id"],
                 email=user_data["email"],
                 name=user_data["name"],
                 role=user_data["role"],
                 phone=user_data.get("phone"),
-                password_hash=self._hash_password(user_data["password"]),
+                password_hash=password_hash,
                 profile=user_data.get("profile", {}),
             )
-            self.users[user.id] = user
+            for user_data, password_hash in zip(demo_users, password_hashes)
+        ])
     
     def login(self, user_id: str, password: str, role: str) -> Dict[str, Any]:
         """Authenticate user and return token"""
         
-        password_hash = self._hash_password(password)
-        
         # For doctors, check Supabase doctors table
-        if role == "doctor":
+        if role == "doctor" and self._supabase is not None:
             try:
-                from supabase_client import get_supabase_client
-                supabase = get_supabase_client()
+                supabase = self._supabase
                 
-                # Query doctor by email first, then by ID (UUID)
-                response = supabase.table("doctors").select("*").eq("email", user_id).execute()
-                if not response.data:
-                    # Try by ID if email didn't match
-                    response = supabase.table("doctors").select("*").eq("id", user_id).execute()
+                # Query doctor by email or ID (UUID) in one round trip; id is a uuid
+                # column, so only match on it when user_id parses as one
+                query = supabase.table("doctors").select(DOCTOR_LOGIN_COLUMNS)
+                try:
+                    uuid.UUID(user_id)
+                    query = query.or_(f"email.eq.{user_id},id.eq.{user_id}")
+                except ValueError:
+                    query = query.eq("email", user_id)
+                response = query.limit(1).execute()
                 
-                if response.data and len(response.data) > 0:
+                if response.data:
                     doctor = response.data[0]
                     
                     # Check password
-                    stored_hash = doctor.get("password_hash", "").strip()
-                    password_hash = password_hash.strip()
+                    stored_hash = (doctor.get("password_hash") or "").strip()
                     
-                    if stored_hash and stored_hash == password_hash:
+                    if stored_hash and self._verify_password(password, stored_hash):
+                        self._upgrade_legacy_hash("doctors", "id", doctor, password, stored_hash)
+                        
                         # Generate token
                         token = self._generate_token()
                         self.tokens[token] = user_id
@@ -218,19 +431,20 @@ class AuthManager:
                 print(f"⚠️ Supabase doctor login error: {e}, falling back to local auth")
         
         # For patients, check Supabase first
-        if role == "patient":
+        if role == "patient" and self._supabase is not None:
             try:
-                from supabase_client import get_supabase_client
-                supabase = get_supabase_client()
+                supabase = self._supabase
                 
                 # Query patient by email (user_id is email for patients)
-                response = supabase.table("patients").select("*").eq("email", user_id).execute()
-                if response.data and len(response.data) > 0:
+                response = supabase.table("patients").select(PATIENT_LOGIN_COLUMNS).eq("email", user_id).limit(1).execute()
+                if response.data:
                     patient = response.data[0]
                     
                     # Check password
-                    stored_hash = patient.get("password_hash", "")
-                    if stored_hash and stored_hash == password_hash:
+                    stored_hash = (patient.get("password_hash") or "").strip()
+                    if stored_hash and self._verify_password(password, stored_hash):
+                        self._upgrade_legacy_hash("patients", "email", patient, password, stored_hash)
+                        
                         # Generate token
                         token = self._generate_token()
                         patient_id = f"patient-{patient.get('email', '')}"
@@ -271,17 +485,17 @@ class AuthManager:
                 print(f"⚠️ Supabase login error: {e}, falling back to local auth")
         
         # Fall back to local authentication (for demo users)
-        user = None
-        for u in self.users.values():
-            # Check by email or ID
-            if (u.email == user_id or u.id == user_id) and u.role.value == role:
-                user = u
-                break
+        # Check by (email, role), then by ID
+        user = self.users.get(self._email_role_index.get((user_id, role)))
+        if user is None:
+            user = self.users.get(user_id)
+            if user is not None and _ROLE_VALUES[user.role] != role:
+                user = None
         
         if not user:
             raise HTTPException(status_code=401, detail="Invalid ID or role")
         
-        if user.password_hash != password_hash:
+        if not self._verify_password(password, user.password_hash):
             raise HTTPException(status_code=401, detail="Invalid password")
         
         if not user.is_active:
@@ -294,34 +508,16 @@ class AuthManager:
         
         return {
             "success": True,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "name": user.name,
-                "role": user.role.value,
-                "phone": user.phone,
-                "token": token,
-                **user.profile,
-            },
+            "user": user_payload(user, token=token),
             "message": "Login successful"
         }
     
     def signup(self, data: PatientSignupRequest) -> Dict[str, Any]:
         """Register a new patient"""
         
-        # Check if email already exists
-        if data.email:
-            for u in self.users.values():
-                if u.email == data.email:
-                    raise HTTPException(status_code=400, detail="Email already registered")
-        
-        # Check if phone already exists
-        for u in self.users.values():
-            if u.phone == data.phone:
-                raise HTTPException(status_code=400, detail="Phone number already registered")
-        
-        # Create user
+        # Hash and build the user before taking the lock; scrypt is the slow part
         user_id = f"patient-{uuid.uuid4().hex[:8]}"
+        password_hash = self._hash_password(data.password)
         
         user = User(
             id=user_id,
@@ -329,7 +525,7 @@ class AuthManager:
             name=data.name,
             role=UserRole.PATIENT,
             phone=data.phone,
-            password_hash=self._hash_password(data.password),
+            password_hash=password_hash,
             profile={
                 "date_of_birth": data.date_of_birth,
                 "gender": data.gender,
@@ -342,21 +538,26 @@ class AuthManager:
             }
         )
         
-        self.users[user.id] = user
-        
-        # Insert patient into Supabase
-        try:
-            from supabase_client import get_supabase_client
-            supabase = get_supabase_client()
+        with self._signup_lock:
+            # Check if email already exists
+            if data.email and data.email in self._email_index:
+                raise HTTPException(status_code=400, detail="Email already registered")
             
-            # Prepare patient data for Supabase
+            # Check if phone already exists
+            if data.phone in self._phone_index:
+                raise HTTPException(status_code=400, detail="Phone number already registered")
+            
+            self._add_user(user)
+        
+        # Insert patient into Supabase in the background; the local user can already log in
+        if self._supabase is not None:
             patient_email = data.email or f"{data.phone}@temp.ehr"
             patient_data = {
                 "patient_id": patient_email,  # Required unique identifier
                 "email": patient_email,
                 "name": data.name,
                 "phone": data.phone,
-                "password_hash": self._hash_password(data.password),  # Store hashed password for login
+                "password_hash": password_hash,  # Store hashed password for login
                 "date_of_birth": data.date_of_birth,
                 "gender": data.gender,
                 "blood_group": data.blood_group,
@@ -366,14 +567,7 @@ class AuthManager:
                 "chronic_conditions": data.chronic_conditions or [],
                 "current_medications": data.current_medications or []
             }
-            
-            # Insert into patients table
-            supabase.table("patients").insert(patient_data).execute()
-            print(f"✅ Patient {data.email} inserted into Supabase")
-            
-        except Exception as e:
-            print(f"⚠️ Warning: Could not insert patient into Supabase: {e}")
-            # Continue with local registration even if Supabase fails
+            self._queue_patient_insert(patient_data, f"Patient {patient_email}")
         
         # Auto-login
         token = self._generate_token()
@@ -385,16 +579,7 @@ class AuthManager:
         
         return {
             "success": True,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "name": user.name,
-                "role": user.role.value,
-                "phone": user.phone,
-                "token": token,
-                "age": patient_age,
-                **user.profile,
-            },
+            "user": user_payload(user, token=token, age=patient_age),
             "message": "Registration successful"
         }
     
@@ -402,27 +587,11 @@ class AuthManager:
         """Quick registration for emergency patients"""
         
         # Check if phone already exists
-        for u in self.users.values():
-            if u.phone == data.phone:
-                # Return existing user
-                token = self._generate_token()
-                self.tokens[token] = u.id
-                return {
-                    "success": True,
-                    "user": {
-                        "id": u.id,
-                        "email": u.email,
-                        "name": u.name,
-                        "role": u.role.value,
-                        "phone": u.phone,
-                        "token": token,
-                        **u.profile,
-                    },
-                    "message": "Welcome back",
-                    "existing_user": True
-                }
+        existing_id = self._phone_index.get(data.phone)
+        if existing_id:
+            return self._welcome_back(existing_id)
         
-        # Create minimal user
+        # Create minimal user, hashing before taking the lock
         user_id = f"emergency-{uuid.uuid4().hex[:8]}"
         temp_password = secrets.token_urlsafe(8)
         
@@ -439,13 +608,16 @@ class AuthManager:
             }
         )
         
-        self.users[user.id] = user
+        with self._signup_lock:
+            # Another signup may have registered the phone while we were hashing
+            existing_id = self._phone_index.get(data.phone)
+            if not existing_id:
+                self._add_user(user)
+        if existing_id:
+            return self._welcome_back(existing_id)
         
-        # Insert emergency patient into Supabase
-        try:
-            from supabase_client import get_supabase_client
-            supabase = get_supabase_client()
-            
+        # Insert emergency patient into Supabase in the background
+        if self._supabase is not None:
             patient_data = {
                 "email": f"{data.phone}@emergency.ehr",
                 "name": data.name,
@@ -454,12 +626,7 @@ class AuthManager:
                 "chronic_conditions": [],
                 "current_medications": []
             }
-            
-            supabase.table("patients").insert(patient_data).execute()
-            print(f"✅ Emergency patient {data.phone} inserted into Supabase")
-            
-        except Exception as e:
-            print(f"⚠️ Warning: Could not insert emergency patient into Supabase: {e}")
+            self._queue_patient_insert(patient_data, f"Emergency patient {data.phone}")
         
         token = self._generate_token()
         self.tokens[token] = user.id
@@ -469,7 +636,7 @@ class AuthManager:
             "user": {
                 "id": user.id,
                 "name": user.name,
-                "role": user.role.value,
+                "role": _ROLE_VALUES[user.role],
                 "phone": user.phone,
                 "token": token,
                 "is_emergency": data.is_emergency,
@@ -478,6 +645,18 @@ class AuthManager:
             "temp_password": temp_password  # In production, send via SMS only
         }
     
+    def _welcome_back(self, user_id: str) -> Dict[str, Any]:
+        """quick_signup response for a phone that is already registered"""
+        u = self.users[user_id]
+        token = self._generate_token()
+        self.tokens[token] = u.id
+        return {
+            "success": True,
+            "user": user_payload(u, token=token),
+            "message": "Welcome back",
+            "existing_user": True
+        }
+    
     def get_user_by_token(self, token: str) -> Optional[User]:
         """Get user from token"""
         user_id = self.tokens.get(token)
@@ -490,12 +669,10 @@ class AuthManager:
         if not authorization:
             raise HTTPException(status_code=401, detail="Not authenticated")
         
-        # Extract token from "Bearer <token>"
-        parts = authorization.split()
-        if len(parts) != 2 or parts[0].lower() != "bearer":
+        token = bearer_token(authorization)
+        if not token:
             raise HTTPException(status_code=401, detail="Invalid authorization header")
         
-        token = parts[1]
         user = self.get_user_by_token(token)
         
         if not user:
@@ -511,28 +688,24 @@ class AuthManager:
         
         if updates.name:
             user.name = updates.name
-        if updates.phone:
-            user.phone = updates.phone
+        if updates.phone and updates.phone != user.phone:
+            with self._signup_lock:
+                if user.phone and self._phone_index.get(user.phone) == user.id:
+                    del self._phone_index[user.phone]
+                user.phone = updates.phone
+                self._phone_index.setdefault(user.phone, user.id)
         if updates.profile:
             user.profile.update(updates.profile)
         
         return {
             "success": True,
-            "user": {
-                "id": user.id,
-                "email": user.email,
-                "name": user.name,
-                "role": user.role.value,
-                "phone": user.phone,
-                **user.profile,
-            },
+            "user": user_payload(user),
             "message": "Profile updated"
         }
     
     def logout(self, token: str) -> Dict[str, Any]:
         """Logout user by invalidating token"""
-        if token in self.tokens:
-            del self.tokens[token]
+        del self.tokens[token]
         return {"success": True, "message": "Logged out"}
 
 
@@ -1,12 +1,16 @@
-import csv
+import pandas as pd
 
 input_path = "icd10cm-codes-2026.txt"  # path to the file you extracted
 output_path = "icd10.csv"
 
-with open(input_path, "r", encoding="utf-8") as infile, open(output_path, "w", newline="", encoding="utf-8") as outfile:
-    writer = csv.writer(outfile)
-    writer.writerow(["code", "description"])
-    for line in infile:
-        parts = line.strip().split(maxsplit=1)
-        if len(parts) == 2:
-            writer.writerow(parts)
+# Codes are left-aligned in columns 0-7 and descriptions start at column 8
+df = pd.read_fwf(
+    input_path,
+    colspecs=[(0, 7), (8, None)],
+    names=["code", "description"],
+    dtype=str,
+    keep_default_na=False,
+    encoding="utf-8",
+)
+df = df[(df["code"] != "") & (df["description"] != "")]
+df.to_csv(output_path, index=False)
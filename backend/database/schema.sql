@@ -280,6 +280,7 @@ CREATE TABLE IF NOT EXISTS triage_rules (
 -- =============================================================================
 CREATE INDEX IF NOT EXISTS idx_doctors_specialty ON doctors(specialty);
 CREATE INDEX IF NOT EXISTS idx_doctors_available ON doctors(is_available, current_load);
+CREATE INDEX IF NOT EXISTS idx_patients_email ON patients(email);
 CREATE INDEX IF NOT EXISTS idx_intake_sessions_status ON intake_sessions(session_status);
 CREATE INDEX IF NOT EXISTS idx_intake_sessions_patient ON intake_sessions(patient_id);
 CREATE INDEX IF NOT EXISTS idx_encounters_patient ON encounters(patient_id);
@@ -0,0 +1,48 @@
+# gemini_client.py
+"""
+Shared Gemini client (google-genai).
+One client per process means one HTTP connection pool: agents reuse its warm
+TLS connections instead of each configuring their own transport.
+"""
+
+import os
+from typing import Optional
+
+try:
+    from google import genai
+    from google.genai import types
+    GENAI_AVAILABLE = True
+except ImportError:
+    GENAI_AVAILABLE = False
+    print("⚠️ google-genai not installed, Gemini fallback disabled.")
+
+GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-2.0-flash")
+# Per-request timeout in milliseconds
+GEMINI_TIMEOUT_MS = int(os.getenv("GEMINI_TIMEOUT_MS", "30000"))
+
+
+def _make_client() -> Optional["genai.Client"]:
+    api_key = os.getenv("GOOGLE_API_KEY")
+    if not GENAI_AVAILABLE or not api_key:
+        return None
+    try:
+        return genai.Client(api_key=api_key, http_options=types.HttpOptions(timeout=GEMINI_TIMEOUT_MS))
+    except Exception as e:
+        print(f"Error creating Gemini client: {e}")
+        return None
+
+
+gemini_client = _make_client()
+
+
+async def warm_up(model: str = GEMINI_MODEL) -> None:
+    """
+    Open the async connection pool with a model metadata lookup, so the first
+    real fallback call skips the TLS handshake. Uses no generation quota.
+    """
+    if gemini_client is None:
+        return
+    try:
+        await gemini_client.aio.models.get(model=model)
+    except Exception as e:
+        print(f"Gemini warm-up failed: {e}")
@@ -7,12 +7,14 @@ import os
 from dotenv import load_dotenv
 load_dotenv()
 
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Header
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, Query, Header, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response, StreamingResponse
 from pydantic import BaseModel
 from typing import Optional, List, Dict, Any
+import asyncio
 import json
+import orjson
 import traceback
 from datetime import datetime
 import uuid
@@ -50,12 +52,15 @@ from agents.custom_orchestrator import orchestrator, run_full_pipeline_custom
 from agents.intake_triage_agent import intake_agent, IntakeSession
 from agents.doctor_matching_agent import doctor_matching_agent
 from agents.dual_validator_agent import dual_validator
-from agents.patient_summary_agent import patient_summary_agent
+from agents.patient_summary_agent import patient_summary_agent, SUMMARY_CSS_BYTES
 from agents.reflexion_agent import reflexion_agent
+from gemini_client import warm_up as warm_up_gemini
 
 # Import auth
 from auth import (
     auth_manager, 
+    bearer_token,
+    user_payload,
     LoginRequest, 
     PatientSignupRequest, 
     QuickSignupRequest,
@@ -118,6 +123,10 @@ class EncounterUpdate(BaseModel):
     edited_soap: Optional[Dict[str, Any]] = None
     diagnoses: Optional[List[str]] = None
 
+class EditPreviewRequest(BaseModel):
+    original_soap: Dict[str, str]
+    edited_soap: Dict[str, str]
+
 class ValidateSOAPRequest(BaseModel):
     soap_note: Dict[str, Any]
     source_conversation: Optional[List[Dict]] = None
@@ -131,6 +140,7 @@ class PatientSummaryRequest(BaseModel):
     follow_up_date: Optional[str] = None
     patient_name: Optional[str] = "Patient"
     doctor_name: Optional[str] = "Your doctor"
+    patient_id: Optional[str] = None
 
 class LoadDoctorsRequest(BaseModel):
     doctors: List[Dict[str, Any]]
@@ -170,33 +180,32 @@ def health():
 # AUTHENTICATION ENDPOINTS
 # ============================================================================
 
+def orjson_response(content: Any) -> Response:
+    """JSON response encoded by orjson in one pass, skipping FastAPI's jsonable_encoder walk"""
+    return Response(content=orjson.dumps(content), media_type="application/json")
+
 @app.post("/auth/login")
 async def login(request: LoginRequest):
     """Login for patients, doctors, and hospital admins"""
-    return auth_manager.login(request.id, request.password, request.role)
+    # Password hashing (scrypt) and Supabase lookups block; keep them off the event loop
+    return orjson_response(await asyncio.to_thread(auth_manager.login, request.id, request.password, request.role))
 
 @app.post("/auth/signup")
 async def signup(request: PatientSignupRequest):
     """Patient registration"""
-    return auth_manager.signup(request)
+    return orjson_response(await asyncio.to_thread(auth_manager.signup, request))
 
 @app.post("/auth/quick-signup")
 async def quick_signup(request: QuickSignupRequest):
     """Quick registration for emergency patients"""
-    return auth_manager.quick_signup(request)
+    return orjson_response(await asyncio.to_thread(auth_manager.quick_signup, request))
 
 @app.get("/auth/me")
 async def get_current_user(authorization: str = Header(None)):
     """Get current authenticated user"""
-    user = auth_manager.get_current_user(authorization)
-    return {
-        "id": user.id,
-        "email": user.email,
-        "name": user.name,
-        "role": user.role.value,
-        "phone": user.phone,
-        **user.profile,
-    }
+    # Token lookups may hit Redis with the sync client; keep them off the event loop
+    user = await asyncio.to_thread(auth_manager.get_current_user, authorization)
+    return orjson_response(user_payload(user))
 
 @app.put("/auth/profile")
 async def update_profile(
@@ -204,16 +213,15 @@ async def update_profile(
     authorization: str = Header(None)
 ):
     """Update user profile"""
-    user = auth_manager.get_current_user(authorization)
-    return auth_manager.update_profile(user.id, request)
+    user = await asyncio.to_thread(auth_manager.get_current_user, authorization)
+    return orjson_response(auth_manager.update_profile(user.id, request))
 
 @app.post("/auth/logout")
 async def logout(authorization: str = Header(None)):
     """Logout user"""
-    if authorization:
-        parts = authorization.split()
-        if len(parts) == 2:
-            return auth_manager.logout(parts[1])
+    token = bearer_token(authorization)
+    if token:
+        return await asyncio.to_thread(auth_manager.logout, token)
     return {"success": True, "message": "Logged out"}
 
 # ============================================================================
@@ -225,7 +233,7 @@ async def start_intake(patient_id: Optional[str] = Form(None)):
     """Start a new patient intake session"""
     session_id = str(uuid.uuid4())
     
-    session = intake_agent.create_session(session_id, patient_id)
+    session = await intake_agent.create_session(session_id, patient_id)
     greeting = intake_agent.get_greeting_message()
     
     return {
@@ -239,11 +247,11 @@ async def start_intake(patient_id: Optional[str] = Form(None)):
 async def intake_message(request: ChatMessage):
     """Process a message in the intake conversation"""
     
-    session = intake_agent.get_session(request.session_id)
+    session = await intake_agent.get_session(request.session_id)
     
     if not session:
         # Create new session if not exists
-        session = intake_agent.create_session(request.session_id, request.patient_id)
+        session = await intake_agent.create_session(request.session_id, request.patient_id)
         greeting = intake_agent.get_greeting_message()
         return {
             "session_id": request.session_id,
@@ -253,10 +261,14 @@ async def intake_message(request: ChatMessage):
         }
     
     # Process message
-    result = intake_agent.process_message(request.session_id, request.message)
+    result = await intake_agent.process_message(request.session_id, request.message)
     
+    return _intake_reply(request.session_id, result)
+
+def _intake_reply(session_id: str, result: Dict[str, Any]) -> Dict[str, Any]:
+    """Shape an intake agent result for the client"""
     return {
-        "session_id": request.session_id,
+        "session_id": session_id,
         "message": result.get("response", ""),
         "stage": result.get("stage", "unknown"),
         "is_emergency": result.get("is_emergency", False),
@@ -266,23 +278,77 @@ async def intake_message(request: ChatMessage):
         "suggested_specialties": result.get("suggested_specialties", [])
     }
 
+@app.post("/intake/message/stream")
+async def intake_message_stream(request: ChatMessage):
+    """
+    Process an intake message as Server-Sent Events.
+    Emits "delta" events with response text as it is generated, then a
+    final "message" event with the same payload as /intake/message.
+    """
+    if not await intake_agent.get_session(request.session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    
+    async def events():
+        async for event in intake_agent.process_message_stream(request.session_id, request.message):
+            if event["type"] == "delta":
+                payload = {"type": "delta", "delta": event["delta"]}
+            else:
+                payload = {"type": "message", **_intake_reply(request.session_id, event)}
+            yield f"data: {json.dumps(payload)}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.websocket("/intake/ws/{session_id}")
+async def intake_websocket(websocket: WebSocket, session_id: str):
+    """
+    Intake conversation over a single WebSocket.
+    Each client text frame is one patient turn; the server pushes a
+    "processing" event immediately, "delta" events as the response is
+    generated, then the turn result.
+    """
+    await websocket.accept()
+    
+    if not await intake_agent.get_session(session_id):
+        await intake_agent.create_session(session_id)
+        await websocket.send_json({
+            "type": "message",
+            "session_id": session_id,
+            "message": intake_agent.get_greeting_message(),
+            "stage": "greeting",
+            "new_session": True
+        })
+    
+    try:
+        while True:
+            user_message = await websocket.receive_text()
+            await websocket.send_json({"type": "processing", "session_id": session_id})
+            
+            async for event in intake_agent.process_message_stream(session_id, user_message):
+                if event["type"] == "delta":
+                    await websocket.send_json({"type": "delta", "delta": event["delta"]})
+                else:
+                    await websocket.send_json({"type": "message", **_intake_reply(session_id, event)})
+    except WebSocketDisconnect:
+        pass
+
 @app.get("/intake/session/{session_id}")
 async def get_intake_session(session_id: str):
     """Get current state of intake session"""
     
-    summary = intake_agent.get_session_summary(session_id)
+    summary = await intake_agent.get_session_summary_json(session_id)
     
-    if "error" in summary:
-        raise HTTPException(status_code=404, detail=summary["error"])
+    if summary is None:
+        raise HTTPException(status_code=404, detail="Session not found")
     
-    return summary
+    # Already serialized (and cached per session version) by the agent
+    return Response(content=summary, media_type="application/json")
 
 @app.get("/intake/sessions")
 async def list_intake_sessions():
     """List all active intake sessions"""
     
     sessions = []
-    for session_id, session in intake_agent.sessions.items():
+    for session_id, session in await intake_agent.sessions.items():
         sessions.append({
             "session_id": session_id,
             "patient_id": session.patient_id,
@@ -302,15 +368,16 @@ class UpdateSessionRequest(BaseModel):
 @app.post("/intake/update")
 async def update_intake_session(request: UpdateSessionRequest):
     """Update an intake session with edited SOAP notes"""
-    if request.session_id not in intake_agent.sessions:
+    session = await intake_agent.get_session(request.session_id)
+    if not session:
         raise HTTPException(status_code=404, detail="Session not found")
     
-    session = intake_agent.sessions[request.session_id]
     # Update the session SOAP
     if request.preliminary_soap:
         session.preliminary_soap = request.preliminary_soap
     if request.final_soap:
         session.final_soap = request.final_soap
+    await intake_agent.save_session(session)
     
     # Also save to draft store for doctor review
     patient_id = session.patient_id or f"patient-{request.session_id}"
@@ -375,7 +442,7 @@ async def match_doctor(request: DoctorMatchRequest):
 async def assign_doctor(request: DoctorAssignRequest):
     """Assign a doctor to a patient session and save draft SOAP"""
     
-    session_summary = intake_agent.get_session_summary(request.session_id)
+    session_summary = await intake_agent.get_session_summary(request.session_id)
     
     if "error" in session_summary:
         raise HTTPException(status_code=404, detail="Session not found")
@@ -620,7 +687,7 @@ async def get_doctor_pending_soaps(doctor_id: str):
                     })
         
         # Also include drafts from intake sessions
-        for session_id, session in intake_agent.sessions.items():
+        for session_id, session in await intake_agent.sessions.items():
             if session.preliminary_soap and session.current_stage == "complete":
                 # Find if there's an appointment for this session
                 for apt in appointments:
@@ -721,7 +788,7 @@ async def finalize_soap(request: FinalizeSoapRequest):
                 encounter_data["intake_session_id"] = draft_data["session_id"]
                 
                 # If we have session details, we can enrich the encounter
-                session = intake_agent.sessions.get(draft_data["session_id"])
+                session = await intake_agent.get_session(draft_data["session_id"])
                 if session:
                     encounter_data["pre_visit_soap"] = session.preliminary_soap
                     encounter_data["validation_scores"] = validation_result
@@ -846,8 +913,8 @@ async def get_draft_soap_by_id(draft_id: str, patient_id: str):
         # Check if it's an intake session
         if draft_id.startswith("intake_"):
             session_id = draft_id.replace("intake_", "")
-            if session_id in intake_agent.sessions:
-                session = intake_agent.sessions[session_id]
+            session = await intake_agent.get_session(session_id)
+            if session:
                 return {
                     "success": True,
                     "draft": {
@@ -1007,25 +1074,45 @@ async def validate_soap(request: ValidateSOAPRequest):
 # PATIENT SUMMARY ENDPOINTS
 # ============================================================================
 
+@app.get("/summary/summary.css")
+async def get_summary_css():
+    """Stylesheet for formatted_html; static, so clients cache it instead of receiving it per summary"""
+    return Response(
+        content=SUMMARY_CSS_BYTES,
+        media_type="text/css",
+        headers={"Cache-Control": "public, max-age=86400"}
+    )
+
 @app.post("/summary/generate")
 async def generate_patient_summary(request: PatientSummaryRequest):
     """Generate a patient-friendly summary"""
     
-    summary = patient_summary_agent.generate_patient_summary(
+    summary = await patient_summary_agent.generate_patient_summary(
         soap_note=request.soap_note,
         diagnoses=request.diagnoses,
         medications=request.medications,
         follow_up_date=request.follow_up_date,
         patient_name=request.patient_name,
-        doctor_name=request.doctor_name
+        doctor_name=request.doctor_name,
+        patient_id=request.patient_id
     )
     
     return {
         "summary": summary,
         "formatted_text": patient_summary_agent.format_for_display(summary),
-        "formatted_html": patient_summary_agent.format_for_html(summary)
+        "formatted_html": patient_summary_agent.format_for_html(summary, include_css=False)
     }
 
+@app.post("/summary/batch")
+async def generate_patient_summary_batch(requests: List[PatientSummaryRequest]):
+    """Generate patient-friendly summaries for many encounters at once (e.g. end-of-day discharges)"""
+    
+    summaries = await patient_summary_agent.generate_patient_summary_batch(
+        [request.model_dump() for request in requests]
+    )
+    
+    return {"summaries": summaries, "count": len(summaries)}
+
 @app.post("/summary/sms")
 async def generate_sms_summary(
     soap_note: Dict[str, Any],
@@ -1033,13 +1120,56 @@ async def generate_sms_summary(
 ):
     """Generate a brief SMS-friendly summary"""
     
-    sms = patient_summary_agent.generate_sms_summary(soap_note, patient_name)
+    sms = await patient_summary_agent.generate_sms_summary(soap_note, patient_name)
     
     return {
         "sms": sms,
         "length": len(sms)
     }
 
+@app.post("/summary/sms/stream")
+async def generate_sms_summary_stream(
+    soap_note: Dict[str, Any],
+    patient_name: str = "Patient"
+):
+    """
+    Stream the SMS summary as Server-Sent Events.
+    Emits "delta" events as text arrives, then a final "sms" event with the full message.
+    """
+    
+    async def events():
+        parts = []
+        async for delta in patient_summary_agent.generate_sms_summary_stream(soap_note, patient_name):
+            parts.append(delta)
+            yield f"data: {json.dumps({'type': 'delta', 'delta': delta})}\n\n"
+        sms = "".join(parts)
+        yield f"data: {json.dumps({'type': 'sms', 'sms': sms, 'length': len(sms)})}\n\n"
+    
+    return StreamingResponse(events(), media_type="text/event-stream")
+
+@app.post("/summary/all")
+async def generate_all_summaries(request: PatientSummaryRequest):
+    """Generate the patient-friendly summary and the SMS summary in one request"""
+    
+    result = await patient_summary_agent.generate_all(
+        soap_note=request.soap_note,
+        diagnoses=request.diagnoses,
+        medications=request.medications,
+        follow_up_date=request.follow_up_date,
+        patient_name=request.patient_name,
+        doctor_name=request.doctor_name,
+        patient_id=request.patient_id
+    )
+    summary = result["summary"]
+    
+    return {
+        "summary": summary,
+        "formatted_text": patient_summary_agent.format_for_display(summary),
+        "formatted_html": patient_summary_agent.format_for_html(summary, include_css=False),
+        "sms": result["sms"],
+        "length": len(result["sms"])
+    }
+
 # ============================================================================
 # DOCTOR ENCOUNTER ENDPOINTS
 # ============================================================================
@@ -1060,7 +1190,7 @@ async def update_encounter(request: EncounterUpdate):
         }
         
         # Log the edit for learning
-        edit_log = reflexion_agent.log_edit(
+        edit_log = await reflexion_agent.log_edit(
             encounter_id=request.encounter_id,
             doctor_id="doctor_1",  # Would come from auth
             specialty="General Medicine",  # Would come from doctor profile
@@ -1121,6 +1251,11 @@ async def get_learning_metrics(specialty: Optional[str] = None):
     """Get learning performance metrics"""
     return reflexion_agent.get_performance_metrics(specialty)
 
+@app.post("/learning/edit-preview")
+async def preview_edit_distance(request: EditPreviewRequest):
+    """Cheap approximate edit distance and severity for live feedback while editing (nothing is logged)"""
+    return reflexion_agent.fast_edit_distance(request.original_soap, request.edited_soap)
+
 @app.get("/learning/patterns")
 async def get_learning_patterns(specialty: Optional[str] = None):
     """Analyze edit patterns"""
@@ -1153,6 +1288,11 @@ async def export_learning_data():
     """Export all learning data"""
     return reflexion_agent.export_learning_data()
 
+@app.get("/learning/export.jsonl")
+async def export_learning_data_jsonl():
+    """Export all learning data as streamed JSONL, one record per line"""
+    return StreamingResponse(reflexion_agent.iter_learning_data_jsonl(), media_type="application/x-ndjson")
+
 # ============================================================================
 # CHAT ENDPOINTS
 # ============================================================================
@@ -1790,6 +1930,9 @@ async def startup_event():
     print("✅ Patient Summary Agent Ready")
     print("✅ Reflexion Learning Agent Ready")
     
+    # Open the shared Gemini connection pool in the background so the first fallback call is warm
+    app.state.gemini_warm_up = asyncio.create_task(warm_up_gemini())
+    
     # Load sample doctors for demo
     sample_doctors = [
         {
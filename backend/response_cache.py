@@ -0,0 +1,87 @@
+# response_cache.py
+"""
+Exact-match cache for LLM responses, shared by the agents.
+Keys are SHA-256 hashes of (model, normalized prompt); entries live in a
+SQLite file (WAL mode) with TTL expiry and oldest-first eviction.
+
+Entries are LLM responses that include patient data, stored in
+plaintext, so the cache is opt-in (LLM_CACHE_ENABLED=1).
+"""
+
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Optional
+
+LLM_CACHE_PATH = os.getenv(
+    "LLM_CACHE_PATH", os.path.join(os.path.dirname(os.path.abspath(__file__)), "data", "llm_cache.sqlite3")
+)
+
+
+def normalize_prompt(text: str) -> str:
+    """NFC, trimmed, whitespace collapsed, so cosmetic differences share a key"""
+    return " ".join(unicodedata.normalize("NFC", text).split())
+
+
+class ResponseCache:
+    def __init__(self, path: str = LLM_CACHE_PATH, max_entries: int = 10_000, ttl: float = 7 * 24 * 3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, response TEXT, created_at REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS responses_created_at ON responses (created_at)")
+
+    @staticmethod
+    def make_key(model: str, *parts: Any) -> str:
+        text = "|".join([model, *(normalize_prompt(p) if isinstance(p, str) else repr(p) for p in parts)])
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ? AND created_at > ?", (key, time.time() - self.ttl)
+            ).fetchone()
+        return row[0] if row else None
+
+    def put(self, key: str, response: str) -> None:
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses (key, response, created_at) VALUES (?, ?, ?)",
+                (key, response, time.time())
+            )
+            self._conn.execute(
+                "DELETE FROM responses WHERE key IN "
+                "(SELECT key FROM responses ORDER BY created_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+
+    async def aget(self, key: str) -> Optional[str]:
+        """get() in a worker thread, off the event loop"""
+        return await asyncio.to_thread(self.get, key)
+
+    async def aput(self, key: str, response: str) -> None:
+        """put() in a worker thread, off the event loop"""
+        await asyncio.to_thread(self.put, key, response)
+
+
+def _open_cache() -> Optional[ResponseCache]:
+    if os.getenv("LLM_CACHE_ENABLED", "0") != "1":
+        return None
+    try:
+        return ResponseCache()
+    except sqlite3.Error as e:
+        print(f"LLM response cache unavailable: {e}")
+        return None
+
+
+response_cache = _open_cache()
+
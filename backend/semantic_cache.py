@@ -0,0 +1,99 @@
+# semantic_cache.py
+"""
+In-memory semantic cache for deterministic LLM calls.
+Entries are keyed by namespace (e.g. per system prompt or per patient) and
+matched by cosine similarity of the normalized user message embedding.
+max_entries bounds the whole cache, across namespaces, in LRU order.
+"""
+
+import re
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+_NUMBER_RE = re.compile(r"\d+(?:\.\d+)?")
+
+
+def numeric_signature(text: str) -> Tuple[str, ...]:
+    """
+    Numbers in the text, in order. Embeddings barely move between
+    "2 days" and "5 days", so only entries with the same numbers are
+    eligible to match.
+    """
+    return tuple(_NUMBER_RE.findall(text))
+
+
+class SemanticCache:
+    def __init__(self, threshold: float = 0.92, max_entries: int = 2048, ttl: float = 3600):
+        self.threshold = threshold
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # namespace -> (numeric signature, text) -> (embedding, value, created_at)
+        self._entries: Dict[str, Dict[Tuple[Tuple[str, ...], str], Tuple[np.ndarray, str, float]]] = {}
+        # (namespace, key) for every entry, least recently used first
+        self._lru: "OrderedDict[Tuple[str, Tuple[Tuple[str, ...], str]], None]" = OrderedDict()
+        self._last_sweep = time.time()
+
+    def _remove(self, namespace: str, key: Tuple[Tuple[str, ...], str]) -> None:
+        entries = self._entries[namespace]
+        del entries[key]
+        self._lru.pop((namespace, key), None)
+        if not entries:
+            del self._entries[namespace]
+
+    def _sweep(self, now: float) -> None:
+        """Drop expired entries in every namespace, at most once per ttl"""
+        if now - self._last_sweep < self.ttl:
+            return
+        self._last_sweep = now
+        for namespace, key in list(self._lru):
+            if now - self._entries[namespace][key][2] > self.ttl:
+                self._remove(namespace, key)
+
+    def embed(self, text: str) -> Optional[np.ndarray]:
+        """Normalized embedding for text, or None if the model is unavailable"""
+        try:
+            from embeddings import embed_texts
+            return embed_texts(text)[0]
+        except Exception as e:
+            print(f"Semantic cache embedding unavailable: {e}")
+            return None
+
+    def get(self, namespace: str, text: str, embedding: np.ndarray) -> Optional[str]:
+        """Return the cached value for the most similar entry above threshold"""
+        entries = self._entries.get(namespace)
+        if not entries:
+            return None
+
+        now = time.time()
+        sig = numeric_signature(text)
+        candidates = []
+        for key, (vec, _, created) in list(entries.items()):
+            if now - created > self.ttl:
+                self._remove(namespace, key)
+            elif key[0] == sig:
+                candidates.append((key, vec))
+        if not candidates:
+            return None
+
+        scores = np.stack([vec for _, vec in candidates]) @ embedding
+        best = int(np.argmax(scores))
+        if scores[best] < self.threshold:
+            return None
+
+        key = candidates[best][0]
+        self._lru.move_to_end((namespace, key))
+        return entries[key][1]
+
+    def put(self, namespace: str, text: str, embedding: np.ndarray, value: str) -> None:
+        """Store value for text, evicting the least recently used entry (any namespace) when full"""
+        now = time.time()
+        self._sweep(now)
+        key = (numeric_signature(text), text)
+        self._entries.setdefault(namespace, {})[key] = (embedding, value, now)
+        self._lru[(namespace, key)] = None
+        self._lru.move_to_end((namespace, key))
+        while len(self._lru) > self.max_entries:
+            self._remove(*next(iter(self._lru)))
@@ -0,0 +1,111 @@
+# session_store.py
+"""
+Shared session storage.
+With REDIS_URL set, sessions are stored in Redis as JSON with a TTL so any
+API worker can serve any turn; otherwise they live in an in-process TTL cache.
+"""
+
+import json
+import os
+from typing import Any, Callable, Dict, Generic, List, Optional, Tuple, TypeVar
+
+from cachetools import TTLCache
+
+T = TypeVar("T")
+
+
+class SessionStore(Generic[T]):
+    def __init__(
+        self,
+        prefix: str,
+        dump: Callable[[T], Dict[str, Any]],
+        load: Callable[[Dict[str, Any]], T],
+        ttl: int = 3600,
+        max_local: int = 10_000,
+        url: Optional[str] = None
+    ):
+        self.prefix = prefix
+        self.ttl = ttl
+        self._dump = dump
+        self._load = load
+        self._redis = None
+        self._local: Optional[TTLCache] = None
+
+        url = url or os.getenv("REDIS_URL")
+        if url:
+            import redis.asyncio as redis
+            self._redis = redis.from_url(url, decode_responses=True)
+        else:
+            self._local = TTLCache(maxsize=max_local, ttl=ttl)
+
+    def _key(self, session_id: str) -> str:
+        return f"{self.prefix}:{session_id}"
+
+    async def get(self, session_id: str) -> Optional[T]:
+        """Load a session, or None if it does not exist or has expired"""
+        if self._redis is None:
+            return self._local.get(session_id)
+        raw = await self._redis.get(self._key(session_id))
+        return self._load(json.loads(raw)) if raw else None
+
+    async def put(self, session_id: str, session: T) -> None:
+        """Save a session and restart its TTL"""
+        if self._redis is None:
+            self._local[session_id] = session
+            return
+        await self._redis.setex(self._key(session_id), self.ttl, json.dumps(self._dump(session), default=str))
+
+    async def items(self) -> List[Tuple[str, T]]:
+        """All live sessions as (session_id, session) pairs"""
+        if self._redis is None:
+            return list(self._local.items())
+        keys = [key async for key in self._redis.scan_iter(match=self._key("*"))]
+        if not keys:
+            return []
+        values = await self._redis.mget(keys)
+        start = len(self.prefix) + 1
+        return [(key[start:], self._load(json.loads(raw))) for key, raw in zip(keys, values) if raw]
+
+
+class TokenStore:
+    """
+    Auth token -> user_id map with a TTL. Same backends as SessionStore
+    (Redis with REDIS_URL, else in-process), but synchronous, since
+    AuthManager runs in worker threads rather than on the event loop.
+    """
+
+    def __init__(self, prefix: str = "auth_token", ttl: int = 86400, max_local: int = 100_000, url: Optional[str] = None):
+        self.prefix = prefix
+        self.ttl = ttl
+        self._redis = None
+        self._local: Optional[TTLCache] = None
+
+        url = url or os.getenv("REDIS_URL")
+        if url:
+            import redis
+            self._redis = redis.Redis.from_url(url, decode_responses=True)
+        else:
+            self._local = TTLCache(maxsize=max_local, ttl=ttl)
+
+    def _key(self, token: str) -> str:
+        return f"{self.prefix}:{token}"
+
+    def get(self, token: str) -> Optional[str]:
+        if self._redis is None:
+            return self._local.get(token)
+        return self._redis.get(self._key(token))
+
+    def __setitem__(self, token: str, user_id: str) -> None:
+        if self._redis is None:
+            self._local[token] = user_id
+            return
+        self._redis.setex(self._key(token), self.ttl, user_id)
+
+    def __contains__(self, token: str) -> bool:
+        return self.get(token) is not None
+
+    def __delitem__(self, token: str) -> None:
+        if self._redis is None:
+            self._local.pop(token, None)
+            return
+        self._redis.delete(self._key(token))
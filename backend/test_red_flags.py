@@ -0,0 +1,44 @@
+import os
+import unittest
+
+os.environ.setdefault("GROQ_API_KEY", "test")
+
+from agents.intake_triage_agent import IntakeTriageAgent
+
+
+class RedFlagTest(unittest.TestCase):
+    # Plural, past-tense and other inflected forms must still escalate
+    FLAGGED = [
+        "I had two seizures today",
+        "my son overdosed",
+        "chest pains since morning",
+        "I think she is having a stroke",
+        "he had strokes before",
+        "Worst headaches of my life",
+        "sudden weakness in my arm",
+        "I CAN'T BREATHE",
+        "she was unconscious for a minute",
+    ]
+
+    NOT_FLAGGED = [
+        "mild sore throat for two days",
+        "runny nose and sneezing",
+    ]
+
+    @classmethod
+    def setUpClass(cls):
+        cls.agent = IntakeTriageAgent()
+
+    def test_flagged(self):
+        for text in self.FLAGGED:
+            with self.subTest(text=text):
+                self.assertTrue(self.agent._check_red_flags(text))
+
+    def test_not_flagged(self):
+        for text in self.NOT_FLAGGED:
+            with self.subTest(text=text):
+                self.assertFalse(self.agent._check_red_flags(text))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,5 +1,11 @@
 # utils.py
 import re
+import time
+from datetime import datetime
+from functools import lru_cache
+from typing import Any
+
+import orjson
 
 def deidentify_text(text: str) -> str:
     """
@@ -20,3 +26,35 @@ def deidentify_text(text: str) -> str:
     # MRN-like tokens
     x = re.sub(r'\bMRN[:\s]*\d+\b', '[REDACTED_MRN]', x, flags=re.IGNORECASE)
     return x
+
+
+# A ```json ... ``` fence around a model reply, stripped in one pass
+_FENCE_RE = re.compile(r"^\s*```(?:json)?\s*|\s*```\s*$")
+
+
+def parse_llm_json(text: str) -> Any:
+    """Parse a JSON reply from an LLM, dropping a surrounding code fence if present"""
+    return orjson.loads(_FENCE_RE.sub("", text))
+
+
+# Coarse clock for display and metadata timestamps: the formatted strings are
+# rebuilt at most once per second (ISO) or minute (date) rather than per call.
+
+@lru_cache(maxsize=1)
+def _iso_for_second(second: int) -> str:
+    return datetime.fromtimestamp(second).isoformat()
+
+
+@lru_cache(maxsize=1)
+def _date_for_minute(minute: int) -> str:
+    return time.strftime('%B %d, %Y', time.localtime(minute * 60))
+
+
+def now_iso() -> str:
+    """Local time as ISO-8601, to the second"""
+    return _iso_for_second(int(time.time()))
+
+
+def today_long() -> str:
+    """Today's date as e.g. 'March 05, 2025'"""
+    return _date_for_minute(int(time.time() // 60))
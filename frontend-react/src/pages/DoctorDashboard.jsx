@@ -151,7 +151,8 @@ export default function DoctorDashboard() {
                 null,
                 null,
                 selectedSession?.patient_id || 'Patient',
-                'Dr. Smith'
+                'Dr. Smith',
+                selectedSession?.patient_id
             );
             setPatientSummary(result);
             setActiveTab('summary');
@@ -568,10 +569,13 @@ export default function DoctorDashboard() {
                         Preview
                     </h3>
                     {patientSummary?.formatted_html && (
-                        <div
-                            className="prose prose-sm max-w-none"
-                            dangerouslySetInnerHTML={{ __html: patientSummary.formatted_html }}
-                        />
+                        <>
+                            <link rel="stylesheet" href={summaryAPI.cssUrl} />
+                            <div
+                                className="prose prose-sm max-w-none"
+                                dangerouslySetInnerHTML={{ __html: patientSummary.formatted_html }}
+                            />
+                        </>
                     )}
                 </div>
 
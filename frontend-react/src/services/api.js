@@ -310,14 +310,18 @@ export const soapAPI = {
 // ============================================================================
 
 export const summaryAPI = {
+    // Stylesheet for formatted_html, cached by the browser
+    cssUrl: `${API_BASE_URL}/summary/summary.css`,
+
     // Generate patient summary
-    generate: async (soapNote, diagnoses = null, medications = null, patientName = 'Patient', doctorName = 'Your doctor') => {
+    generate: async (soapNote, diagnoses = null, medications = null, patientName = 'Patient', doctorName = 'Your doctor', patientId = null) => {
         const response = await api.post('/summary/generate', {
             soap_note: soapNote,
             diagnoses,
             medications,
             patient_name: patientName,
             doctor_name: doctorName,
+            patient_id: patientId,
         });
         return response.data;
     },